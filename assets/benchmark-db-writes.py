@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Benchmark the database operations the indexing tools perform: adds,
+adds of datasets already present, updates with and without allow_any,
+archives, existence checks by id and by location, at several batch and
+table sizes
+
+Runs against the datacube configured in the environment, e.g. the
+docker-compose database after `make init`. Datasets of a synthetic
+`benchmark_writes` product are added to it, and removed again with
+--cleanup.
+"""
+import csv
+import math
+import statistics
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import click
+from datacube import Datacube
+from datacube.index.hl import Doc2Dataset
+from datacube.utils import changes
+
+from odc_index.db import (
+    _engine,
+    add_datasets_if_absent,
+    bulk_has_location,
+    bulk_unchanged,
+)
+
+PRODUCT_NAME = "benchmark_writes"
+
+PRODUCT = {
+    "name": PRODUCT_NAME,
+    "description": "Synthetic datasets for database write benchmarks",
+    "metadata_type": "eo3",
+    "metadata": {"product": {"name": PRODUCT_NAME}},
+    "measurements": [{"name": "band", "dtype": "uint16", "nodata": 0, "units": "1"}],
+}
+
+# Namespace for the ids of synthetic datasets
+NAMESPACE = uuid.UUID("2a1c1b5e-8a3d-4d6e-9f0b-6c1d2e3f4a5b")
+
+PERCENTILES = (50, 90, 99)
+
+
+def dataset_doc(n: int, processed: str = "2020-01-02T00:00:00Z") -> dict:
+    return {
+        "$schema": "https://schemas.opendatacube.org/dataset",
+        "id": str(uuid.uuid5(NAMESPACE, str(n))),
+        "product": {"name": PRODUCT_NAME},
+        "crs": "epsg:32755",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[0, 0], [0, 100], [100, 100], [100, 0], [0, 0]]],
+        },
+        "grids": {
+            "default": {
+                "shape": [10, 10],
+                "transform": [10, 0, 0, 0, -10, 100, 0, 0, 1],
+            }
+        },
+        "properties": {
+            "datetime": "2020-01-01T00:00:00Z",
+            "odc:processing_datetime": processed,
+            "odc:region_code": f"{n % 1000:03d}",
+        },
+        "measurements": {"band": {"path": "band.tif"}},
+        "lineage": {},
+    }
+
+
+def dataset_uri(n: int) -> str:
+    return f"s3://benchmark-writes/{n}/dataset.yaml"
+
+
+class Datasets:
+    """Builds synthetic datasets, numbering new ones after any already added"""
+
+    def __init__(self, dc: Datacube, start: int):
+        self.doc2ds = Doc2Dataset(dc.index, products=[PRODUCT_NAME])
+        self.next = start
+
+    def make(self, n: int, processed: str = "2020-01-02T00:00:00Z"):
+        ds, err = self.doc2ds(dataset_doc(n, processed), dataset_uri(n))
+        if ds is None:
+            raise click.ClickException(f"Failed to build dataset: {err}")
+        return ds
+
+    def numbers(self, count: int) -> List[int]:
+        """Numbers of `count` datasets that were never added"""
+        numbers = list(range(self.next, self.next + count))
+        self.next += count
+        return numbers
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered), math.ceil(q / 100 * len(ordered))) - 1)
+    return ordered[rank]
+
+
+def timed(func: Callable[[list], None], batches: List[list]) -> List[float]:
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        func(batch)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def fill(dc: Datacube, datasets: Datasets, size: int):
+    """Add datasets until the product holds at least `size` of them"""
+    count = dc.index.datasets.count(product=PRODUCT_NAME)
+    while count < size:
+        for n in datasets.numbers(min(1000, size - count)):
+            dc.index.datasets.add(datasets.make(n))
+            count += 1
+        click.echo(f"  {count}/{size} datasets", err=True)
+
+
+def benchmark(
+    dc: Datacube, datasets: Datasets, batch_size: int, repeat: int
+) -> Dict[str, List[float]]:
+    """Latencies of each operation for `repeat` batches of `batch_size`"""
+    numbers = [datasets.numbers(batch_size) for _ in range(repeat)]
+    batches = [[datasets.make(n) for n in batch] for batch in numbers]
+    # The same datasets with a different processing time
+    changed = [
+        [datasets.make(n, processed="2021-01-01T00:00:00Z") for n in batch]
+        for batch in numbers
+    ]
+    index = dc.index.datasets
+    results = {}
+
+    results["add"] = timed(lambda b: [index.add(ds) for ds in b], batches)
+    # What the indexers do for datasets that are already present
+    results["add-if-absent"] = timed(
+        lambda b: [add_datasets_if_absent(dc, [ds]) for ds in b], batches
+    )
+    # What --update does without --allow-unsafe, here with unchanged documents
+    results["update"] = timed(
+        lambda b: [index.update(ds, updates_allowed={}) for ds in b], batches
+    )
+    results["bulk-unchanged"] = timed(lambda b: bulk_unchanged(dc, b), batches)
+    results["update-allow-any"] = timed(
+        lambda b: [
+            index.update(ds, updates_allowed={tuple(): changes.allow_any}) for ds in b
+        ],
+        changed,
+    )
+
+    results["get"] = timed(lambda b: [index.get(ds.id) for ds in b], batches)
+    results["bulk-has"] = timed(lambda b: index.bulk_has([ds.id for ds in b]), batches)
+    results["location-get"] = timed(
+        lambda b: [index.get_datasets_for_location(ds.uris[0]) for ds in b], batches
+    )
+    results["location-bulk"] = timed(
+        lambda b: bulk_has_location(dc, [ds.uris[0] for ds in b]), batches
+    )
+
+    results["archive"] = timed(lambda b: index.archive([ds.id for ds in b]), batches)
+    for batch in batches:
+        index.restore([ds.id for ds in batch])
+
+    return results
+
+
+def cleanup(dc: Datacube):
+    """Delete every dataset of the benchmark product"""
+    product = dc.index.products.get_by_name(PRODUCT_NAME)
+    if product is None:
+        return
+    with _engine(dc).begin() as connection:
+        for statement in (
+            "DELETE FROM agdc.dataset_location WHERE dataset_ref IN "
+            "(SELECT id FROM agdc.dataset WHERE dataset_type_ref = %(product)s)",
+            "DELETE FROM agdc.dataset_source WHERE dataset_ref IN "
+            "(SELECT id FROM agdc.dataset WHERE dataset_type_ref = %(product)s)",
+            "DELETE FROM agdc.dataset WHERE dataset_type_ref = %(product)s",
+        ):
+            connection.execute(statement, product=product.id)
+
+
+def _sizes(ctx, param, value) -> List[int]:
+    try:
+        return sorted(int(v) for v in value.split(","))
+    except ValueError:
+        raise click.BadParameter("Expected comma separated integers")
+
+
+@click.command("benchmark-db-writes")
+@click.option(
+    "--table-sizes",
+    default="1000,10000,100000",
+    callback=_sizes,
+    help="Comma separated numbers of datasets in the product to benchmark at.",
+)
+@click.option(
+    "--batch-sizes",
+    default="1,10,100",
+    callback=_sizes,
+    help="Comma separated numbers of datasets per timed batch.",
+)
+@click.option("--repeat", default=20, help="Timed batches per measurement.")
+@click.option(
+    "--csv",
+    "csv_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Also write the results to this CSV file.",
+)
+@click.option(
+    "--cleanup",
+    "cleanup_after",
+    is_flag=True,
+    default=False,
+    help="Delete the benchmark datasets once done.",
+)
+def cli(table_sizes, batch_sizes, repeat, csv_path, cleanup_after):
+    dc = Datacube(app="benchmark-db-writes")
+    if dc.index.products.get_by_name(PRODUCT_NAME) is None:
+        dc.index.products.add_document(PRODUCT)
+    datasets = Datasets(dc, dc.index.datasets.count(product=PRODUCT_NAME))
+
+    columns = ["table_size", "batch_size", "operation"]
+    columns += [f"p{q}_ms" for q in PERCENTILES] + ["datasets_per_s"]
+    rows = []
+    click.echo("".join(f"{c:>16}" for c in columns))
+    for table_size in table_sizes:
+        fill(dc, datasets, table_size)
+        for batch_size in batch_sizes:
+            results = benchmark(dc, datasets, batch_size, repeat)
+            for operation, latencies in results.items():
+                row = [table_size, batch_size, operation]
+                row += [percentile(latencies, q) * 1000 for q in PERCENTILES]
+                row.append(batch_size / statistics.median(latencies))
+                rows.append(row)
+                click.echo(
+                    "".join(
+                        f"{v:>16.2f}" if isinstance(v, float) else f"{v:>16}"
+                        for v in row
+                    )
+                )
+
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+    if cleanup_after:
+        cleanup(dc)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Benchmark startup of the indexing tools: module import time, `--help`
+time and, given a queue and product, time to index the first SQS message
+"""
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+CLI_MODULES = {
+    "s3-to-dc": "odc_index.s3_to_dc",
+    "sqs-to-dc": "odc_index.sqs_to_dc",
+    "stac-to-dc": "odc_index.stac_api_to_dc",
+    "thredds-to-dc": "odc_index.thredds_to_dc",
+}
+
+
+def timed(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+@click.command("benchmark-startup")
+@click.option(
+    "--repeat", default=5, help="Runs per measurement, the median is reported."
+)
+@click.option(
+    "--queue",
+    default=None,
+    help="SQS queue to time indexing the first message from with sqs-to-dc.",
+)
+@click.option("--product", default=None, help="Product for the --queue benchmark.")
+def cli(repeat, queue, product):
+    print(f"{'tool':<16}{'import':>10}{'--help':>10}")
+    for tool, module in CLI_MODULES.items():
+        import_time = timed([sys.executable, "-c", f"import {module}"], repeat)
+        help_time = timed([sys.executable, "-m", module, "--help"], repeat)
+        print(f"{tool:<16}{import_time:>9.3f}s{help_time:>9.3f}s")
+
+    if queue and product:
+        first_message = timed(
+            [
+                sys.executable,
+                "-m",
+                CLI_MODULES["sqs-to-dc"],
+                "--limit=1",
+                queue,
+                product,
+            ],
+            1,
+        )
+        print(f"sqs-to-dc first message: {first_message:.3f}s")
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,10 +1,9 @@
 """Functions used by s3_to_dc application
-"""
-import itertools
 
-from odc.index import from_yaml_doc_stream
-from datacube import Datacube
-import yaml
+Submodules are the entry points of short lived command line tools, so
+nothing heavy is imported here; datacube and friends are imported where
+they are first used.
+"""
 
 
 def bulk_has_location(loc_list: list, product: str) -> list:
@@ -33,6 +32,8 @@ def bulk_has_uuid(loc_list: list, product: str) -> list:
     Returns:
         list -- List of booleans with location check results
     """
+    from datacube import Datacube
+
     uuid_list = _get_uuid_s3(loc_list)
     with Datacube() as dc:
         has_result = dc.index.datasets.bulk_has(uuid_list)
@@ -0,0 +1,201 @@
+"""Local on-disk cache of fetched metadata documents
+
+Documents are keyed by URL together with the ETag/Last-Modified validators
+returned when they were fetched, so repeat runs can revalidate them with
+conditional requests instead of downloading them again. Bodies are stored
+zlib compressed and content addressed, so identical documents published
+under several URLs are only stored once.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import NamedTuple, Optional
+
+# Default cache size limit in bytes of compressed bodies
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Fraction of the size limit to evict down to once it is exceeded
+_EVICT_TARGET = 0.9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    digest TEXT NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_accessed ON documents (accessed);
+CREATE INDEX IF NOT EXISTS documents_digest ON documents (digest);
+CREATE TABLE IF NOT EXISTS bodies (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+
+class CachedDocument(NamedTuple):
+    """Validators and content digest recorded for a cached URL"""
+
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+
+
+class DocumentCache:
+    """SQLite backed LRU cache of document bodies keyed by URL
+
+    Arguments:
+        path {str} -- Directory to keep the cache database in
+        max_size {int} -- Maximum total size in bytes of compressed bodies
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, "documents.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._total = self._size()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def lookup(self, url: str) -> Optional[CachedDocument]:
+        """Return the validators recorded for a URL, if it is cached"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, digest FROM documents WHERE url = ?",
+                (url,),
+            ).fetchone()
+        return CachedDocument(*row) if row else None
+
+    def conditional_headers(self, url: str) -> dict:
+        """HTTP headers to revalidate a cached URL with a conditional GET"""
+        entry = self.lookup(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def revalidated(self, url: str) -> Optional[bytes]:
+        """Return the cached body for a URL the server reported as not modified
+
+        Returns None if the entry was evicted in the meantime, in which case
+        the caller has to fetch the document again unconditionally.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT b.data FROM documents d JOIN bodies b ON b.digest = d.digest "
+                "WHERE d.url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE documents SET accessed = ? WHERE url = ?", (time.time(), url)
+            )
+            self.hits += 1
+        return zlib.decompress(row[0])
+
+    def store(
+        self,
+        url: str,
+        body: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        """Record a freshly fetched body and its validators for a URL
+
+        Bodies without any validator are not cached as they could never be
+        revalidated.
+        """
+        self.misses += 1
+        if not etag and not last_modified:
+            return
+
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                if not self._db.execute(
+                    "SELECT 1 FROM bodies WHERE digest = ?", (digest,)
+                ).fetchone():
+                    data = zlib.compress(body)
+                    self._db.execute(
+                        "INSERT INTO bodies (digest, size, data) VALUES (?, ?, ?)",
+                        (digest, len(data), data),
+                    )
+                    self._total += len(data)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO documents "
+                    "(url, etag, last_modified, digest, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (url, etag, last_modified, digest, time.time()),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._evict()
+
+    def size(self) -> int:
+        """Total size in bytes of the compressed bodies held in the cache"""
+        return self._total
+
+    def _size(self) -> int:
+        (size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies"
+        ).fetchone()
+        return size
+
+    def _evict(self):
+        # Drop least recently used URLs until the bodies they referenced
+        # bring the cache back under the target size
+        if self._total <= self.max_size:
+            return
+        target = self.max_size * _EVICT_TARGET
+        while True:
+            excess = self._total - target
+            if excess <= 0:
+                break
+            urls = []
+            for url, size in self._db.execute(
+                "SELECT d.url, b.size FROM documents d "
+                "JOIN bodies b ON b.digest = d.digest ORDER BY d.accessed"
+            ):
+                urls.append((url,))
+                excess -= size
+                if excess <= 0:
+                    break
+            if not urls:
+                break
+            self._db.execute("BEGIN")
+            self._db.executemany("DELETE FROM documents WHERE url = ?", urls)
+            self._db.execute(
+                "DELETE FROM bodies WHERE digest NOT IN (SELECT digest FROM documents)"
+            )
+            self._db.execute("COMMIT")
+            self._total = self._size()
@@ -0,0 +1,97 @@
+"""Coalescing of SQS messages about the same dataset
+
+Messages received within a short window are grouped by the dataset they
+are about. Only the most recently sent message of each group is handled,
+the others are superseded by it and acknowledged together once it has
+been, so redelivered and quickly overtaken messages cost no extra writes.
+"""
+import math
+import time
+from typing import Callable, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# Most messages held in one window, whatever its length
+DEFAULT_MAX_MESSAGES = 100
+
+
+def sent_time(message) -> int:
+    """When a message was sent, in milliseconds since the epoch, or 0 if SQS
+    did not say
+    """
+    attributes = getattr(message, "attributes", None) or {}
+    try:
+        return int(attributes.get("SentTimestamp", 0))
+    except ValueError:
+        return 0
+
+
+def coalesce(
+    messages: List, key: Callable[[object], Optional[Hashable]]
+) -> List[Tuple[object, List]]:
+    """The final message about each dataset with the messages it supersedes
+
+    Arguments:
+        messages {list} -- Messages in the order they were received
+        key {Callable} -- Returns the dataset a message is about, or None
+            for messages that can't be coalesced
+
+    Returns:
+        list -- (final message, superseded messages), in the order the final
+            messages were received
+    """
+    groups = {}
+    for n, message in enumerate(messages):
+        k = key(message)
+        groups.setdefault(n if k is None else ("key", k), []).append((n, message))
+
+    finals = []
+    for group in groups.values():
+        # The latest sent wins, ties go to the latest received
+        ordered = sorted(group, key=lambda item: (sent_time(item[1]), item[0]))
+        n, final = ordered[-1]
+        finals.append((n, final, [message for _, message in ordered[:-1]]))
+    finals.sort(key=lambda item: item[0])
+    return [(final, superseded) for _, final, superseded in finals]
+
+
+class CoalescingWindow:
+    """Groups the messages of consecutive polls until `window` seconds have
+    passed since the first of them arrived, or `max_messages` are held
+
+    Arguments:
+        window {float} -- Seconds to hold messages for
+        max_messages {int} -- Most messages held at once
+    """
+
+    def __init__(self, window: float, max_messages: int = DEFAULT_MAX_MESSAGES):
+        self.window = window
+        self.max_messages = max_messages
+        self._opened: Optional[float] = None
+
+    def wait_time(self) -> Optional[int]:
+        """Longest a poll should wait so as not to hold messages past the
+        window, at least a second so that polls stay long polls, or None
+        while no messages are held
+        """
+        if self._opened is None:
+            return None
+        remaining = self.window - (time.monotonic() - self._opened)
+        return max(1, math.ceil(remaining))
+
+    def groups(self, batches: Iterable[list]) -> Iterator[list]:
+        """Merge batches of messages into one list per window. Empty batches
+        let a window close while the queue is quiet
+        """
+        pending = []
+        for batch in batches:
+            if batch and self._opened is None:
+                self._opened = time.monotonic()
+            pending.extend(batch)
+            if pending and (
+                len(pending) >= self.max_messages
+                or time.monotonic() - self._opened >= self.window
+            ):
+                yield pending
+                pending, self._opened = [], None
+        if pending:
+            self._opened = None
+            yield pending
@@ -0,0 +1,104 @@
+"""Read gzip and zstd compressed metadata documents transparently
+
+Compression is detected from the Content-Encoding of a response, the
+extension of the URL or the leading magic bytes of the body, and bodies
+are decompressed while they are read from the network rather than from a
+full compressed copy in memory.
+"""
+import gzip
+from typing import BinaryIO, Optional
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+SUFFIXES = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+
+ENCODINGS = {"gzip": "gzip", "x-gzip": "gzip", "zstd": "zstd"}
+
+
+def compression_of(
+    url: str = "", content_encoding: Optional[str] = None, head: bytes = b""
+) -> Optional[str]:
+    """Compression of a document, "gzip", "zstd" or None, going by its
+    Content-Encoding, its URL or the first bytes of its body
+    """
+    if content_encoding:
+        codec = ENCODINGS.get(content_encoding.strip().lower())
+        if codec:
+            return codec
+    for suffix, codec in SUFFIXES.items():
+        if url.endswith(suffix):
+            return codec
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def uncompressed_name(url: str) -> str:
+    """URL without any compression extension, e.g. to choose a parser"""
+    for suffix in SUFFIXES:
+        if url.endswith(suffix):
+            return url[: -len(suffix)]
+    return url
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "Reading zstd compressed documents requires the zstandard package"
+        )
+    return zstandard
+
+
+class _Prefixed:
+    """Readable stream of bytes already read from `stream`, then the rest"""
+
+    def __init__(self, head: bytes, stream: BinaryIO):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.head:
+            return self.stream.read(size) if size >= 0 else self.stream.read()
+        if size < 0:
+            head, self.head = self.head, b""
+            return head + self.stream.read()
+        head, self.head = self.head[:size], self.head[size:]
+        return head
+
+
+def read_body(
+    stream: BinaryIO, url: str = "", content_encoding: Optional[str] = None
+) -> bytes:
+    """Read a whole document from a file-like object such as a boto3
+    StreamingBody, decompressing it on the fly if it is compressed
+    """
+    codec = compression_of(url, content_encoding)
+    if codec is None:
+        head = stream.read(len(ZSTD_MAGIC))
+        codec = compression_of(head=head)
+        stream = _Prefixed(head, stream)
+        if codec is None:
+            return stream.read()
+
+    if codec == "gzip":
+        with gzip.GzipFile(fileobj=stream) as f:
+            return f.read()
+    with _zstd().ZstdDecompressor().stream_reader(stream) as f:
+        return f.read()
+
+
+def decompress(
+    body: bytes, url: str = "", content_encoding: Optional[str] = None
+) -> bytes:
+    """Decompress a document that was read whole, if it is compressed"""
+    codec = compression_of(url, content_encoding, body[: len(ZSTD_MAGIC)])
+    if codec == "gzip" and body.startswith(GZIP_MAGIC):
+        return gzip.decompress(body)
+    if codec == "zstd" and body.startswith(ZSTD_MAGIC):
+        return _zstd().ZstdDecompressor().decompressobj().decompress(body)
+    return body
@@ -0,0 +1,186 @@
+"""Adaptive control of database write batch size and concurrency
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_BATCH_SIZE = 100
+
+# Longest pause between batches while the database is overloaded, in seconds
+MAX_DELAY = 30.0
+
+
+def is_overload(error: Optional[Exception]) -> bool:
+    """True for errors that indicate the database is struggling, rather
+    than a problem with the dataset being written
+    """
+    from sqlalchemy.exc import OperationalError, TimeoutError
+
+    return isinstance(error, (OperationalError, TimeoutError))
+
+
+def is_fatal(error: Optional[Exception]) -> bool:
+    """True for database errors that no other dataset will get past either,
+    such as a missing table or permission, or an unusable connection
+    """
+    from sqlalchemy.exc import InterfaceError, ProgrammingError
+
+    return isinstance(error, (InterfaceError, ProgrammingError))
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease controller for DB writes
+
+    Each batch of writes is timed. While the mean commit latency stays under
+    `target_latency` and the share of overload errors under `max_error_rate`,
+    the batch size and number of concurrent writers grow additively. As soon
+    as either is exceeded they are halved and a growing pause is inserted
+    between batches. Without a `target_latency` batches and concurrency stay
+    fixed at their initial values.
+
+    Arguments:
+        batch_size {int} -- Initial number of datasets per batch
+        min_batch_size {int} -- Lower bound for the batch size
+        max_batch_size {int} -- Upper bound for the batch size
+        workers {int} -- Initial number of concurrent writers
+        max_workers {int} -- Upper bound for concurrent writers
+        target_latency {float} -- Target mean commit latency in seconds
+        max_error_rate {float} -- Highest tolerated share of overload errors
+    """
+
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        min_batch_size: int = 10,
+        max_batch_size: int = 1000,
+        workers: int = 1,
+        max_workers: int = 1,
+        target_latency: Optional[float] = None,
+        max_error_rate: float = 0.05,
+    ):
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size, min_batch_size)
+        self.batch_size = min(max(batch_size, min_batch_size), self.max_batch_size)
+        self.max_workers = max(max_workers, 1)
+        self.workers = min(max(workers, 1), self.max_workers)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.step = max(1, min_batch_size)
+        self.delay = 0.0
+
+    @property
+    def adaptive(self) -> bool:
+        return self.target_latency is not None
+
+    def batches(self, items: Iterable) -> Iterator[list]:
+        """Split items into lists of the current batch size, which is read
+        again for every batch
+        """
+        it = iter(items)
+        while True:
+            batch = list(islice(it, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def rounds(self, items: Iterable) -> Iterator[List[list]]:
+        """Split items into one batch of the current batch size for each
+        current writer, both read again for every round
+        """
+        it = iter(items)
+        while True:
+            batches = []
+            for _ in range(self.workers):
+                batch = list(islice(it, self.batch_size))
+                if not batch:
+                    break
+                batches.append(batch)
+            if not batches:
+                return
+            yield batches
+
+    def run_batches(
+        self, func: Callable[[list], Any], batches: List[list]
+    ) -> List[Tuple[Any, Optional[Exception]]]:
+        """Call func once per batch, such as to write it in one transaction,
+        timing each call. The items of a batch that failed other than by
+        overloading the database are retried one at a time, so that only
+        the items at fault fail
+
+        Returns:
+            list -- (item, exception or None) for each item, in order
+        """
+        results = []
+        for batch, error in self.run(func, batches):
+            if error is None:
+                results.extend((item, None) for item in batch)
+            elif is_overload(error) or len(batch) == 1:
+                results.extend((item, error) for item in batch)
+            else:
+                for item in batch:
+                    try:
+                        func([item])
+                        results.append((item, None))
+                    except Exception as e:
+                        results.append((item, e))
+        return results
+
+    def run(
+        self, func: Callable[[Any], Any], items: List
+    ) -> List[Tuple[Any, Optional[Exception]]]:
+        """Call func on each item with the current concurrency, record how
+        the batch went and pause if the database needs to recover
+
+        Returns:
+            list -- (item, exception or None) for each item, in order
+        """
+
+        def _timed(item):
+            start = time.monotonic()
+            try:
+                func(item)
+                error = None
+            except Exception as e:
+                error = e
+            return item, error, time.monotonic() - start
+
+        if self.workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(_timed, items))
+        else:
+            results = [_timed(item) for item in items]
+
+        self.record(
+            [latency for _, _, latency in results],
+            sum(1 for _, error, _ in results if is_overload(error)),
+        )
+        if self.delay:
+            time.sleep(self.delay)
+
+        return [(item, error) for item, error, _ in results]
+
+    def record(self, latencies: List[float], errors: int):
+        """Adjust batch size and concurrency from the commit latencies and
+        overload error count of one batch
+        """
+        if not self.adaptive or not latencies:
+            return
+
+        mean_latency = sum(latencies) / len(latencies)
+        error_rate = errors / len(latencies)
+
+        if mean_latency > self.target_latency or error_rate > self.max_error_rate:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.workers = max(1, self.workers // 2)
+            self.delay = min(MAX_DELAY, max(self.delay * 2, 0.1))
+            logging.warning(
+                f"Database struggling (latency {mean_latency:.3f}s, "
+                f"errors {error_rate:.1%}), backing off to batches of "
+                f"{self.batch_size} with {self.workers} worker(s)"
+            )
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.step)
+            self.workers = min(self.max_workers, self.workers + 1)
+            self.delay = self.delay / 2 if self.delay > 0.1 else 0.0
@@ -0,0 +1,96 @@
+"""Support for running indexers as long lived daemons: graceful
+shutdown on SIGTERM, periodic cache refreshes and a liveness/readiness
+HTTP endpoint
+"""
+import logging
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Hashable
+
+# Seconds without a heartbeat after which the daemon is reported dead
+DEFAULT_MAX_IDLE = 300
+
+
+class DaemonState:
+    """Shared state between the indexing loop, signal handlers and the
+    health endpoint
+
+    Arguments:
+        refresh_interval {float} -- Seconds between cache refreshes
+        max_idle {float} -- Seconds without a heartbeat before reporting dead
+    """
+
+    def __init__(self, refresh_interval: float = 600, max_idle=DEFAULT_MAX_IDLE):
+        self.refresh_interval = refresh_interval
+        self.max_idle = max_idle
+        self.stopping = threading.Event()
+        self.ready = False
+        self._last_beat = time.monotonic()
+        self._started = time.monotonic()
+        self._last_refresh = {}
+
+    def install_signal_handlers(self):
+        """Stop taking new work on SIGTERM or SIGINT, letting in-flight
+        work drain before exiting
+        """
+
+        def _stop(signum, frame):
+            logging.info(f"Received signal {signum}, draining in-flight work")
+            self.stopping.set()
+
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+
+    def beat(self):
+        """Record that the loop is making progress"""
+        self._last_beat = time.monotonic()
+
+    @property
+    def alive(self) -> bool:
+        return time.monotonic() - self._last_beat < self.max_idle
+
+    def refresh_due(self, key: Hashable = None) -> bool:
+        """True once every refresh_interval, resetting the timer. Loops
+        sharing the state, such as one per queue, each pass their own key
+        """
+        now = time.monotonic()
+        if now - self._last_refresh.get(key, self._started) >= self.refresh_interval:
+            self._last_refresh[key] = now
+            return True
+        return False
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_health(state: DaemonState, port: int, host: str = "") -> HTTPServer:
+    """Serve /healthz (liveness) and /readyz (readiness) from a background
+    thread, returning the server so it can be shut down
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/healthz":
+                ok = state.alive
+            elif self.path == "/readyz":
+                ok = state.ready and not state.stopping.is_set()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200 if ok else 503)
+            self.send_header("Content-Type", "text/plain")
+            self.end_headers()
+            self.wfile.write(b"ok\n" if ok else b"unavailable\n")
+
+        def log_message(self, format, *args):
+            # Keep probes out of the indexing logs
+            pass
+
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving health checks on port {server.server_address[1]}")
+    return server
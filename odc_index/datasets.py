@@ -0,0 +1,240 @@
+"""Turn streams of fetched metadata documents into datacube Datasets,
+keeping track of the URI and processing stage of every failure
+"""
+import json
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, Tuple
+from uuid import UUID
+
+from odc_index.compression import decompress, uncompressed_name
+
+if TYPE_CHECKING:
+    from datacube.index import Index
+    from datacube.model import Dataset
+
+    from odc_index.replica import ReadRouter
+
+# Fields a trusted EO3 document must still have, as paths into the document
+TRUSTED_REQUIRED_FIELDS = (
+    ("id",),
+    ("product", "name"),
+    ("crs",),
+    ("properties", "datetime"),
+    ("measurements",),
+)
+
+# Checks Doc2Dataset makes that trusted documents skip
+TRUSTED_SKIPPED_CHECKS = (
+    "product signature matching",
+    "lineage lookup in the database",
+    "lineage verification",
+)
+
+
+def parse_document(uri: str, data: bytes) -> dict:
+    """Parse a JSON or YAML metadata document, which may be gzip or zstd
+    compressed, using the URI's extension to pick the faster JSON parser
+    where possible
+    """
+    data = decompress(data, uri)
+    if uncompressed_name(uri).endswith(".json"):
+        return json.loads(data)
+
+    from datacube.utils import documents
+
+    return documents.parse_yaml(data)
+
+
+def _missing_fields(doc: dict) -> list:
+    missing = []
+    for path in TRUSTED_REQUIRED_FIELDS:
+        value = doc
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if not value:
+            missing.append(".".join(path))
+    return missing
+
+
+class TrustedDoc2Dataset:
+    """Doc2Dataset for EO3 documents from producers that already validated
+    them, which takes the product from the document by name and drops its
+    lineage instead of matching signatures and resolving sources
+
+    Only the fields in TRUSTED_REQUIRED_FIELDS, a valid id and the dataset
+    measurements covering the product's are still checked.
+
+    Arguments:
+        index -- Datacube index to look up products in
+        products {list} -- Product names documents may name, all if None
+    """
+
+    def __init__(self, index: "Index", products: list = None):
+        if products:
+            found = {name: index.products.get_by_name(name) for name in products}
+            missing = [name for name, product in found.items() if product is None]
+            if missing:
+                raise ValueError(
+                    f"Supplied product names {missing} not present in the database"
+                )
+        else:
+            found = {product.name: product for product in index.products.get_all()}
+        self.products = found
+
+    def __call__(self, doc: dict, uri: str) -> Tuple[Optional["Dataset"], object]:
+        from datacube.index.eo3 import prep_eo3
+        from datacube.index.hl import check_dataset_consistent
+        from datacube.model import Dataset
+
+        missing = _missing_fields(doc)
+        if missing:
+            return None, f"Missing required fields: {', '.join(missing)}"
+        try:
+            UUID(str(doc["id"]))
+        except ValueError:
+            return None, f"Invalid dataset id {doc['id']}"
+        product = self.products.get(doc["product"]["name"])
+        if product is None:
+            return None, f"Product {doc['product']['name']} is not a candidate product"
+
+        doc = prep_eo3({k: v for k, v in doc.items() if k != "lineage"})
+        dataset = Dataset(product, doc, uris=[uri], sources={})
+        ok, reason = check_dataset_consistent(dataset)
+        if not ok:
+            return None, reason
+        return dataset, None
+
+
+class RoutedDoc2Dataset:
+    """Resolves documents with the products and lineage of the replica of
+    `reads` while it is up to date, and of the primary otherwise
+
+    Arguments:
+        reads {ReadRouter} -- Router with a replica
+        make {Callable} -- Makes a Doc2Dataset for an index
+        index -- Primary index, only loaded from on the first fallback
+    """
+
+    def __init__(self, reads: "ReadRouter", make: Callable, index: "Index"):
+        self.reads = reads
+        self._make = make
+        self._index = index
+        self._replica = make(reads.replica.index)
+        self._primary = None
+        self._lock = threading.Lock()
+
+    def __call__(self, doc: dict, uri: str):
+        if self.reads.replica_ok():
+            return self._replica(doc, uri)
+        with self._lock:
+            if self._primary is None:
+                self._primary = self._make(self._index)
+        return self._primary(doc, uri)
+
+
+def make_doc2ds(
+    index: "Index",
+    products: list = None,
+    trusted: bool = False,
+    reads: "ReadRouter" = None,
+    **kwargs,
+):
+    """Doc2Dataset, or TrustedDoc2Dataset if `trusted`, in which case the
+    lineage options in `kwargs` do not apply. With a replica in `reads`,
+    products and lineage are looked up on it rather than on `index`
+    """
+    if trusted:
+        logging.info(
+            "Trusted mode skips %s, and only checks for %s",
+            ", ".join(TRUSTED_SKIPPED_CHECKS),
+            ", ".join(".".join(path) for path in TRUSTED_REQUIRED_FIELDS),
+        )
+
+    def _make(index: "Index"):
+        if trusted:
+            return TrustedDoc2Dataset(index, products)
+
+        from datacube.index.hl import Doc2Dataset
+
+        return Doc2Dataset(index, products=products, **kwargs)
+
+    if reads is not None and reads.replica is not None:
+        return RoutedDoc2Dataset(reads, _make, index)
+    return _make(index)
+
+
+def doc_stream_to_datasets(
+    doc_stream: Iterable[Tuple[str, bytes]],
+    index: "Index",
+    products: list = None,
+    transform: Callable[[dict], dict] = None,
+    **kwargs,
+) -> Iterator[Tuple[str, Optional["Dataset"], Optional[str], Optional[str]]]:
+    """Equivalent of odc.index.from_yaml_doc_stream that keeps the URI with
+    every result
+
+    Arguments:
+        doc_stream -- Iterable of (uri, document body)
+        index -- Datacube index to resolve products and lineage with
+        products {list} -- Candidate product names
+        transform -- Optional transformation of parsed documents, e.g. STAC to EO3
+        kwargs -- Passed through to make_doc2ds, e.g. lineage options, trusted
+            or a ReadRouter as reads
+
+    Yields:
+        tuple -- (uri, dataset, error, stage) where on failure dataset is None
+        and stage is either 'parse' or 'dataset'
+    """
+    doc2ds = make_doc2ds(index, products=products, **kwargs)
+    for uri, data in doc_stream:
+        try:
+            metadata = parse_document(uri, data)
+            if transform is not None:
+                metadata = transform(metadata)
+        except Exception as e:
+            yield uri, None, f"Failed to parse {uri}: {e}", "parse"
+            continue
+
+        try:
+            ds, err = doc2ds(metadata, uri)
+        except ValueError as e:
+            ds, err = None, e
+        if ds is not None:
+            yield uri, ds, None, None
+        else:
+            yield uri, None, f"Error: {uri}, {err}", "dataset"
+
+
+class Doc2DatasetCache:
+    """Doc2Datasets of make_doc2ds shared between threads, one per list of
+    candidate products. They are only read once built, so threads indexing
+    the same products, such as the queues of a multi-queue sqs-to-dc, don't
+    each load the products and metadata types
+
+    Arguments:
+        index -- Datacube index, as for make_doc2ds
+        kwargs -- Passed through to make_doc2ds
+    """
+
+    def __init__(self, index: "Index", **kwargs):
+        self._index = index
+        self._kwargs = kwargs
+        self._built = {}
+        self._lock = threading.Lock()
+
+    def get(self, products: list = None, max_age: Optional[float] = None):
+        """Doc2Dataset for products, built again if built more than
+        max_age seconds ago
+        """
+        key = tuple(products or ())
+        with self._lock:
+            entry = self._built.get(key)
+            now = time.monotonic()
+            if entry is None or (max_age is not None and now - entry[0] >= max_age):
+                doc2ds = make_doc2ds(
+                    self._index, products=list(key) or None, **self._kwargs
+                )
+                entry = self._built[key] = (now, doc2ds)
+            return entry[1]
@@ -0,0 +1,583 @@
+"""Bulk SQL helpers for operations the datacube index API
+only offers one dataset at a time
+"""
+import json
+import logging
+from typing import TYPE_CHECKING, Iterable, List, NamedTuple, Optional, Set, Tuple
+from uuid import UUID
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+    from datacube.model import Dataset
+
+_SELECT_UNCHANGED = """
+SELECT d.id
+FROM json_to_recordset(CAST(:batch AS json))
+    AS i(id uuid, product integer, metadata jsonb, uris text[])
+JOIN agdc.dataset d ON d.id = i.id
+WHERE d.dataset_type_ref = i.product
+  AND d.metadata = i.metadata
+  AND NOT EXISTS (
+    SELECT 1 FROM unnest(i.uris) AS u(uri)
+    WHERE NOT EXISTS (
+      SELECT 1 FROM agdc.dataset_location l
+      WHERE l.dataset_ref = d.id
+        AND l.archived IS NULL
+        AND l.uri_scheme || ':' || l.uri_body = u.uri
+    )
+  )
+"""
+
+_SELECT_LOCATIONS = """
+SELECT l.uri_scheme || ':' || l.uri_body
+FROM unnest(CAST(:schemes AS text[]), CAST(:bodies AS text[])) AS u(scheme, body)
+JOIN agdc.dataset_location l ON l.uri_scheme = u.scheme AND l.uri_body = u.body
+JOIN agdc.dataset d ON d.id = l.dataset_ref
+WHERE l.archived IS NULL
+  AND d.archived IS NULL
+"""
+
+# Seconds a streaming replica is behind its primary. A replica that has
+# replayed everything it received is up to date however long ago that was,
+# and a database that is not a replica is never behind.
+_REPLICA_LAG = """
+SELECT CAST(
+  CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(
+      EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 'Infinity'
+    )
+  END AS double precision
+)
+"""
+
+# Adds datasets that are not indexed yet, with the sources and locations of
+# those that were added, in one statement. Concurrent adds of the same
+# dataset wait for each other and then leave it be, rather than failing.
+_ADD_IF_ABSENT = """
+WITH added AS (
+  INSERT INTO agdc.dataset (id, metadata_type_ref, dataset_type_ref, metadata)
+  SELECT i.id, t.metadata_type_ref, t.id, i.metadata
+  FROM json_to_recordset(CAST(:datasets AS json))
+    AS i(id uuid, product integer, metadata jsonb)
+  JOIN agdc.dataset_type t ON t.id = i.product
+  ON CONFLICT DO NOTHING
+  RETURNING id
+), sources AS (
+  INSERT INTO agdc.dataset_source (dataset_ref, classifier, source_dataset_ref)
+  SELECT s.dataset_ref, s.classifier, s.source_dataset_ref
+  FROM json_to_recordset(CAST(:sources AS json))
+    AS s(dataset_ref uuid, classifier text, source_dataset_ref uuid)
+  WHERE s.dataset_ref IN (SELECT id FROM added)
+  ON CONFLICT DO NOTHING
+), locations AS (
+  INSERT INTO agdc.dataset_location (dataset_ref, uri_scheme, uri_body)
+  SELECT l.dataset_ref, l.uri_scheme, l.uri_body
+  FROM json_to_recordset(CAST(:locations AS json))
+    AS l(dataset_ref uuid, uri_scheme text, uri_body text)
+  WHERE l.dataset_ref IN (SELECT id FROM added)
+  ON CONFLICT DO NOTHING
+)
+SELECT id FROM added
+"""
+
+# Adds the new location of every `moved` row and, unless keeping the old
+# ones, deletes the old row. Locations already present are left alone.
+_MOVE_LOCATIONS = """
+, added AS (
+  INSERT INTO agdc.dataset_location (dataset_ref, uri_scheme, uri_body)
+  SELECT dataset_ref, new_scheme, new_body FROM moved
+  ON CONFLICT DO NOTHING
+  RETURNING 1
+), removed AS (
+  DELETE FROM agdc.dataset_location
+  WHERE id IN (SELECT id FROM moved WHERE NOT :keep_old)
+  RETURNING 1
+)
+SELECT (SELECT max(id) FROM moved),
+       (SELECT count(*) FROM moved),
+       (SELECT count(*) FROM added),
+       (SELECT count(*) FROM removed)
+"""
+
+_RELOCATE_PREFIX = (
+    """
+WITH moved AS (
+  SELECT l.id, l.dataset_ref,
+         CAST(:new_scheme AS text) AS new_scheme,
+         :new_body || substr(l.uri_body, :old_length + 1) AS new_body
+  FROM agdc.dataset_location l
+  JOIN agdc.dataset d ON d.id = l.dataset_ref
+  WHERE l.id > :after
+    AND l.id <= :last
+    AND l.archived IS NULL
+    AND l.uri_scheme = :old_scheme
+    AND left(l.uri_body, :old_length) = :old_body
+    AND (cardinality(CAST(:products AS integer[])) = 0
+         OR d.dataset_type_ref = ANY(CAST(:products AS integer[])))
+  ORDER BY l.id
+  LIMIT :batch_size
+)"""
+    + _MOVE_LOCATIONS
+)
+
+_RELOCATE_PAIRS = (
+    """
+WITH moved AS (
+  SELECT l.id, l.dataset_ref, p.new_scheme, p.new_body
+  FROM unnest(
+    CAST(:old_schemes AS text[]), CAST(:old_bodies AS text[]),
+    CAST(:new_schemes AS text[]), CAST(:new_bodies AS text[])
+  ) AS p(old_scheme, old_body, new_scheme, new_body)
+  JOIN agdc.dataset_location l
+    ON l.uri_scheme = p.old_scheme AND l.uri_body = p.old_body
+  JOIN agdc.dataset d ON d.id = l.dataset_ref
+  WHERE l.archived IS NULL
+    AND (p.new_scheme, p.new_body) <> (p.old_scheme, p.old_body)
+    AND (cardinality(CAST(:products AS integer[])) = 0
+         OR d.dataset_type_ref = ANY(CAST(:products AS integer[])))
+)"""
+    + _MOVE_LOCATIONS
+)
+
+# Loading prepared datasets: rows are copied into a temporary table, one
+# JSON document per row, and inserted from there, leaving existing rows be
+_CREATE_PREPARED = """
+CREATE TEMPORARY TABLE prepared_datasets (doc jsonb) ON COMMIT DROP;
+CREATE TEMPORARY TABLE prepared_added (id uuid PRIMARY KEY) ON COMMIT DROP;
+"""
+
+# Raw lines, with quote and delimiter characters that never occur in JSON
+_COPY_PREPARED = """
+COPY prepared_datasets FROM STDIN
+WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+"""
+
+_INSERT_PREPARED = """
+WITH matched AS (
+  SELECT CAST(p.doc->>'id' AS uuid) AS id, t.id AS product,
+         t.metadata_type_ref, p.doc->'metadata' AS metadata
+  FROM prepared_datasets p
+  JOIN agdc.dataset_type t ON t.name = p.doc->>'product'
+), added AS (
+  INSERT INTO agdc.dataset (id, metadata_type_ref, dataset_type_ref, metadata)
+  SELECT id, metadata_type_ref, product, metadata FROM matched
+  ON CONFLICT DO NOTHING
+  RETURNING id
+), kept AS (
+  INSERT INTO prepared_added (id) SELECT id FROM added
+)
+SELECT (SELECT count(*) FROM prepared_datasets),
+       (SELECT count(*) FROM matched),
+       (SELECT count(*) FROM added)
+"""
+
+# Locations and sources are only added for the datasets the load added, like
+# add_datasets_if_absent, leaving those already indexed as they are
+_INSERT_PREPARED_LOCATIONS = """
+INSERT INTO agdc.dataset_location (dataset_ref, uri_scheme, uri_body)
+SELECT a.id, split_part(u.uri, ':', 1), substr(u.uri, strpos(u.uri, ':') + 1)
+FROM prepared_added a
+JOIN prepared_datasets p ON CAST(p.doc->>'id' AS uuid) = a.id
+CROSS JOIN jsonb_array_elements_text(p.doc->'uris') AS u(uri)
+ON CONFLICT DO NOTHING
+"""
+
+# Links sources that are indexed and counts those that are not
+_INSERT_PREPARED_SOURCES = """
+WITH sources AS (
+  SELECT DISTINCT a.id, s.classifier, CAST(s.source AS uuid) AS source
+  FROM prepared_added a
+  JOIN prepared_datasets p ON CAST(p.doc->>'id' AS uuid) = a.id
+  CROSS JOIN jsonb_each_text(p.doc->'sources') AS s(classifier, source)
+), linked AS (
+  INSERT INTO agdc.dataset_source (dataset_ref, classifier, source_dataset_ref)
+  SELECT s.id, s.classifier, s.source
+  FROM sources s
+  JOIN agdc.dataset src ON src.id = s.source
+  ON CONFLICT DO NOTHING
+)
+SELECT count(*) FROM sources s
+WHERE NOT EXISTS (SELECT 1 FROM agdc.dataset d WHERE d.id = s.source)
+"""
+
+
+class Relocated(NamedTuple):
+    """Location rows matched, added and removed by a relocation batch"""
+
+    matched: int
+    added: int
+    removed: int
+
+
+class Loaded(NamedTuple):
+    """Prepared rows read, matched to a product and added by a load batch,
+    and lineage sources of added datasets left out as they are not indexed
+    """
+
+    rows: int
+    matched: int
+    added: int
+    missing_sources: int
+
+
+def _engine(dc: "Datacube"):
+    return dc.index._db._engine
+
+
+def bulk_unchanged(dc: "Datacube", datasets: Iterable["Dataset"]) -> Set[UUID]:
+    """Find datasets whose stored metadata document and locations already
+    match the incoming ones, so updating them would be a no-op
+
+    The comparison is done in a single query with JSONB equality against the
+    stored documents, rather than fetching and diffing each dataset. If the
+    query fails no dataset is reported unchanged, so callers fall back to
+    the full update path.
+
+    Arguments:
+        dc {Datacube} -- Datacube to check against
+        datasets {Iterable[Dataset]} -- Incoming datasets
+
+    Returns:
+        Set[UUID] -- Ids of the datasets that are unchanged
+    """
+    from datacube.utils import jsonify_document
+    from sqlalchemy import text
+
+    batch = [
+        {
+            "id": str(ds.id),
+            "product": ds.type.id,
+            "metadata": jsonify_document(ds.metadata_doc_without_lineage()),
+            "uris": [uri for uri in ds.uris or [] if uri is not None],
+        }
+        for ds in datasets
+    ]
+    if not batch:
+        return set()
+
+    try:
+        with _engine(dc).connect() as connection:
+            rows = connection.execute(text(_SELECT_UNCHANGED), batch=json.dumps(batch))
+            return {UUID(str(row[0])) for row in rows}
+    except Exception as e:
+        logging.warning(f"Failed to check for unchanged datasets: {e}")
+        return set()
+
+
+def add_datasets_if_absent(dc: "Datacube", datasets: Iterable["Dataset"]) -> Set[UUID]:
+    """Add the datasets that are not indexed yet, along with any lineage
+    datasets they carry, in a single statement
+
+    Equivalent to dc.index.datasets.add for each dataset, except that
+    datasets already present, including ones added concurrently by another
+    indexer, are left as they are instead of being checked for first.
+
+    Arguments:
+        dc {Datacube} -- Datacube to add to
+        datasets {Iterable[Dataset]} -- Datasets to add
+
+    Returns:
+        Set[UUID] -- Ids of the given datasets that were added, the others
+        were already indexed
+    """
+    from datacube.model.utils import flatten_datasets
+    from datacube.utils import jsonify_document
+    from sqlalchemy import text
+
+    datasets = list(datasets)
+    rows, sources, locations = {}, [], []
+    for dataset in datasets:
+        for ds in [dss[0] for dss in flatten_datasets(dataset).values()]:
+            if ds.id in rows:
+                continue
+            rows[ds.id] = {
+                "id": str(ds.id),
+                "product": ds.type.id,
+                "metadata": jsonify_document(ds.metadata_doc_without_lineage()),
+            }
+            sources.extend(
+                {
+                    "dataset_ref": str(ds.id),
+                    "classifier": classifier,
+                    "source_dataset_ref": str(source.id),
+                }
+                for classifier, source in (ds.sources or {}).items()
+            )
+        for uri in dataset.uris or []:
+            if uri is not None:
+                scheme, body = _split_uri(uri)
+                locations.append(
+                    {
+                        "dataset_ref": str(dataset.id),
+                        "uri_scheme": scheme,
+                        "uri_body": body,
+                    }
+                )
+    if not rows:
+        return set()
+
+    with _engine(dc).begin() as connection:
+        added = connection.execute(
+            text(_ADD_IF_ABSENT),
+            datasets=json.dumps(list(rows.values())),
+            sources=json.dumps(sources),
+            locations=json.dumps(locations),
+        )
+        added = {UUID(str(row[0])) for row in added}
+    return {dataset.id for dataset in datasets if dataset.id in added}
+
+
+def update_datasets(
+    dc: "Datacube", datasets: Iterable["Dataset"], updates_allowed=None
+) -> None:
+    """Update datasets and add their new locations in a single transaction
+
+    Equivalent to dc.index.datasets.update for each dataset, except that
+    either all of them are written or, if any can't be, none are.
+
+    Arguments:
+        dc {Datacube} -- Datacube to update
+        datasets {Iterable[Dataset]} -- Datasets to update
+        updates_allowed {dict} -- Allowed changes, as for update
+
+    Raises:
+        ValueError: If a dataset is not indexed or has changes that are not
+        allowed
+    """
+    resource = dc.index.datasets
+    writes = []
+    for ds in datasets:
+        allowed, safe_changes, unsafe_changes = resource.can_update(ds, updates_allowed)
+        if not allowed:
+            offsets = ", ".join(str(offset) for offset, _, _ in unsafe_changes)
+            raise ValueError(f"Unsafe changes in {ds.id}: {offsets}")
+        existing = set(resource.get(ds.id).uris or [])
+        uris = [uri for uri in ds.uris or [] if uri and uri not in existing]
+        writes.append((ds, bool(safe_changes or unsafe_changes), uris))
+    if not writes:
+        return
+
+    with dc.index._db.begin() as transaction:
+        for ds, changed, uris in writes:
+            if changed and not transaction.update_dataset(
+                ds.metadata_doc_without_lineage(), ds.id, ds.type.id
+            ):
+                raise ValueError(f"Failed to update dataset {ds.id}")
+            # Reversed like datacube does, each location goes to the front
+            for uri in uris[::-1]:
+                transaction.insert_dataset_location(ds.id, uri)
+
+
+def bulk_has_location(dc: "Datacube", uris: List[str]) -> Set[str]:
+    """Find which of the given URIs are already a location of an active
+    dataset, with a single query using the dataset_location unique index
+
+    Arguments:
+        dc {Datacube} -- Datacube to check against
+        uris {List[str]} -- Dataset document URIs, e.g. s3://bucket/key.yaml
+
+    Returns:
+        Set[str] -- The URIs that are indexed
+    """
+    from sqlalchemy import text
+
+    schemes, bodies = [], []
+    for uri in uris:
+        scheme, _, body = uri.partition(":")
+        schemes.append(scheme)
+        bodies.append(body)
+    if not schemes:
+        return set()
+
+    with _engine(dc).connect() as connection:
+        rows = connection.execute(
+            text(_SELECT_LOCATIONS), schemes=schemes, bodies=bodies
+        )
+        return {row[0] for row in rows}
+
+
+def replica_lag(dc: "Datacube") -> float:
+    """Seconds of replication lag of the database behind `dc`, 0 if it is
+    not a replica
+    """
+    from sqlalchemy import text
+
+    with _engine(dc).connect() as connection:
+        return float(connection.execute(text(_REPLICA_LAG)).scalar())
+
+
+def _split_uri(uri: str) -> Tuple[str, str]:
+    # The scheme and body columns of agdc.dataset_location
+    scheme, _, body = uri.partition(":")
+    return scheme, body
+
+
+def _move(connection, statement, dry_run: bool, **params):
+    from sqlalchemy import text
+
+    transaction = connection.begin()
+    try:
+        row = connection.execute(text(statement), **params).fetchone()
+    except Exception:
+        transaction.rollback()
+        raise
+    if dry_run:
+        transaction.rollback()
+    else:
+        transaction.commit()
+    return row
+
+
+def relocate_prefix(
+    dc: "Datacube",
+    old_prefix: str,
+    new_prefix: str,
+    products: Optional[List[int]] = None,
+    keep_old: bool = False,
+    batch_size: int = 10000,
+    dry_run: bool = False,
+) -> Iterable[Relocated]:
+    """Rewrite the active locations starting with `old_prefix` to start
+    with `new_prefix` instead, entirely in SQL, without reading or
+    validating any dataset document
+
+    Each batch of `batch_size` locations is moved in its own transaction,
+    walking the dataset_location primary key. Locations added after the
+    relocation started, including its own, are not considered.
+
+    Arguments:
+        dc {Datacube} -- Datacube to relocate datasets in
+        old_prefix {str} -- e.g. s3://old-bucket/collection/
+        new_prefix {str} -- e.g. s3://new-bucket/collection/
+        products {List[int]} -- Only relocate datasets of these product ids
+        keep_old {bool} -- Add the new locations without removing the old ones
+        batch_size {int} -- Locations per transaction
+        dry_run {bool} -- Roll back every transaction
+
+    Yields:
+        Relocated -- Counts of every batch
+    """
+    from sqlalchemy import text
+
+    old_scheme, old_body = _split_uri(old_prefix)
+    new_scheme, new_body = _split_uri(new_prefix)
+    with _engine(dc).connect() as connection:
+        last = connection.execute(
+            text("SELECT max(id) FROM agdc.dataset_location")
+        ).scalar()
+        after = 0
+        while last is not None:
+            row = _move(
+                connection,
+                _RELOCATE_PREFIX,
+                dry_run,
+                after=after,
+                last=last,
+                old_scheme=old_scheme,
+                old_body=old_body,
+                old_length=len(old_body),
+                new_scheme=new_scheme,
+                new_body=new_body,
+                products=products or [],
+                keep_old=keep_old,
+                batch_size=batch_size,
+            )
+            if row[0] is None:
+                return
+            after = row[0]
+            yield Relocated(*row[1:])
+
+
+def relocate_locations(
+    dc: "Datacube",
+    pairs: List[Tuple[str, str]],
+    products: Optional[List[int]] = None,
+    keep_old: bool = False,
+    dry_run: bool = False,
+) -> Relocated:
+    """Move the datasets located at the old URI of each (old, new) pair to
+    the new URI, in a single transaction
+
+    Arguments:
+        dc {Datacube} -- Datacube to relocate datasets in
+        pairs {List[Tuple[str, str]]} -- Old and new URIs of each document
+        products {List[int]} -- Only relocate datasets of these product ids
+        keep_old {bool} -- Add the new locations without removing the old ones
+        dry_run {bool} -- Roll back the transaction
+
+    Returns:
+        Relocated -- Counts of locations matched, added and removed
+    """
+    if not pairs:
+        return Relocated(0, 0, 0)
+    old = [_split_uri(o) for o, _ in pairs]
+    new = [_split_uri(n) for _, n in pairs]
+    with _engine(dc).connect() as connection:
+        row = _move(
+            connection,
+            _RELOCATE_PAIRS,
+            dry_run,
+            old_schemes=[scheme for scheme, _ in old],
+            old_bodies=[body for _, body in old],
+            new_schemes=[scheme for scheme, _ in new],
+            new_bodies=[body for _, body in new],
+            products=products or [],
+            keep_old=keep_old,
+        )
+    return Relocated(*row[1:])
+
+
+class _LineReader:
+    """File-like object over lines, for COPY FROM STDIN"""
+
+    def __init__(self, lines: Iterable[bytes]):
+        self._lines = iter(lines)
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line + b"\n"
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def load_prepared(dc: "Datacube", lines: Iterable[bytes]) -> Loaded:
+    """Add the datasets of prepared file lines, with their locations and
+    links to sources already in the index, in a single transaction
+
+    Rows are streamed to the database with COPY. Datasets that already
+    exist are left as they are, without adding their locations or sources,
+    so loading the same file twice is harmless.
+
+    Arguments:
+        dc {Datacube} -- Datacube to load into
+        lines {Iterable[bytes]} -- JSON lines as written by prepare_datasets
+
+    Returns:
+        Loaded -- Counts of rows read, matched to a product and added, and
+        of sources that could not be linked
+    """
+    connection = _engine(dc).raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(_CREATE_PREPARED)
+        cursor.copy_expert(_COPY_PREPARED, _LineReader(lines))
+        cursor.execute(_INSERT_PREPARED)
+        rows, matched, added = cursor.fetchone()
+        cursor.execute(_INSERT_PREPARED_LOCATIONS)
+        cursor.execute(_INSERT_PREPARED_SOURCES)
+        (missing_sources,) = cursor.fetchone()
+        connection.commit()
+        return Loaded(rows, matched, added, missing_sources)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
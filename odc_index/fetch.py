@@ -0,0 +1,189 @@
+"""Fetch metadata documents from S3 and HTTP(S), revalidating
+them against a local DocumentCache when one is provided
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import format_datetime
+from types import SimpleNamespace
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from odc_index.cache import DocumentCache
+from odc_index.compression import decompress, read_body
+from odc_index.ratelimit import S3RateLimiter, s3_client
+
+
+def split_s3_url(url: str) -> Tuple[str, str]:
+    """Split an s3://bucket/key URL into bucket and key"""
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def get_object(s3, bucket: str, key: str, limiter: S3RateLimiter = None, **kwargs):
+    """s3.get_object, going through a rate limiter if one is provided"""
+    if limiter is not None:
+        return limiter.call(s3.get_object, bucket, key, **kwargs)
+    return s3.get_object(Bucket=bucket, Key=key, **kwargs)
+
+
+def fetch_url(
+    url: str, cache: Optional[DocumentCache] = None, session=None, timeout=60
+) -> bytes:
+    """GET a document over HTTP(S), revalidating any cached copy with a
+    conditional request, and decompress it if it is compressed
+
+    Arguments:
+        url {str} -- URL of the document
+        cache {DocumentCache} -- Optional cache to revalidate against and populate
+        session -- Optional requests session to reuse connections
+
+    Returns:
+        bytes -- Body of the document
+    """
+    import requests
+
+    get = (session or requests).get
+    if cache is None:
+        # requests already undoes any Content-Encoding, which leaves .gz files
+        return decompress(get(url, timeout=timeout).content, url)
+
+    response = get(url, headers=cache.conditional_headers(url), timeout=timeout)
+    if response.status_code == 304:
+        body = cache.revalidated(url)
+        if body is not None:
+            return decompress(body, url)
+        response = get(url, timeout=timeout)
+
+    if response.ok:
+        cache.store(
+            url,
+            response.content,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+    return decompress(response.content, url)
+
+
+def fetch_s3(
+    bucket: str,
+    key: str,
+    cache: Optional[DocumentCache] = None,
+    s3=None,
+    limiter: Optional[S3RateLimiter] = None,
+    **kwargs,
+) -> bytes:
+    """GET an S3 object, revalidating any cached copy by its ETag, and
+    decompress it if it is compressed
+
+    Without a cache the object is decompressed as it is read. Cached
+    objects are kept compressed.
+
+    Arguments:
+        bucket {str} -- Bucket name
+        key {str} -- Object key
+        cache {DocumentCache} -- Optional cache to revalidate against and populate
+        s3 -- Optional boto3 S3 client
+        limiter {S3RateLimiter} -- Optional limiter of S3 request rates
+
+    Returns:
+        bytes -- Body of the object
+    """
+    from botocore.exceptions import ClientError
+
+    s3 = s3 or s3_client(limiter)
+    url = f"s3://{bucket}/{key}"
+    entry = cache.lookup(url) if cache is not None else None
+
+    if entry is not None and entry.etag:
+        try:
+            obj = get_object(s3, bucket, key, limiter, IfNoneMatch=entry.etag, **kwargs)
+        except ClientError as e:
+            if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") != 304:
+                raise
+            body = cache.revalidated(url)
+            if body is not None:
+                return decompress(body, url)
+            obj = get_object(s3, bucket, key, limiter, **kwargs)
+    else:
+        obj = get_object(s3, bucket, key, limiter, **kwargs)
+
+    if cache is None:
+        return read_body(obj["Body"], url, obj.get("ContentEncoding"))
+
+    body = obj["Body"].read()
+    last_modified = obj.get("LastModified")
+    cache.store(
+        url,
+        body,
+        etag=obj.get("ETag"),
+        last_modified=(
+            format_datetime(last_modified, usegmt=True) if last_modified else None
+        ),
+    )
+    return decompress(body, url, obj.get("ContentEncoding"))
+
+
+def _bounded_map(func: Callable, items: Iterable, workers: int) -> Iterator:
+    """Apply func to items on a thread pool, keeping at most `workers` * 2
+    calls in flight and yielding results as they complete
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+
+def fetch_s3_urls(
+    urls: Iterable[str],
+    cache: Optional[DocumentCache] = None,
+    nconcurrent=24,
+    limiter: Optional[S3RateLimiter] = None,
+) -> Iterator[SimpleNamespace]:
+    """Threaded equivalent of odc.aio.S3Fetcher that goes through a DocumentCache
+    and an S3RateLimiter, when provided
+
+    Yields objects with `url`, `data` and `error` attributes, `data` is None
+    and `error` set if the object could not be fetched.
+    """
+    s3 = s3_client(limiter)
+
+    def _fetch(url):
+        try:
+            return SimpleNamespace(
+                url=url,
+                data=fetch_s3(*split_s3_url(url), cache, s3, limiter),
+                error=None,
+            )
+        except Exception as e:
+            logging.error(f"Failed to fetch {url} with error: {e}")
+            return SimpleNamespace(url=url, data=None, error=e)
+
+    return _bounded_map(_fetch, urls, nconcurrent)
+
+
+def download_yamls(
+    yaml_urls: List[str], cache: Optional[DocumentCache] = None, workers=8
+) -> List[Tuple[Optional[bytes], str, Optional[str]]]:
+    """Equivalent of odc.thredds.download_yamls that goes through a DocumentCache
+
+    Returns:
+        list -- List of (content, url without scheme, error) tuples
+    """
+    import requests
+
+    session = requests.Session()
+
+    def _download(url):
+        target = url[len(urlparse(url).scheme + "://") :]
+        try:
+            return fetch_url(url, cache, session), target, None
+        except requests.RequestException as e:
+            return None, target, str(e)
+
+    return list(_bounded_map(_download, yaml_urls, workers))
@@ -0,0 +1,142 @@
+"""Watermarks for incremental harvesting of STAC collections
+
+A harvest state file maps each collection to the latest item `datetime` or
+`updated` time that has been indexed, so that the next run only asks for
+items newer than that, less a safety overlap for late arrivals.
+"""
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+WATERMARK_FIELDS = ("datetime", "updated")
+
+# Default hours subtracted from a watermark before querying, to pick up
+# items published late or with out of order timestamps
+DEFAULT_OVERLAP_HOURS = 24
+
+
+def parse_time(value: str) -> datetime:
+    """Parse an RFC 3339 timestamp as found in STAC items, with any number
+    of fractional second digits, taking naive times as UTC
+    """
+    from dateutil.parser import isoparse
+
+    parsed = isoparse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class HarvestState:
+    """Watermarks per collection and field, kept in a JSON file that is
+    replaced atomically on save
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.watermarks: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.watermarks = json.load(f)
+
+    @staticmethod
+    def _key(collection: Optional[str], field: str) -> str:
+        return f"{collection or '*'}/{field}"
+
+    def get(self, collection: Optional[str], field: str) -> Optional[datetime]:
+        value = self.watermarks.get(self._key(collection, field))
+        return parse_time(value) if value else None
+
+    def set(self, collection: Optional[str], field: str, value: datetime):
+        self.watermarks[self._key(collection, field)] = format_time(value)
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.watermarks, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class Watermark:
+    """Tracks the `field` time of items as they are harvested, and which of
+    them failed, to tell how far the watermark can safely advance
+
+    Arguments:
+        field {str} -- Item property to track, datetime or updated
+        previous {datetime} -- Watermark before this run, if any
+    """
+
+    def __init__(self, field: str, previous: Optional[datetime] = None):
+        self.field = field
+        self.previous = previous
+        self.latest: Optional[datetime] = None
+        self.earliest_failure: Optional[datetime] = None
+        self.untracked_failures = 0
+        self._times: Dict[str, datetime] = {}
+        # Items found by and yielded from the current search, and whether
+        # they came in ascending order of the field
+        self.found: Optional[int] = None
+        self.seen = 0
+        self.in_order = True
+
+    def since(self, overlap: timedelta) -> Optional[datetime]:
+        """Time to query from, None for a first full harvest"""
+        return self.previous - overlap if self.previous else None
+
+    def search(self, found: int):
+        """Start tracking the items of a search that found `found` of them"""
+        self.found, self.seen, self.in_order = found, 0, True
+
+    @property
+    def truncated(self) -> bool:
+        """True if the current search yielded fewer items than it found, as
+        when it hits the API's limit on results
+        """
+        return self.found is not None and self.seen < self.found
+
+    def track(
+        self, items: Iterable[Tuple[dict, str, bool]]
+    ) -> Iterator[Tuple[dict, str, bool]]:
+        """Pass (metadata, uri, relative) items through, noting their times"""
+        last = None
+        for metadata, uri, relative in items:
+            self.seen += 1
+            value = metadata.get("properties", {}).get(self.field)
+            if value:
+                time = parse_time(value)
+                if uri is not None:
+                    self._times[uri] = time
+                if last is not None and time < last:
+                    self.in_order = False
+                last = time
+                if self.latest is None or time > self.latest:
+                    self.latest = time
+            yield metadata, uri, relative
+
+    def failed(self, uri: Optional[str]):
+        time = self._times.get(uri)
+        if time is None:
+            self.untracked_failures += 1
+        elif self.earliest_failure is None or time < self.earliest_failure:
+            self.earliest_failure = time
+
+    def advanced(self) -> Optional[datetime]:
+        """New watermark: the latest item time, or just before the earliest
+        failure so it is retried, never moving backwards. A truncated search
+        may have left out items older than the latest, so it doesn't move
+        """
+        if self.untracked_failures or self.truncated:
+            return self.previous
+        candidate = self.latest
+        if self.earliest_failure is not None:
+            candidate = self.earliest_failure - timedelta(seconds=1)
+        if candidate is None:
+            return self.previous
+        if self.previous is not None and candidate < self.previous:
+            return self.previous
+        return candidate
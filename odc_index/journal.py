@@ -0,0 +1,194 @@
+"""Structured journal of indexing failures, so that a later run can replay
+just the documents or messages that failed instead of the whole source
+"""
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import IO, Iterator, List, NamedTuple, Optional
+
+STAGES = ("fetch", "parse", "dataset", "write", "message")
+
+
+class Failure(NamedTuple):
+    """One journal entry, together with the run it was recorded in"""
+
+    tool: str
+    params: dict
+    source: str
+    stage: str
+    error_class: str
+    error: str
+    dataset_id: Optional[str] = None
+    body: Optional[str] = None
+    attributes: Optional[dict] = None
+
+
+class FailureJournal:
+    """Append-only, newline delimited JSON journal of failures
+
+    Every run first writes a header line with the tool name and its command
+    line parameters, followed by one line per failure with the source (URL
+    or SQS message id), the stage it failed at and the error class. A
+    journal without a path records nothing, so callers need not check.
+
+    Arguments:
+        path {str} -- File to append to, or None to disable journalling
+        tool {str} -- Name of the command recording failures
+        params {dict} -- Command line parameters, needed to replay the run
+    """
+
+    def __init__(self, path: Optional[str], tool: str = "", params: dict = None):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file: Optional[IO] = None
+        self._parent: Optional["FailureJournal"] = None
+        # Header of the run the last line written belongs to, shared by parts
+        self._last_header = [None]
+        self._header = {
+            "type": "run",
+            "tool": tool,
+            "time": datetime.now(timezone.utc).isoformat(),
+            "params": params or {},
+        }
+        if path is not None:
+            self._file = open(path, "a", encoding="utf-8")
+            self._write(None)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def part(self, params: dict) -> "FailureJournal":
+        """Journal for one part of this run with some of its parameters
+        replaced, such as one queue of a multi-queue sqs-to-dc, writing to
+        the same file
+
+        Its header is written before its first failure and again whenever
+        failures of other parts were written in between, so each failure is
+        read back with the parameters needed to replay it.
+        """
+        journal = FailureJournal(None)
+        journal.path = self.path
+        journal._file = self._file
+        journal._lock = self._lock
+        journal._parent = self
+        journal._last_header = self._last_header
+        journal._header = dict(
+            self._header, params=dict(self._header["params"], **params)
+        )
+        return journal
+
+    def _write(self, entry: Optional[dict]):
+        with self._lock:
+            if self._last_header[0] is not self._header:
+                self._file.write(json.dumps(self._header, default=str) + "\n")
+                self._last_header[0] = self._header
+            if entry is not None:
+                self._file.write(json.dumps(entry, default=str) + "\n")
+            self._file.flush()
+
+    def record(
+        self,
+        source: str,
+        stage: str,
+        error,
+        dataset_id: Optional[str] = None,
+        body: Optional[str] = None,
+        attributes: Optional[dict] = None,
+    ):
+        """Record a failure of source at stage
+
+        Arguments:
+            source {str} -- URL of the document or id of the SQS message
+            stage {str} -- One of STAGES
+            error -- The exception raised, or an error message
+            body {str} -- Body of the SQS message, to replay it
+            attributes {dict} -- Message attributes of the SQS message, which
+                can change what is done with it
+        """
+        if not self.enabled:
+            return
+        entry = {
+            "type": "failure",
+            "source": source,
+            "stage": stage,
+            "error_class": type(error).__name__
+            if isinstance(error, BaseException)
+            else "Error",
+            "error": str(error),
+        }
+        if dataset_id is not None:
+            entry["dataset_id"] = str(dataset_id)
+        if body is not None:
+            entry["body"] = body
+        if attributes:
+            entry["attributes"] = attributes
+        self._write(entry)
+        self.count += 1
+
+    def close(self):
+        if self._parent is not None:
+            # The file belongs to the whole run, which counts every part
+            with self._lock:
+                self._parent.count += self.count
+            self._file = None
+            self.count = 0
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if self.count:
+                logging.info(f"Recorded {self.count} failures in {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_journal(path: str) -> Iterator[Failure]:
+    """Read failures back from a journal, each with the tool and parameters
+    of the run that recorded it. Later failures of the same source replace
+    earlier ones.
+    """
+    failures = {}
+    tool, params = "", {}
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.warning(f"Skipping malformed line {n} of {path}")
+                continue
+            if entry.get("type") == "run":
+                tool, params = entry.get("tool", ""), entry.get("params", {})
+            elif entry.get("type") == "failure":
+                failures.pop((tool, entry["source"]), None)
+                failures[(tool, entry["source"])] = Failure(
+                    tool,
+                    params,
+                    entry["source"],
+                    entry.get("stage", ""),
+                    entry.get("error_class", ""),
+                    entry.get("error", ""),
+                    entry.get("dataset_id"),
+                    entry.get("body"),
+                    entry.get("attributes"),
+                )
+    yield from failures.values()
+
+
+def group_runs(failures: List[Failure]) -> List[List[Failure]]:
+    """Group failures by the tool and parameters they were recorded with,
+    keeping the order runs first appear in
+    """
+    groups = {}
+    for failure in failures:
+        key = (failure.tool, json.dumps(failure.params, sort_keys=True, default=str))
+        groups.setdefault(key, []).append(failure)
+    return list(groups.values())
@@ -0,0 +1,237 @@
+"""List S3 objects matching a glob, restricted to one shard
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch, fnmatchcase
+from types import SimpleNamespace
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from odc_index.shard import Shard, in_shard
+
+_GLOB_CHARS = set("*?[")
+
+DEFAULT_LIST_PARALLELISM = 16
+
+# Levels below the fixed prefix listed with a delimiter before switching
+# to flat listings under a `**`
+DEFAULT_FANOUT_DEPTH = 3
+
+
+def _is_glob(part: str) -> bool:
+    return bool(_GLOB_CHARS & set(part))
+
+
+def split_glob(uri: str) -> Tuple[str, str, List[str]]:
+    """Split an s3://bucket/fixed/prefix/<glob> URI into its bucket, the
+    fixed prefix before the first glob component and the glob components
+
+    Returns:
+        tuple -- (bucket, prefix, [glob components])
+    """
+    parsed = urlparse(uri)
+    parts = parsed.path.lstrip("/").split("/")
+    for i, part in enumerate(parts):
+        if _is_glob(part):
+            break
+    else:
+        i = len(parts) - 1
+    prefix = "/".join(parts[:i]) + "/" if i else ""
+    return parsed.netloc, prefix, parts[i:]
+
+
+def list_level(bucket: str, prefix: str, s3=None) -> Tuple[List[str], List[str]]:
+    """Delimiter listing of one level under prefix
+
+    Returns:
+        tuple -- (common prefixes, keys) directly under prefix
+    """
+    import boto3
+
+    s3 = s3 or boto3.client("s3")
+    prefixes, keys = [], []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+        keys.extend(o["Key"] for o in page.get("Contents", []))
+    return prefixes, keys
+
+
+def s3_find_shard(
+    uri: str, shard: Optional[Shard], by: str = "key", s3=None
+) -> Iterator[SimpleNamespace]:
+    """Equivalent of s3_find_glob(uri, False) restricted to one shard
+
+    With `by="key"` every matching key is listed and kept if it hashes to
+    the shard. With `by="prefix"` the top level prefixes below the fixed part
+    of the glob are listed first, and only those hashing to the shard are
+    listed further, so each replica only lists its own part of the bucket.
+
+    Yields objects with a `url` attribute.
+    """
+    import boto3
+    from odc.aio import s3_find_glob
+
+    if shard is None or by == "key":
+        yield from (o for o in s3_find_glob(uri, False) if in_shard(o.url, shard))
+        return
+
+    s3 = s3 or boto3.client("s3")
+    bucket, prefix, pattern = split_glob(uri)
+    if len(pattern) < 2:
+        logging.warning(f"No prefix level to shard on in {uri}, sharding by key")
+        yield from s3_find_shard(uri, shard, "key")
+        return
+
+    first, rest = pattern[0], pattern[1:]
+    prefixes, keys = list_level(bucket, prefix, s3)
+
+    # Objects directly under the fixed prefix only match a recursive glob
+    if first == "**" and len(rest) == 1:
+        for key in keys:
+            name = key[len(prefix) :]
+            if fnmatch(name, rest[0]) and in_shard(name, shard):
+                yield SimpleNamespace(url=f"s3://{bucket}/{key}")
+
+    for sub in prefixes:
+        name = sub[len(prefix) :].rstrip("/")
+        if not in_shard(name, shard):
+            continue
+        if first == "**":
+            sub_pattern = pattern
+        elif fnmatch(name, first):
+            sub_pattern = rest
+        else:
+            continue
+
+        if any(_is_glob(p) for p in sub_pattern):
+            yield from s3_find_glob(
+                f"s3://{bucket}/{sub}" + "/".join(sub_pattern), False
+            )
+        else:
+            key = sub + "/".join(sub_pattern)
+            response = s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+            if any(o["Key"] == key for o in response.get("Contents", [])):
+                yield SimpleNamespace(url=f"s3://{bucket}/{key}")
+
+
+def match_parts(parts: List[str], pattern: List[str]) -> bool:
+    """Match path components against glob components, where `**` matches
+    any number of whole components, including none
+    """
+    if not pattern:
+        return not parts
+    if pattern[0] == "**":
+        return any(match_parts(parts[i:], pattern[1:]) for i in range(len(parts) + 1))
+    return (
+        bool(parts)
+        and fnmatchcase(parts[0], pattern[0])
+        and match_parts(parts[1:], pattern[1:])
+    )
+
+
+def could_match(parts: List[str], pattern: List[str]) -> bool:
+    """True if keys below the directory with components `parts` can match
+    the glob components `pattern`
+    """
+    if not parts:
+        return bool(pattern)
+    if not pattern:
+        return False
+    if pattern[0] == "**":
+        return True
+    return fnmatchcase(parts[0], pattern[0]) and could_match(parts[1:], pattern[1:])
+
+
+def s3_find_parallel(
+    uri: str,
+    parallelism: int = DEFAULT_LIST_PARALLELISM,
+    fanout_depth: int = DEFAULT_FANOUT_DEPTH,
+    shard: Optional[Shard] = None,
+    by: str = "key",
+    s3=None,
+) -> Iterator[SimpleNamespace]:
+    """Equivalent of s3_find_shard that lists prefixes concurrently
+
+    Common prefixes below the fixed part of the glob are found with delimiter
+    listings, and only prefixes that can contain matches are listed further.
+    Under a `**`, prefixes deeper than `fanout_depth` are listed flat instead.
+    Every page of every listing is a separate task on a pool of `parallelism`
+    threads, and matching keys are yielded as soon as their page arrives, so
+    fetching starts while the listing is still running. At most twice as
+    many pages as threads are listed ahead of the consumer, and the prefixes
+    still to list are taken depth first, so memory use stays bounded however
+    large the bucket.
+
+    Sharding matches s3_find_shard, including falling back to sharding by
+    key when the glob has no prefix level to shard on.
+
+    Yields objects with a `url` attribute.
+    """
+    if s3 is None:
+        import boto3
+
+        s3 = boto3.client("s3")
+    bucket, root, pattern = split_glob(uri)
+    recursive = "**" in pattern
+    if shard is not None and by == "prefix" and len(pattern) < 2:
+        logging.warning(f"No prefix level to shard on in {uri}, sharding by key")
+        by = "key"
+
+    def _relative(key: str) -> List[str]:
+        return key[len(root) :].rstrip("/").split("/")
+
+    def _list_page(prefix: str, depth: int, token: Optional[str]):
+        delimited = not recursive or depth < fanout_depth
+        kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if delimited:
+            kwargs["Delimiter"] = "/"
+        if token:
+            kwargs["ContinuationToken"] = token
+        response = s3.list_objects_v2(**kwargs)
+
+        keys = []
+        for obj in response.get("Contents", []):
+            parts = _relative(obj["Key"])
+            if match_parts(parts, pattern):
+                keys.append(obj["Key"])
+        prefixes = []
+        for common in response.get("CommonPrefixes", []):
+            parts = _relative(common["Prefix"])
+            if could_match(parts, pattern):
+                prefixes.append(common["Prefix"])
+
+        if shard is not None and by == "key":
+            keys = [k for k in keys if in_shard(f"s3://{bucket}/{k}", shard)]
+        elif shard is not None and depth == 0:
+            # Sharding by prefix decides on the first level below the root
+            keys = [k for k in keys if in_shard(_relative(k)[0], shard)]
+            prefixes = [p for p in prefixes if in_shard(_relative(p)[0], shard)]
+
+        next_page = None
+        if response.get("IsTruncated"):
+            next_page = (prefix, depth, response["NextContinuationToken"])
+        return keys, [(p, depth + 1, None) for p in prefixes], next_page
+
+    parallelism = max(parallelism, 1)
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        # Listings not submitted yet, taken last in first out so that the
+        # listing goes depth first and finishes prefixes it has started
+        backlog = [(root, 0, None)]
+        pending = set()
+        try:
+            while backlog or pending:
+                while backlog and len(pending) < 2 * parallelism:
+                    pending.add(executor.submit(_list_page, *backlog.pop()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    keys, prefixes, next_page = future.result()
+                    backlog.extend(reversed(prefixes))
+                    if next_page is not None:
+                        backlog.append(next_page)
+                    for key in keys:
+                        yield SimpleNamespace(url=f"s3://{bucket}/{key}")
+        finally:
+            # Stop listing if the consumer goes away early
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Bulk load prepared dataset files, written by the --prepare-to option of
+s3-to-dc and thredds-to-dc, into a Datacube database with COPY
+"""
+import logging
+from itertools import chain, islice
+
+import click
+
+from odc_index.db import Loaded, load_prepared
+from odc_index.logs import setup_logging
+from odc_index.prepared import read_prepared
+
+# Prepared datasets loaded per transaction
+DEFAULT_BATCH_SIZE = 100000
+
+
+@click.command("load-dc")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=DEFAULT_BATCH_SIZE,
+    help="Datasets loaded per transaction",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
+@click.argument("files", type=click.Path(exists=True, dir_okay=False), nargs=-1)
+def cli(batch_size, log_json, files):
+    """Add the datasets in prepared FILES to the datacube, skipping those
+    already indexed along with their locations
+    """
+    from datacube import Datacube
+
+    setup_logging(json_format=log_json)
+
+    dc = Datacube()
+    lines = chain.from_iterable(read_prepared(path) for path in files)
+    total = Loaded(0, 0, 0, 0)
+    for first in lines:
+        # Stream each batch to the database rather than holding it in memory
+        loaded = load_prepared(dc, chain([first], islice(lines, batch_size - 1)))
+        total = Loaded(*(t + b for t, b in zip(total, loaded)))
+        logging.info("Loaded %s datasets so far, %s added", total.rows, total.added)
+        if loaded.matched < loaded.rows:
+            logging.error(
+                "%s datasets name a product missing from the database",
+                loaded.rows - loaded.matched,
+            )
+        if loaded.missing_sources:
+            logging.warning(
+                "%s lineage sources are not indexed and were left out",
+                loaded.missing_sources,
+            )
+
+    print(
+        f"Added {total.added} Datasets, {total.matched - total.added} already "
+        f"indexed, {total.rows - total.matched} with unknown products, "
+        f"{total.missing_sources} lineage sources not indexed"
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,163 @@
+"""Cheap logging for the per-dataset hot path
+
+Records are handed to a background thread through a queue before they are
+formatted, so indexing threads never format messages or block on stdout.
+Per-dataset success lines can be sampled down to one in N, with periodic
+summaries of counts and rates taking their place.
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Seconds between summaries of success and failure rates
+DEFAULT_SUMMARY_INTERVAL = 60.0
+
+# Log every Nth success, process wide, set by setup_logging
+_sample_every = 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with any `fields` passed in `extra`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # QueueHandler.prepare formats the message on the calling thread, leave
+    # that to the listener instead
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(
+    level=logging.INFO, sample_every: int = 1, json_format: bool = False
+) -> QueueListener:
+    """Route the root logger through a queue to a stderr handler running on
+    a background thread, which is flushed at exit
+
+    Arguments:
+        level -- Root log level
+        sample_every {int} -- Log one in this many per-dataset successes,
+            0 to only log summaries
+        json_format {bool} -- Log JSON objects instead of plain lines
+    """
+    global _sample_every
+    _sample_every = sample_every
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        JsonFormatter() if json_format else logging.Formatter(logging.BASIC_FORMAT)
+    )
+    records = queue.Queue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(_DeferredQueueHandler(records))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RateLog:
+    """Counts per-item outcomes, logging a sample of successes, every
+    failure and a summary of rates every `interval` seconds
+
+    Messages take %-style arguments, which are only formatted for records
+    that are actually emitted.
+
+    Arguments:
+        name {str} -- What is being counted, used in summaries
+        every {int} -- Log one in this many successes, defaults to the
+            process wide setting of setup_logging
+        interval {float} -- Seconds between summaries
+    """
+
+    def __init__(
+        self,
+        name: str = "datasets",
+        every: Optional[int] = None,
+        interval: float = DEFAULT_SUMMARY_INTERVAL,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.name = name
+        self.every = _sample_every if every is None else every
+        self.interval = interval
+        self.logger = logger or logging.getLogger()
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._start = self._last = time.monotonic()
+        self._last_successes = self._last_failures = 0
+
+    def success(self, msg: str, *args):
+        with self._lock:
+            self.successes += 1
+            sampled = self.every > 0 and self.successes % self.every == 0
+        if sampled:
+            self.logger.info(msg, *args)
+        self._maybe_summarise()
+
+    def failure(self, msg, *args):
+        with self._lock:
+            self.failures += 1
+        self.logger.error(msg, *args)
+        self._maybe_summarise()
+
+    def _maybe_summarise(self):
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return
+        with self._lock:
+            if now - self._last < self.interval:
+                return
+            elapsed = now - self._last
+            successes = self.successes - self._last_successes
+            failures = self.failures - self._last_failures
+            self._last, self._last_successes = now, self.successes
+            self._last_failures = self.failures
+        self._summarise(successes, failures, elapsed)
+
+    def _summarise(self, successes: int, failures: int, elapsed: float):
+        self.logger.info(
+            "%s %s succeeded (%.1f/s), %s failed (%.1f/s) in the last %.0fs",
+            successes,
+            self.name,
+            successes / elapsed if elapsed else 0.0,
+            failures,
+            failures / elapsed if elapsed else 0.0,
+            elapsed,
+            extra={
+                "fields": {
+                    "event": "summary",
+                    "successes": successes,
+                    "failures": failures,
+                    "seconds": elapsed,
+                }
+            },
+        )
+
+    def close(self):
+        """Log a summary of the whole run"""
+        if self.successes or self.failures:
+            self._summarise(
+                self.successes, self.failures, time.monotonic() - self._start
+            )
@@ -0,0 +1,188 @@
+"""Filter object keys and URLs on fields parsed from their path, such as
+acquisition date, Landsat path/row, MGRS tile or region code, before any
+document is fetched
+
+Fields are described by a key template such as
+
+    ga_ls8c_ard_3/{path}/{row}/{year}/{month}/{day}/*.odc-metadata.yaml
+    L2/sentinel-2-nrt/S2MSIARD/{date}/*_T{tile}_*/ARD-METADATA.yaml
+
+where `*` matches within one path component, `**` across components, and
+`{name}` or `{name:regex}` captures a named field.
+"""
+import calendar
+import re
+from datetime import date, datetime
+from typing import Iterable, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+# Patterns of well known fields, any other field matches one path component
+NAMED_PATTERNS = {
+    "date": r"\d{4}-\d{2}-\d{2}|\d{8}",
+    "year": r"\d{4}",
+    "month": r"\d{2}",
+    "day": r"\d{2}",
+    "path": r"\d{3}",
+    "row": r"\d{3}",
+    "tile": r"\d{2}[A-Z]{3}",
+    "region": r"[^/]+?",
+}
+
+_DEFAULT_PATTERN = r"[^/]+?"
+
+_TOKEN = re.compile(r"\{(\w+)(?::([^}]+))?\}|\*\*|\*|\?")
+
+
+def compile_template(template: str) -> "re.Pattern":
+    """Turn a key template into a regular expression with a named group per
+    field, matching at the end of a key and at a path component boundary
+
+    Raises:
+        ValueError: If a field appears twice or a regex is invalid
+    """
+    parts, pos, names = [], 0, set()
+    for m in _TOKEN.finditer(template):
+        parts.append(re.escape(template[pos : m.start()]))
+        token = m.group(0)
+        if m.group(1):
+            name = m.group(1)
+            if name in names:
+                raise ValueError(f"Field '{name}' appears twice in '{template}'")
+            names.add(name)
+            pattern = m.group(2) or NAMED_PATTERNS.get(name, _DEFAULT_PATTERN)
+            parts.append(f"(?P<{name}>{pattern})")
+        elif token == "**":
+            parts.append(".*")
+        elif token == "*":
+            parts.append("[^/]*")
+        else:
+            parts.append("[^/]")
+        pos = m.end()
+    parts.append(re.escape(template[pos:]))
+    try:
+        return re.compile("(?:^|/)" + "".join(parts) + "$")
+    except re.error as e:
+        raise ValueError(f"Invalid key template '{template}': {e}")
+
+
+def date_span(fields: dict) -> Optional[Tuple[date, date]]:
+    """First and last day covered by the date fields of a key, if any"""
+    if fields.get("date"):
+        value = fields["date"].replace("-", "")
+        day = datetime.strptime(value, "%Y%m%d").date()
+        return day, day
+    if not fields.get("year"):
+        return None
+    year = int(fields["year"])
+    if not fields.get("month"):
+        return date(year, 1, 1), date(year, 12, 31)
+    month = int(fields["month"])
+    if not fields.get("day"):
+        return date(year, month, 1), date(
+            year, month, calendar.monthrange(year, month)[1]
+        )
+    day = date(year, month, int(fields["day"]))
+    return day, day
+
+
+def region_code(fields: dict) -> Optional[str]:
+    """Region code of a key: its region or tile field, or path and row
+    concatenated as in Landsat region codes
+    """
+    if fields.get("region"):
+        return fields["region"]
+    if fields.get("tile"):
+        return fields["tile"]
+    if fields.get("path") and fields.get("row"):
+        return fields["path"] + fields["row"]
+    return None
+
+
+class KeyFilter:
+    """Predicate on URLs, keeping those whose path matches a template and
+    whose fields fall inside a date window and a set of region codes
+
+    Arguments:
+        template {str} -- Key template, see module documentation
+        from_date {date} -- First day to keep, inclusive
+        to_date {date} -- Last day to keep, inclusive
+        region_codes {Iterable[str]} -- Region codes to keep
+    """
+
+    def __init__(
+        self,
+        template: str,
+        from_date: Optional[date] = None,
+        to_date: Optional[date] = None,
+        region_codes: Optional[Iterable[str]] = None,
+    ):
+        self.template = template
+        self.pattern = compile_template(template)
+        self.from_date = from_date
+        self.to_date = to_date
+        self.region_codes: Optional[Set[str]] = (
+            set(region_codes) if region_codes else None
+        )
+        self.kept = 0
+        self.dropped = 0
+
+    def fields(self, url: str) -> Optional[dict]:
+        """Fields parsed from the path of a URL, None if it does not match"""
+        m = self.pattern.search(urlparse(url).path.lstrip("/"))
+        return m.groupdict() if m else None
+
+    def _keep(self, url: str) -> bool:
+        fields = self.fields(url)
+        if fields is None:
+            return False
+
+        if self.from_date or self.to_date:
+            try:
+                span = date_span(fields)
+            except ValueError:
+                return False
+            if span is None:
+                return False
+            first, last = span
+            if self.from_date and last < self.from_date:
+                return False
+            if self.to_date and first > self.to_date:
+                return False
+
+        if self.region_codes is not None:
+            if region_code(fields) not in self.region_codes:
+                return False
+        return True
+
+    def __call__(self, url: str) -> bool:
+        keep = self._keep(url)
+        if keep:
+            self.kept += 1
+        else:
+            self.dropped += 1
+        return keep
+
+
+def key_filter_from_options(
+    template: Optional[str],
+    from_date: Optional[datetime],
+    to_date: Optional[datetime],
+    region_codes: Tuple[str, ...],
+) -> Optional[KeyFilter]:
+    """KeyFilter for the --key-template family of command line options
+
+    Raises:
+        ValueError: If filters are given without a template to parse keys with
+    """
+    if template is None:
+        if from_date or to_date or region_codes:
+            raise ValueError(
+                "--from-date, --to-date and --region-code need --key-template"
+            )
+        return None
+    return KeyFilter(
+        template,
+        from_date.date() if from_date else None,
+        to_date.date() if to_date else None,
+        region_codes,
+    )
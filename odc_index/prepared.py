@@ -0,0 +1,105 @@
+"""Prepared dataset files: the output of fetching, parsing and resolving
+documents without writing them to the index, for load-dc to bulk load later
+
+Each line is a JSON object with the dataset `id`, `product` name, stored
+`metadata` document, `uris` and the ids of its `sources` by classifier.
+Lineage datasets carried by a dataset get rows of their own before it, so
+that load-dc adds them first. Files ending in .gz are gzip compressed.
+"""
+import gzip
+import json
+import logging
+from typing import IO, TYPE_CHECKING, Iterable, Iterator, Optional, Set, Tuple
+
+from odc_index.journal import FailureJournal
+from odc_index.logs import RateLog
+
+if TYPE_CHECKING:
+    from datacube.model import Dataset
+
+
+def _open(path: str, mode: str) -> IO[bytes]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def prepared_row(ds: "Dataset") -> dict:
+    """Row of a prepared file, holding what datasets.add would store"""
+    from datacube.utils import jsonify_document
+
+    return {
+        "id": str(ds.id),
+        "product": ds.type.name,
+        "metadata": jsonify_document(ds.metadata_doc_without_lineage()),
+        "uris": [uri for uri in ds.uris or [] if uri is not None],
+        "sources": {
+            classifier: str(source.id)
+            for classifier, source in (ds.sources or {}).items()
+        },
+    }
+
+
+def prepared_rows(ds: "Dataset", seen: Set = None) -> Iterator[dict]:
+    """Rows of the lineage datasets a dataset carries, depth-first, and then
+    of the dataset itself, leaving out datasets already in `seen`
+    """
+    if seen is None:
+        seen = set()
+    if ds.id in seen:
+        return
+    seen.add(ds.id)
+    for source in (ds.sources or {}).values():
+        yield from prepared_rows(source, seen)
+    yield prepared_row(ds)
+
+
+def read_prepared(path: str) -> Iterator[bytes]:
+    """Lines of a prepared file, without their line endings"""
+    with _open(path, "rb") as f:
+        for line in f:
+            line = line.rstrip(b"\n")
+            if line:
+                yield line
+
+
+def prepare_datasets(
+    ds_stream: Iterable[Tuple[str, Optional["Dataset"], Optional[str], Optional[str]]],
+    path: str,
+    journal: FailureJournal = None,
+) -> Tuple[int, int]:
+    """Write the datasets of a doc_stream_to_datasets stream to a prepared
+    file, with their lineage, journaling the documents that failed
+
+    Returns:
+        tuple -- Numbers of datasets written and failed, not counting lineage
+    """
+    if journal is None:
+        journal = FailureJournal(None)
+
+    written, failed, rows = 0, 0, 0
+    # Ids of the datasets written, so that shared lineage is written once
+    seen = set()
+    progress = RateLog("datasets")
+    with _open(path, "wb") as f:
+        for uri, ds, err, stage in ds_stream:
+            if err is not None:
+                progress.failure(err)
+                journal.record(uri, stage, err)
+                failed += 1
+                continue
+            for row in prepared_rows(ds, seen):
+                f.write(json.dumps(row, separators=(",", ":")).encode())
+                f.write(b"\n")
+                rows += 1
+            progress.success("Prepared %s from %s", ds.id, uri)
+            written += 1
+
+    progress.close()
+    logging.info(
+        "Wrote %s prepared datasets and %s lineage datasets to %s",
+        written,
+        rows - written,
+        path,
+    )
+    return written, failed
@@ -0,0 +1,161 @@
+"""Client-side rate limiting of S3 requests, shared by fetching threads
+
+Requests take a token from a global bucket and from a bucket per key
+prefix, since S3 limits request rates per prefix. Throttling responses
+halve the rates of the buckets involved and are retried with backoff,
+successes raise them again towards their configured ceilings.
+"""
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Error codes S3 answers with when requests should slow down
+THROTTLE_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
+# Attempts at a throttled request before giving up
+DEFAULT_RETRIES = 5
+
+# Fraction of its ceiling a bucket's rate grows by on every success
+RECOVERY_STEP = 0.01
+
+
+def is_throttle(error: Exception) -> bool:
+    """True for S3 errors asking the client to slow down"""
+    response = getattr(error, "response", None) or {}
+    code = response.get("Error", {}).get("Code")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in THROTTLE_CODES or status == 503
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing `rate` requests per second on
+    average, with bursts of up to one second's worth
+    """
+
+    def __init__(self, rate: float, min_rate: float = 1.0):
+        self.ceiling = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        capacity = max(self.rate, 1.0)
+        self._tokens = min(capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def decrease(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, self.rate)
+
+    def increase(self):
+        with self._lock:
+            self.rate = min(self.ceiling, self.rate + self.ceiling * RECOVERY_STEP)
+
+
+class S3RateLimiter:
+    """Limits S3 requests globally and per key prefix, adapting to throttling
+
+    Arguments:
+        rate {float} -- Requests per second across all prefixes, unlimited
+            if None
+        prefix_rate {float} -- Requests per second per prefix, unlimited if None
+        prefix_depth {int} -- Leading key components that make up a prefix
+        retries {int} -- Attempts at a throttled request before giving up
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        prefix_rate: Optional[float] = None,
+        prefix_depth: int = 1,
+        retries: int = DEFAULT_RETRIES,
+    ):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.prefix_rate = prefix_rate
+        self.prefix_depth = prefix_depth
+        self.retries = retries
+        self.throttled = 0
+        self._prefixes: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _prefix_bucket(self, bucket: str, key: str) -> Optional[TokenBucket]:
+        if not self.prefix_rate:
+            return None
+        prefix = bucket + "/" + "/".join(key.split("/")[: self.prefix_depth])
+        with self._lock:
+            if prefix not in self._prefixes:
+                self._prefixes[prefix] = TokenBucket(self.prefix_rate)
+            return self._prefixes[prefix]
+
+    def call(self, func: Callable[..., T], bucket: str, key: str, **kwargs) -> T:
+        """Call an S3 client method such as get_object for one object,
+        waiting for tokens first and retrying with backoff when throttled
+        """
+        buckets = [b for b in (self.bucket, self._prefix_bucket(bucket, key)) if b]
+        for attempt in range(self.retries):
+            for b in buckets:
+                b.acquire()
+            try:
+                result = func(Bucket=bucket, Key=key, **kwargs)
+            except Exception as e:
+                if not is_throttle(e) or attempt == self.retries - 1:
+                    raise
+                with self._lock:
+                    self.throttled += 1
+                for b in buckets:
+                    b.decrease()
+                # Full jitter exponential backoff
+                time.sleep(random.uniform(0, min(20.0, 0.1 * 2**attempt)))
+                continue
+            for b in buckets:
+                b.increase()
+            return result
+
+
+def s3_client(limiter: Optional[S3RateLimiter] = None):
+    """boto3 S3 client for requests made through limiter, if set
+
+    botocore retries throttled requests itself, at full rate and before the
+    limiter sees them, so clients used with a limiter leave retries to it.
+    `max_attempts` counts retries after the first attempt.
+    """
+    import boto3
+
+    if limiter is None:
+        return boto3.client("s3")
+    from botocore.config import Config
+
+    return boto3.client("s3", config=Config(retries={"max_attempts": 0}))
+
+
+def limiter_from_options(
+    rate: Optional[float], prefix_rate: Optional[float], prefix_depth: int
+) -> Optional[S3RateLimiter]:
+    """S3RateLimiter for the --s3-rate family of command line options, None
+    if no limit is set
+    """
+    if not rate and not prefix_rate:
+        return None
+    return S3RateLimiter(rate, prefix_rate, prefix_depth)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Move indexed datasets to a new bucket or URL scheme by rewriting their
+locations in bulk, without fetching or re-validating their documents
+"""
+import logging
+from typing import Iterable, Iterator, List, Tuple
+
+import click
+
+from odc_index.db import Relocated, relocate_locations, relocate_prefix
+from odc_index.listing import DEFAULT_LIST_PARALLELISM, s3_find_parallel
+from odc_index.logs import setup_logging
+
+# Locations moved per transaction
+DEFAULT_BATCH_SIZE = 10000
+
+
+def listed_pairs(
+    urls: Iterable[str], old_prefix: str, new_prefix: str, batch_size: int
+) -> Iterator[List[Tuple[str, str]]]:
+    """Batches of (old, new) location pairs for listed documents under the
+    new prefix, mapping each back to where it was under the old prefix
+    """
+    batch = []
+    for url in urls:
+        if not url.startswith(new_prefix):
+            logging.warning("Skipping %s, which is not under %s", url, new_prefix)
+            continue
+        batch.append((old_prefix + url[len(new_prefix) :], url))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@click.command("relocate-dc")
+@click.option(
+    "--product",
+    "products",
+    multiple=True,
+    help="Only relocate datasets of this product. Can be repeated",
+)
+@click.option(
+    "--list",
+    "list_glob",
+    default=None,
+    help="List this glob under NEW_PREFIX, e.g. 's3://new-bucket/ls8/**/*.yaml', "
+    "and only relocate datasets whose document was found there. By default "
+    "every location under OLD_PREFIX is rewritten without checking",
+)
+@click.option(
+    "--list-parallelism",
+    type=int,
+    default=DEFAULT_LIST_PARALLELISM,
+    help="Number of prefixes listed concurrently with --list",
+)
+@click.option(
+    "--keep-old",
+    is_flag=True,
+    default=False,
+    help="Add the new locations but keep the old ones",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=DEFAULT_BATCH_SIZE,
+    help="Locations moved per transaction",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Report what would be moved and roll every transaction back",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
+@click.argument("old_prefix", type=str, nargs=1)
+@click.argument("new_prefix", type=str, nargs=1)
+def cli(
+    products,
+    list_glob,
+    list_parallelism,
+    keep_old,
+    batch_size,
+    dry_run,
+    log_json,
+    old_prefix,
+    new_prefix,
+):
+    """Rewrite dataset locations starting with OLD_PREFIX to start with
+    NEW_PREFIX, e.g. s3://old-bucket/ls8/ s3://new-bucket/ls8/
+    """
+    from datacube import Datacube
+
+    setup_logging(json_format=log_json)
+
+    if old_prefix == new_prefix:
+        raise click.UsageError("OLD_PREFIX and NEW_PREFIX are the same")
+    if list_glob is not None and not list_glob.startswith(new_prefix):
+        raise click.UsageError("--list must be a glob under NEW_PREFIX")
+
+    dc = Datacube()
+    product_ids = []
+    for name in products:
+        product = dc.index.products.get_by_name(name)
+        if product is None:
+            raise click.UsageError(f"Unknown product {name}")
+        product_ids.append(product.id)
+
+    if list_glob is None:
+        batches = relocate_prefix(
+            dc,
+            old_prefix,
+            new_prefix,
+            product_ids,
+            keep_old=keep_old,
+            batch_size=batch_size,
+            dry_run=dry_run,
+        )
+    else:
+        urls = (o.url for o in s3_find_parallel(list_glob, list_parallelism))
+        batches = (
+            relocate_locations(
+                dc, pairs, product_ids, keep_old=keep_old, dry_run=dry_run
+            )
+            for pairs in listed_pairs(urls, old_prefix, new_prefix, batch_size)
+        )
+
+    total = Relocated(0, 0, 0)
+    for batch in batches:
+        total = Relocated(*(t + b for t, b in zip(total, batch)))
+        logging.info("Moved %s locations so far, %s added, %s removed", *total)
+
+    verb = "Would move" if dry_run else "Moved"
+    print(
+        f"{verb} {total.matched} locations: "
+        f"{total.added} added, {total.removed} removed"
+    )
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Replay the failures recorded in a failure journal, retrying only the
+documents and messages that failed rather than the whole source
+"""
+import json
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, List, Tuple
+from uuid import UUID
+
+import click
+
+from odc_index.control import AIMDController
+from odc_index.db import bulk_has_location
+from odc_index.journal import Failure, FailureJournal, group_runs, read_journal
+from odc_index.logs import setup_logging
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+
+# Number of journal entries checked against the database per query
+CHECK_BATCH_SIZE = 1000
+
+
+class JournalMessage:
+    """Stands in for an SQS message read back from a journal, with the
+    message attributes it was received with
+    """
+
+    def __init__(self, message_id: str, body: str, message_attributes: dict = None):
+        self.message_id = message_id
+        self.body = body
+        self.message_attributes = message_attributes or {}
+
+    def delete(self):
+        # The original message was either deleted or is still on its queue
+        pass
+
+
+class JournalQueue:
+    """Stands in for an SQS queue holding the messages of a journal, so that
+    they can be replayed through queue_to_odc unchanged
+    """
+
+    def __init__(self, failures: List[Failure]):
+        self._messages = deque(
+            JournalMessage(f.source, f.body, f.attributes)
+            for f in failures
+            if f.body is not None
+        )
+
+    def receive_messages(self, MaxNumberOfMessages=1, **kwargs):
+        n = min(MaxNumberOfMessages, len(self._messages))
+        return [self._messages.popleft() for _ in range(n)]
+
+
+def _lineage_kwargs(params: dict) -> dict:
+    return {
+        "skip_lineage": params.get("skip_lineage", False),
+        "fail_on_missing_lineage": params.get("fail_on_missing_lineage", True),
+        "verify_lineage": params.get("verify_lineage", False),
+        "trusted": params.get("trusted", False),
+    }
+
+
+def _archives(failure: Failure) -> bool:
+    from odc_index.sqs_to_dc import message_action
+
+    message = JournalMessage(failure.source, failure.body, failure.attributes)
+    return failure.tool == "sqs-to-dc" and message_action(message) == "archive"
+
+
+def not_indexed(dc: "Datacube", failures: List[Failure]) -> List[Failure]:
+    """Drop failures whose dataset has been indexed since they were recorded,
+    by location for documents and by dataset id where the journal has one.
+    Messages that archive a dataset are kept, their dataset is indexed
+    """
+    remaining = []
+    for i in range(0, len(failures), CHECK_BATCH_SIZE):
+        batch = failures[i : i + CHECK_BATCH_SIZE]
+        located = bulk_has_location(
+            dc, [f.source for f in batch if f.tool != "sqs-to-dc"]
+        )
+        with_ids = [f for f in batch if f.dataset_id is not None and not _archives(f)]
+        has_ids = dc.index.datasets.bulk_has([UUID(f.dataset_id) for f in with_ids])
+        known = {f.dataset_id for f, has in zip(with_ids, has_ids) if has}
+        remaining.extend(
+            f for f in batch if f.source not in located and f.dataset_id not in known
+        )
+    return remaining
+
+
+def replay_s3(
+    dc: "Datacube",
+    failures: List[Failure],
+    workers: int,
+    journal: FailureJournal,
+) -> Tuple[int, int]:
+    from odc.index.stac import stac_transform
+    from odc_index.fetch import fetch_s3_urls
+    from odc_index.s3_to_dc import dump_to_odc
+
+    params = failures[0].params
+    added, failed, _ = dump_to_odc(
+        fetch_s3_urls([f.source for f in failures], nconcurrent=workers),
+        dc,
+        params["product"].split(),
+        transform=stac_transform if params.get("stac") else None,
+        update=params.get("update", False),
+        allow_unsafe=params.get("allow_unsafe", False),
+        controller=AIMDController(workers=workers, max_workers=workers),
+        journal=journal,
+        **_lineage_kwargs(params),
+    )
+    return added, failed
+
+
+def replay_thredds(
+    dc: "Datacube",
+    failures: List[Failure],
+    workers: int,
+    journal: FailureJournal,
+) -> Tuple[int, int]:
+    from odc_index.fetch import download_yamls
+    from odc_index.thredds_to_dc import dump_list_to_odc
+
+    params = failures[0].params
+    return dump_list_to_odc(
+        download_yamls([f.source for f in failures], workers=workers),
+        dc,
+        params["product"].split(),
+        journal=journal,
+        **_lineage_kwargs(params),
+    )
+
+
+def replay_stac(
+    dc: "Datacube",
+    failures: List[Failure],
+    workers: int,
+    journal: FailureJournal,
+) -> Tuple[int, int]:
+    import requests
+    from odc_index.datasets import make_doc2ds
+    from odc_index.fetch import _bounded_map, fetch_url
+    from odc_index.stac_api_to_dc import (
+        guess_location,
+        index_update_datasets,
+        transform_items,
+    )
+
+    params = failures[0].params
+    session = requests.Session()
+
+    def _fetch(url):
+        try:
+            return url, json.loads(fetch_url(url, session=session)), None
+        except (requests.RequestException, ValueError) as e:
+            return url, None, e
+
+    def _items():
+        for url, metadata, err in _bounded_map(
+            _fetch, [f.source for f in failures], workers
+        ):
+            if err is not None:
+                logging.error(f"Failed to fetch {url}: {err}")
+                journal.record(url, "fetch", err)
+                continue
+            uri, relative = guess_location(metadata)
+            yield metadata, uri or url, relative
+
+    doc2ds = make_doc2ds(
+        dc.index,
+        products=params["product"].split(),
+        trusted=params.get("trusted", False),
+    )
+    added, failed, _ = index_update_datasets(
+        dc,
+        transform_items(doc2ds, _items()),
+        params.get("update", False),
+        params.get("allow_unsafe", False),
+        AIMDController(workers=workers, max_workers=workers),
+        journal,
+    )
+    return added, failed
+
+
+def replay_sqs(
+    dc: "Datacube",
+    failures: List[Failure],
+    workers: int,
+    journal: FailureJournal,
+) -> Tuple[int, int]:
+    from odc.index.stac import stac_transform
+    from odc_index.sqs_to_dc import queue_to_odc
+
+    params = failures[0].params
+    return queue_to_odc(
+        JournalQueue(failures),
+        dc,
+        params["product"].split(),
+        record_path=tuple(params.get("record_path") or ()),
+        transform=stac_transform if params.get("stac") else None,
+        update=params.get("update", False),
+        archive=params.get("archive", False),
+        allow_unsafe=params.get("allow_unsafe", False),
+        odc_metadata_link=params.get("odc_metadata_link"),
+        region_code_list_uri=params.get("region_code_list_uri"),
+        controller=AIMDController(
+            batch_size=10,
+            min_batch_size=1,
+            max_batch_size=10,
+            workers=workers,
+            max_workers=workers,
+        ),
+        journal=journal,
+        **_lineage_kwargs(params),
+    )
+
+
+REPLAYERS = {
+    "s3-to-dc": replay_s3,
+    "thredds-to-dc": replay_thredds,
+    "stac-to-dc": replay_stac,
+    "sqs-to-dc": replay_sqs,
+}
+
+
+@click.command("replay-to-dc")
+@click.option(
+    "--workers",
+    type=int,
+    default=8,
+    help="Number of documents fetched and datasets written concurrently",
+)
+@click.option(
+    "--failure-journal",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append entries that fail again to this file",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only report what would be replayed",
+)
+@click.option(
+    "--log-sample",
+    type=int,
+    default=0,
+    help="Log one in N successfully indexed datasets. By default only failures "
+    "and periodic summaries of rates are logged",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
+@click.argument("journal_path", type=click.Path(exists=True, dir_okay=False))
+def cli(workers, failure_journal, dry_run, log_sample, log_json, journal_path):
+    """Retry only the failures recorded in a failure journal, skipping
+    anything that has been indexed since"""
+    from datacube import Datacube
+
+    setup_logging(sample_every=log_sample, json_format=log_json)
+
+    failures = list(read_journal(journal_path))
+    print(f"Read {len(failures)} failures from {journal_path}")
+
+    dc = Datacube()
+    added, failed, skipped = 0, 0, 0
+    for run in group_runs(failures):
+        tool = run[0].tool
+        if tool not in REPLAYERS:
+            logging.warning(f"Don't know how to replay {len(run)} {tool} failures")
+            failed += len(run)
+            continue
+
+        params = run[0].params
+        if not (params.get("update") or params.get("archive")):
+            # Updates and archives are replayed regardless, they are idempotent
+            remaining = not_indexed(dc, run)
+            skipped += len(run) - len(remaining)
+            run = remaining
+        if not run:
+            continue
+
+        print(f"Replaying {len(run)} {tool} failures")
+        if dry_run:
+            continue
+
+        # Re-recorded failures keep the tool and parameters of the original run
+        run_journal = FailureJournal(failure_journal, tool, params)
+        try:
+            run_added, run_failed = REPLAYERS[tool](dc, run, workers, run_journal)
+        finally:
+            run_journal.close()
+        added += run_added
+        failed += run_failed
+
+    print(f"Skipped {skipped} already indexed, Added {added}, Failed {failed}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,100 @@
+"""Routing of read-only queries to a streaming replica of the index database
+
+Existence checks, product loading and lineage lookups can go to a replica
+configured as another datacube environment, while writes always go to the
+primary. Reads fall back to the primary whenever the replica lags too far
+behind, or can't be reached, so that recent writes stay visible.
+"""
+import logging
+import math
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from odc_index.db import replica_lag
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+
+# Seconds of replication lag above which reads fall back to the primary
+DEFAULT_MAX_LAG = 30.0
+
+# Seconds a measured replication lag is trusted for
+LAG_CHECK_INTERVAL = 10.0
+
+
+class ReadRouter:
+    """Chooses the connection read-only queries go to
+
+    Arguments:
+        primary {Datacube} -- Connection for writes, and reads as a fallback
+        replica {Datacube} -- Read-only connection, or None to read from the
+            primary
+        max_lag {float} -- Seconds of replication lag above which reads
+            fall back to the primary
+        check_interval {float} -- Seconds between measurements of the lag
+        lag {Callable} -- Measures the lag of a connection, for testing
+    """
+
+    def __init__(
+        self,
+        primary: "Datacube",
+        replica: Optional["Datacube"] = None,
+        max_lag: float = DEFAULT_MAX_LAG,
+        check_interval: float = LAG_CHECK_INTERVAL,
+        lag: Callable[["Datacube"], float] = replica_lag,
+    ):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.fallbacks = 0
+        self._lag = lag
+        self._checked: Optional[float] = None
+        self._replica_ok = False
+        self._lock = threading.Lock()
+
+    def replica_ok(self) -> bool:
+        """True if reads should go to the replica, measuring its lag again
+        once every check_interval
+        """
+        if self.replica is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked >= self.check_interval:
+                self._checked = now
+                try:
+                    lag = self._lag(self.replica)
+                except Exception as e:
+                    logging.warning("Failed to measure replica lag: %s", e)
+                    lag = math.inf
+                ok = lag <= self.max_lag
+                if ok != self._replica_ok:
+                    if ok:
+                        logging.info("Reading from the replica, %.1fs behind", lag)
+                    else:
+                        logging.warning(
+                            "Replica is %.1fs behind, reading from the primary", lag
+                        )
+                        self.fallbacks += 1
+                self._replica_ok = ok
+            return self._replica_ok
+
+    def reader(self) -> "Datacube":
+        """Connection for a read-only query"""
+        return self.replica if self.replica_ok() else self.primary
+
+
+def router_from_options(
+    dc: "Datacube", replica_env: Optional[str], max_lag: float
+) -> ReadRouter:
+    """ReadRouter for the --replica-env and --max-replica-lag command line
+    options, reading from the primary `dc` alone without a replica
+    """
+    if not replica_env:
+        return ReadRouter(dc)
+
+    from datacube import Datacube
+
+    return ReadRouter(dc, Datacube(env=replica_env), max_lag=max_lag)
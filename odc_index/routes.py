@@ -0,0 +1,120 @@
+"""Queues served by one multi-queue sqs-to-dc process, read from a YAML
+config file such as
+
+    queues:
+      - queue: dea-ls8-ard
+        products: ga_ls8c_ard_3
+        stac: true
+        odc_metadata_link: STAC-LINKS-REL:odc_yaml
+      - queue: dea-s2-nrt
+        products: [s2a_nrt_granule, s2b_nrt_granule]
+        record_path:
+          - L2/sentinel-2-nrt/S2MSIARD/*/*/ARD-METADATA.yaml
+        region_code_list_uri: s3://bucket/region_codes.csv
+
+Each queue has its own products and the options that say how its messages
+are read, everything else is shared and set on the command line.
+"""
+from typing import List, NamedTuple, Optional, Tuple
+
+import yaml
+
+FIELDS = {
+    "queue",
+    "products",
+    "stac",
+    "odc_metadata_link",
+    "record_path",
+    "region_code_list_uri",
+}
+
+
+class QueueRoute(NamedTuple):
+    """A queue and how to index the messages on it"""
+
+    queue: str
+    products: Tuple[str, ...]
+    stac: bool = False
+    odc_metadata_link: Optional[str] = None
+    record_path: Tuple[str, ...] = ()
+    region_code_list_uri: Optional[str] = None
+
+    def params(self) -> dict:
+        """The sqs-to-dc command line parameters of this queue, as recorded
+        in failure journals for replay-to-dc
+        """
+        return {
+            "queue_name": self.queue,
+            "product": " ".join(self.products),
+            "stac": self.stac,
+            "odc_metadata_link": self.odc_metadata_link,
+            "record_path": list(self.record_path),
+            "region_code_list_uri": self.region_code_list_uri,
+        }
+
+
+def _strings(value, what: str) -> Tuple[str, ...]:
+    # A space separated string like the PRODUCT argument, or a list
+    if isinstance(value, str):
+        return tuple(value.split())
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return tuple(value)
+    raise ValueError(f"{what} must be a string or a list of strings")
+
+
+def parse_routes(config: dict) -> List[QueueRoute]:
+    """Routes of a parsed config file
+
+    Raises:
+        ValueError: If the config is malformed or names a queue twice
+    """
+    entries = config.get("queues") if isinstance(config, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("Config must have a non-empty list of queues")
+
+    routes = []
+    for n, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Queue {n} must be a mapping")
+        unknown = set(entry) - FIELDS
+        if unknown:
+            raise ValueError(f"Queue {n} has unknown fields {sorted(unknown)}")
+        if not isinstance(entry.get("queue"), str):
+            raise ValueError(f"Queue {n} needs a queue name")
+        what = f"Products of queue {entry['queue']}"
+        products = _strings(entry.get("products", ""), what)
+        if not products:
+            raise ValueError(f"Queue {entry['queue']} needs products")
+        routes.append(
+            QueueRoute(
+                queue=entry["queue"],
+                products=products,
+                stac=bool(entry.get("stac", False)),
+                odc_metadata_link=entry.get("odc_metadata_link"),
+                record_path=_strings(
+                    entry.get("record_path") or [],
+                    f"Record path of queue {entry['queue']}",
+                ),
+                region_code_list_uri=entry.get("region_code_list_uri"),
+            )
+        )
+
+    names = [r.queue for r in routes]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Queues listed more than once: {duplicates}")
+    return routes
+
+
+def load_routes(path: str) -> List[QueueRoute]:
+    """Routes of a YAML config file
+
+    Raises:
+        ValueError: If the file is malformed or names a queue twice
+    """
+    with open(path) as f:
+        try:
+            config = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Can't parse {path}: {e}")
+    return parse_routes(config)
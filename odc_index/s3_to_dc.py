@@ -4,57 +4,134 @@ and index datasets found into RDS
 """
 import logging
 import sys
-from typing import Tuple
+from functools import partial
+from typing import TYPE_CHECKING, Tuple
 
 import click
-from datacube import Datacube
-from datacube.utils import changes
-from odc.aio import S3Fetcher, s3_find_glob
-from odc.index import from_yaml_doc_stream
-from odc.index.stac import stac_transform
+
+from odc_index.cache import DocumentCache
+from odc_index.control import AIMDController
+from odc_index.datasets import doc_stream_to_datasets
+from odc_index.db import add_datasets_if_absent, bulk_unchanged, update_datasets
+from odc_index.fetch import fetch_s3_urls
+from odc_index.journal import FailureJournal
+from odc_index.listing import DEFAULT_LIST_PARALLELISM, s3_find_parallel, s3_find_shard
+from odc_index.logs import RateLog, setup_logging
+from odc_index.predicates import key_filter_from_options
+from odc_index.prepared import prepare_datasets
+from odc_index.ratelimit import limiter_from_options
+from odc_index.replica import DEFAULT_MAX_LAG, ReadRouter, router_from_options
+from odc_index.shard import SHARD_BY, shard_option_callback
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+
+
+def _fetched(data_stream, journal: FailureJournal):
+    for d in data_stream:
+        if d.data is None:
+            logging.error("Failed to fetch %s", d.url)
+            journal.record(d.url, "fetch", getattr(d, "error", None) or "Fetch failed")
+        else:
+            yield d.url, d.data
 
 
 def dump_to_odc(
     data_stream,
-    dc: Datacube,
+    dc: "Datacube",
     products: list,
     transform=None,
     update=False,
     allow_unsafe=False,
+    controller: AIMDController = None,
+    journal: FailureJournal = None,
+    reads: ReadRouter = None,
     **kwargs,
-) -> Tuple[int, int]:
-    # TODO: Get right combination of flags for **kwargs in low validation/no-lineage mode
-    expand_stream = ((d.url, d.data) for d in data_stream if d.data is not None)
+) -> Tuple[int, int, int]:
+    """Add or update the datasets of fetched documents
 
-    ds_stream = from_yaml_doc_stream(
-        expand_stream, dc.index, products=products, transform=transform, **kwargs
+    Returns:
+        tuple -- Numbers of datasets written, failed and, in update mode,
+        skipped as unchanged
+    """
+    from datacube.utils import changes
+
+    if journal is None:
+        journal = FailureJournal(None)
+
+    ds_stream = doc_stream_to_datasets(
+        _fetched(data_stream, journal),
+        dc.index,
+        products=products,
+        transform=transform,
+        reads=reads,
+        **kwargs,
     )
+    if controller is None:
+        controller = AIMDController()
+
+    # Datasets another indexer added first
+    present = set()
+
+    def _write(items):
+        # One call and one transaction per batch
+        datasets = [ds for _, ds in items]
+        if update:
+            updates = {}
+            if allow_unsafe:
+                updates = {tuple(): changes.allow_any}
+            update_datasets(dc, datasets, updates_allowed=updates)
+        else:
+            added = add_datasets_if_absent(dc, datasets)
+            present.update(ds.id for ds in datasets if ds.id not in added)
+
     ds_added = 0
     ds_failed = 0
-    # Consume chained streams to DB
-    for result in ds_stream:
-        ds, err = result
-        if err is not None:
-            logging.error(err)
-            ds_failed += 1
-        else:
-            logging.info(ds)
-            # TODO: Potentially wrap this in transactions and batch to DB
-            # TODO: Capture UUID's from dataset doc and perform a bulk has
-            try:
-                if update:
-                    updates = {}
-                    if allow_unsafe:
-                        updates = {tuple(): changes.allow_any}
-                    dc.index.datasets.update(ds, updates_allowed=updates)
+    ds_unchanged = 0
+    progress = RateLog("datasets")
+    # Consume chained streams to DB in batches sized by the controller, one
+    # per writer, so that in update mode unchanged datasets can be skipped
+    # after a single query
+    for batches in controller.rounds(ds_stream):
+        unchanged = set()
+        if update:
+            # On the primary, as a stale replica could hide a recent update
+            unchanged = bulk_unchanged(
+                dc, [ds for batch in batches for _, ds, err, _ in batch if err is None]
+            )
+        to_write = []
+        for batch in batches:
+            writes = []
+            for uri, ds, err, stage in batch:
+                if err is not None:
+                    progress.failure(err)
+                    journal.record(uri, stage, err)
+                    ds_failed += 1
+                elif ds.id in unchanged:
+                    ds_unchanged += 1
                 else:
-                    dc.index.datasets.add(ds)
-                ds_added += 1
-            except Exception as e:
-                logging.error(e)
+                    writes.append((uri, ds))
+            if writes:
+                to_write.append(writes)
+
+        for (uri, ds), err in controller.run_batches(_write, to_write):
+            if err is not None:
+                progress.failure(err)
+                journal.record(uri, "write", err, dataset_id=ds.id)
                 ds_failed += 1
+            elif ds.id in present:
+                logging.debug("Dataset %s from %s is already indexed", ds.id, uri)
+            else:
+                progress.success("Indexed %s from %s", ds.id, uri)
+                ds_added += 1
 
-    return ds_added, ds_failed
+    progress.close()
+    if ds_unchanged:
+        logging.info("Skipped updating %s unchanged datasets", ds_unchanged)
+    if present:
+        logging.info("Skipped adding %s already indexed datasets", len(present))
+
+    return ds_added, ds_failed, ds_unchanged
 
 
 @click.command("s3-to-dc")
@@ -79,6 +156,14 @@ def dump_to_odc(
     default=False,
     help="Default is no verification. Set to verify parent dataset definitions.",
 )
+@click.option(
+    "--trusted",
+    is_flag=True,
+    default=False,
+    help="Trust EO3 documents from a known producer: take the product named "
+    "in each document, skip lineage and product signature matching, and only "
+    "check that required fields are present",
+)
 @click.option(
     "--stac",
     is_flag=True,
@@ -97,19 +182,194 @@ def dump_to_odc(
     default=False,
     help="Allow unsafe changes to a dataset. Take care!",
 )
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep a local cache of fetched documents in this directory and "
+    "revalidate them with conditional requests on later runs",
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="Maximum size of the document cache in MB, least recently used "
+    "documents are evicted first",
+)
+@click.option(
+    "--target-latency",
+    type=float,
+    default=None,
+    help="Target database commit latency in seconds. If set, the write batch "
+    "size and number of writers adapt to stay under it",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=1,
+    help="Maximum number of concurrent database writers",
+)
+@click.option(
+    "--s3-rate",
+    type=float,
+    default=None,
+    help="Limit S3 GET requests to this many per second overall. The rate "
+    "is halved whenever S3 throttles requests and recovers gradually",
+)
+@click.option(
+    "--s3-prefix-rate",
+    type=float,
+    default=None,
+    help="Limit S3 GET requests to this many per second per key prefix",
+)
+@click.option(
+    "--s3-prefix-depth",
+    type=int,
+    default=1,
+    help="Number of leading key components that make up a prefix for "
+    "--s3-prefix-rate",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=shard_option_callback,
+    help="Only process shard i of N, given as 'i/N' with 0 <= i < N, so that "
+    "N replicas together cover the source exactly once",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(SHARD_BY),
+    default="key",
+    help="Assign individual keys to shards, or whole top level prefixes "
+    "below the fixed part of the URI, which avoids listing other shards' prefixes",
+)
+@click.option(
+    "--key-template",
+    default=None,
+    help="Parse fields such as {date}, {year}/{month}/{day}, {path}/{row}, "
+    "{tile} or {region} from the end of each key, e.g. "
+    "'{path}/{row}/{year}/{month}/{day}/*.yaml'. Keys that do not match "
+    "are skipped before they are fetched",
+)
+@click.option(
+    "--from-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Skip keys dated before this day, requires --key-template",
+)
+@click.option(
+    "--to-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Skip keys dated after this day, requires --key-template",
+)
+@click.option(
+    "--region-code",
+    "region_codes",
+    multiple=True,
+    help="Only index keys with this region code: the {region} or {tile} field, "
+    "or {path} and {row} joined. Can be repeated. Requires --key-template",
+)
+@click.option(
+    "--list-parallelism",
+    type=int,
+    default=DEFAULT_LIST_PARALLELISM,
+    help="Number of prefixes listed concurrently. Matching keys are fetched "
+    "while the listing runs. Set to 1 to list with s3_find_glob",
+)
+@click.option(
+    "--prepare-to",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Only prepare datasets, writing them to this file, gzip compressed "
+    "if it ends in .gz, for load-dc to bulk load later. The database is only "
+    "read, for products and, unless skipped, lineage. Lineage datasets the "
+    "documents carry are prepared too",
+)
+@click.option(
+    "--replica-env",
+    default=None,
+    help="Datacube config environment of a read-only replica of the index "
+    "database. Existence checks, product loading and lineage lookups go to it "
+    "while it is up to date, writes always go to the default environment",
+)
+@click.option(
+    "--max-replica-lag",
+    type=float,
+    default=DEFAULT_MAX_LAG,
+    help="Seconds of replication lag above which reads fall back from "
+    "--replica-env to the default environment",
+)
+@click.option(
+    "--failure-journal",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the URL, stage and error class of every failure to this "
+    "file, for replay-to-dc to retry later",
+)
+@click.option(
+    "--log-sample",
+    type=int,
+    default=0,
+    help="Log one in N successfully indexed datasets. By default only failures "
+    "and periodic summaries of rates are logged",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
 @click.argument("uri", type=str, nargs=1)
 @click.argument("product", type=str, nargs=1)
 def cli(
     skip_lineage,
     fail_on_missing_lineage,
     verify_lineage,
+    trusted,
     stac,
     update,
     allow_unsafe,
+    cache_dir,
+    cache_size,
+    target_latency,
+    max_workers,
+    s3_rate,
+    s3_prefix_rate,
+    s3_prefix_depth,
+    shard,
+    shard_by,
+    key_template,
+    from_date,
+    to_date,
+    region_codes,
+    list_parallelism,
+    prepare_to,
+    replica_env,
+    max_replica_lag,
+    failure_journal,
+    log_sample,
+    log_json,
     uri,
     product,
 ):
     """ Iterate through files in an S3 bucket and add them to datacube"""
+    from datacube import Datacube
+    from odc.aio import S3Fetcher
+    from odc.index.stac import stac_transform
+
+    setup_logging(sample_every=log_sample, json_format=log_json)
+
+    try:
+        key_filter = key_filter_from_options(
+            key_template, from_date, to_date, region_codes
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if prepare_to and update:
+        raise click.UsageError(
+            "--prepare-to can't be combined with --update, load-dc only adds"
+        )
 
     transform = None
     if stac:
@@ -119,30 +379,87 @@ def cli(
 
     # Get a generator from supplied S3 Uri for metadata definitions
     fetcher = S3Fetcher()
+    cache = None
+    if cache_dir:
+        cache = DocumentCache(cache_dir, max_size=cache_size * 1024 * 1024)
+    limiter = limiter_from_options(s3_rate, s3_prefix_rate, s3_prefix_depth)
+    if cache is not None or limiter is not None:
+        # S3Fetcher can neither revalidate a cache nor be rate limited
+        fetcher = partial(fetch_s3_urls, cache=cache, limiter=limiter)
 
     # TODO: Share Fetcher
-    s3_obj_stream = s3_find_glob(uri, False)
+    if list_parallelism > 1:
+        s3_obj_stream = s3_find_parallel(
+            uri, list_parallelism, shard=shard, by=shard_by
+        )
+    else:
+        s3_obj_stream = s3_find_shard(uri, shard, shard_by)
 
     # Extract URLs from output of iterator before passing to Fetcher
     s3_url_stream = (o.url for o in s3_obj_stream)
+    if key_filter is not None:
+        s3_url_stream = filter(key_filter, s3_url_stream)
 
     # TODO: Capture S3 URL's in batches and perform bulk_location_has
 
+    journal = FailureJournal(
+        failure_journal, "s3-to-dc", click.get_current_context().params
+    )
+
     # Consume generator and fetch YAML's
     dc = Datacube()
-    added, failed = dump_to_odc(
-        fetcher(s3_url_stream),
-        dc,
-        candidate_products,
-        skip_lineage=skip_lineage,
-        fail_on_missing_lineage=fail_on_missing_lineage,
-        verify_lineage=verify_lineage,
-        transform=transform,
-        update=update,
-        allow_unsafe=allow_unsafe,
-    )
+    reads = router_from_options(dc, replica_env, max_replica_lag)
+    if prepare_to:
+        prepared, failed = prepare_datasets(
+            doc_stream_to_datasets(
+                _fetched(fetcher(s3_url_stream), journal),
+                dc.index,
+                products=candidate_products,
+                transform=transform,
+                skip_lineage=skip_lineage,
+                fail_on_missing_lineage=fail_on_missing_lineage,
+                verify_lineage=verify_lineage,
+                trusted=trusted,
+                reads=reads,
+            ),
+            prepare_to,
+            journal,
+        )
+        print(f"Prepared {prepared} Datasets, Failed {failed} Datasets")
+    else:
+        added, failed, unchanged = dump_to_odc(
+            fetcher(s3_url_stream),
+            dc,
+            candidate_products,
+            skip_lineage=skip_lineage,
+            fail_on_missing_lineage=fail_on_missing_lineage,
+            verify_lineage=verify_lineage,
+            trusted=trusted,
+            transform=transform,
+            update=update,
+            allow_unsafe=allow_unsafe,
+            controller=AIMDController(
+                max_workers=max_workers, target_latency=target_latency
+            ),
+            journal=journal,
+            reads=reads,
+        )
+        if update:
+            print(
+                f"Updated {added} Datasets, {unchanged} unchanged, "
+                f"Failed {failed} Datasets"
+            )
+        else:
+            print(f"Added {added} Datasets, Failed {failed} Datasets")
+    journal.close()
 
-    print(f"Added {added} Datasets, Failed {failed} Datasets")
+    if limiter is not None and limiter.throttled:
+        print(f"S3 throttled {limiter.throttled} requests, which were retried")
+    if key_filter is not None:
+        print(f"Skipped {key_filter.dropped} keys outside the key filters")
+    if cache is not None:
+        print(f"Document cache: {cache.hits} unchanged, {cache.misses} fetched")
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+"""Deterministic sharding of keys and prefixes, so that several
+replicas of a job can split one source between them
+"""
+import hashlib
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+import click
+
+SHARD_BY = ("key", "prefix")
+
+
+class Shard(NamedTuple):
+    """Shard `index` (0 based) out of `count` shards"""
+
+    index: int
+    count: int
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+def parse_shard(value: str) -> Shard:
+    """Parse an 'i/N' shard specification, with 0 <= i < N
+
+    Raises:
+        ValueError: If the specification is malformed
+    """
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be of the form i/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in 0..N-1, got '{value}'")
+    return Shard(index, count)
+
+
+def shard_option_callback(ctx, param, value) -> Optional[Shard]:
+    """click callback for a --shard option"""
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def shard_of(name: str, count: int) -> int:
+    """Stable shard number of a name, independent of process and platform"""
+    digest = hashlib.md5(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def in_shard(name: str, shard: Optional[Shard]) -> bool:
+    return shard is None or shard_of(name, shard.count) == shard.index
+
+
+def top_level_prefix(url: str, root: str) -> str:
+    """First path component of url below the path of root
+
+    The root path is matched anywhere in the url path, so that THREDDS
+    catalog roots can be related to their fileServer dataset URLs.
+    Returns the whole url if it does not lie below root.
+    """
+    root_parts = [p for p in urlparse(root).path.split("/") if p and p != "catalog.xml"]
+    # Drop the service segment, e.g. thredds/catalog/... vs thredds/fileServer/...
+    if "catalog" in root_parts:
+        root_parts = root_parts[root_parts.index("catalog") + 1 :]
+    parts = [p for p in urlparse(url).path.split("/") if p]
+
+    n = len(root_parts)
+    for i in range(len(parts) - n):
+        if parts[i : i + n] == root_parts:
+            return parts[i + n]
+    return url
+
+
+def shard_name(url: str, root: str, by: str) -> str:
+    """Name a url is sharded on, either the url itself or its top level
+    prefix below root
+    """
+    if by == "prefix":
+        return top_level_prefix(url, root)
+    return url
@@ -4,22 +4,49 @@
 import json
 import logging
 import uuid
-from typing import Tuple
-from toolz import dicttoolz
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Callable, Hashable, List, Optional, Tuple
 
-import boto3
 import click
-import requests
-from datacube import Datacube
-from datacube.index.hl import Doc2Dataset
-from datacube.utils import changes, documents
-from odc.index.stac import stac_transform
 from pathlib import PurePath
 from yaml import load
-import pandas as pd
 
-# Added log handler
-logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
+from odc_index.cache import DocumentCache
+from odc_index.coalesce import CoalescingWindow, coalesce
+from odc_index.compression import read_body
+from odc_index.control import AIMDController, is_fatal, is_overload
+from odc_index.daemon import DaemonState, serve_health
+from odc_index.datasets import Doc2DatasetCache
+from odc_index.db import add_datasets_if_absent, bulk_unchanged, update_datasets
+from odc_index.fetch import fetch_url, get_object
+from odc_index.journal import FailureJournal
+from odc_index.logs import RateLog, setup_logging
+from odc_index.ratelimit import S3RateLimiter, limiter_from_options, s3_client
+from odc_index.replica import DEFAULT_MAX_LAG, ReadRouter, router_from_options
+from odc_index.routes import QueueRoute, load_routes
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+    from datacube.index.hl import Doc2Dataset
+
+# Number of S3 objects of one multi-record message fetched concurrently
+RECORD_FETCH_WORKERS = 8
+
+# Seconds received messages stay hidden from other consumers
+VISIBILITY_TIMEOUT = 60
+
+# Longest --coalesce-window. Messages are held for the window and then
+# handled, fetching documents and writing datasets, all within the visibility
+# timeout of the first message held, so three quarters of it is left for that
+MAX_COALESCE_WINDOW = VISIBILITY_TIMEOUT / 4
+
+# Options of make_doc2ds, shared by every queue of a multi-queue process
+LINEAGE_OPTIONS = (
+    "skip_lineage",
+    "fail_on_missing_lineage",
+    "verify_lineage",
+    "trusted",
+)
 
 
 class SQStoDCException(Exception):
@@ -30,23 +57,61 @@ class SQStoDCException(Exception):
     pass
 
 
-def get_messages(queue, limit):
+def get_message_batches(
+    queue,
+    limit,
+    batch_size: Callable[[], int] = lambda: 1,
+    state: DaemonState = None,
+    wait_time: Callable[[], Optional[int]] = lambda: None,
+):
+    """Yield the list of messages received by each poll of the queue
+
+    Arguments:
+        queue -- SQS queue resource
+        limit {int} -- Stop after this many messages, if set
+        batch_size {Callable} -- Returns the number of messages to ask for
+            in the next poll, at most 10
+        state {DaemonState} -- If set, keep polling an empty queue until
+            asked to stop, yielding an empty list for every empty poll
+        wait_time {Callable} -- Returns the longest the next poll may wait
+            for messages, or None for the default
+    """
     count = 0
+    default_wait = 20 if state is not None else 10
 
     while True:
+        if state is not None:
+            # In daemon mode, stop polling once asked to drain
+            if state.stopping.is_set():
+                break
+            state.beat()
+
         messages = queue.receive_messages(
-            VisibilityTimeout=60,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10,
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            MaxNumberOfMessages=min(max(batch_size(), 1), 10),
+            WaitTimeSeconds=min(default_wait, wait_time() or default_wait),
+            AttributeNames=["SentTimestamp"],
             MessageAttributeNames=["All"],
         )
 
-        if len(messages) == 0 or (limit and count >= limit):
+        if limit and count >= limit:
             break
+        elif len(messages) == 0:
+            # In daemon mode, keep long polling an empty queue
+            if state is None:
+                break
+            yield []
         else:
-            for message in messages:
-                count += 1
-                yield message
+            if limit:
+                # Anything past the limit becomes visible again on the queue
+                messages = messages[: limit - count]
+            count += len(messages)
+            yield messages
+
+
+def get_messages(queue, limit, state: DaemonState = None):
+    for messages in get_message_batches(queue, limit, state=state):
+        yield from messages
 
 
 def extract_metadata_from_message(message):
@@ -64,7 +129,55 @@ def extract_metadata_from_message(message):
         raise SQStoDCException(f"Failed to load metadata from the SQS message")
 
 
-def get_metadata_uri(metadata, transform, odc_metadata_link):
+def message_action(message, update=False, archive=False) -> str:
+    """What to do with the dataset of a message: "archive" with --archive or
+    if the message has an `action` attribute of ARCHIVED, otherwise "update"
+    with --update or "add"
+    """
+    attributes = getattr(message, "message_attributes", None) or {}
+    if archive or attributes.get("action", {}).get("StringValue") == "ARCHIVED":
+        return "archive"
+    return "update" if update else "add"
+
+
+def dataset_key(message, record_path=None) -> Optional[Hashable]:
+    """What a message is about, to coalesce messages by: the dataset id in
+    its metadata, or the matching objects of an S3 event. None if unknown
+    """
+    try:
+        metadata = extract_metadata_from_message(message)
+    except (SQStoDCException, ValueError, TypeError):
+        return None
+    if not isinstance(metadata, dict):
+        return None
+    if record_path:
+        return tuple(matching_s3_records(metadata, record_path)) or None
+    return metadata.get("id")
+
+
+def delete_messages(queue, messages: list):
+    """Delete messages in batches of ten, the most SQS takes per request"""
+    for i in range(0, len(messages), 10):
+        chunk = messages[i : i + 10]
+        response = queue.delete_messages(
+            Entries=[
+                {"Id": str(n), "ReceiptHandle": message.receipt_handle}
+                for n, message in enumerate(chunk)
+            ]
+        )
+        for failure in response.get("Failed", []):
+            logging.warning(
+                "Failed to delete message %s: %s",
+                chunk[int(failure["Id"])].message_id,
+                failure.get("Message"),
+            )
+
+
+def get_metadata_uri(metadata, transform, odc_metadata_link, cache=None):
+    import requests
+    from datacube.utils import documents
+    from toolz import dicttoolz
+
     odc_yaml_uri = None
     uri = None
 
@@ -79,7 +192,7 @@ def get_metadata_uri(metadata, transform, odc_metadata_link):
         # if odc_yaml_uri exist, it will load the metadata content from that URL
         if odc_yaml_uri:
             try:
-                content = requests.get(odc_yaml_uri).content
+                content = fetch_url(odc_yaml_uri, cache)
                 metadata = documents.parse_yaml(content)
                 uri = odc_yaml_uri
             except requests.RequestException as err:
@@ -103,45 +216,93 @@ def get_metadata_uri(metadata, transform, odc_metadata_link):
     return metadata, uri
 
 
-def get_metadata_from_s3_record(message: dict, record_path: tuple) -> Tuple[dict, str]:
-    """[summary]
+def matching_s3_records(message: dict, record_path: tuple) -> List[Tuple[str, str]]:
+    """Bucket and key of every S3 event record in a message whose key
+    matches one of the record_path patterns, or any key if there are none
+    """
+    from toolz import dicttoolz
+
+    matches = []
+    for record in message.get("Records") or []:
+        bucket_name = dicttoolz.get_in(["s3", "bucket", "name"], record)
+        key = dicttoolz.get_in(["s3", "object", "key"], record)
+        if bucket_name and key:
+            if (
+                record_path is None
+                or len(record_path) == 0
+                or any([PurePath(key).match(p) for p in record_path])
+            ):
+                matches.append((bucket_name, key))
+    return matches
+
+
+def _load_s3_metadata(
+    s3, bucket_name: str, key: str, limiter: S3RateLimiter = None
+) -> Tuple[dict, str]:
+    try:
+        obj = get_object(s3, bucket_name, key, limiter, ResponseCacheControl="no-cache")
+        body = read_body(obj["Body"], key, obj.get("ContentEncoding"))
+        return load(body), get_s3_url(bucket_name, key)
+    except Exception as e:
+        raise SQStoDCException(
+            f"Exception thrown when trying to load s3 object: '{e}'\n"
+        )
+
+
+def get_metadata_from_s3_records(
+    message: dict,
+    record_path: tuple,
+    workers: int = RECORD_FETCH_WORKERS,
+    limiter: S3RateLimiter = None,
+) -> List[Tuple[dict, str]]:
+    """Fetch the metadata document of every matching record in an S3 event
+    message, concurrently
 
     Args:
-        message (dict): [description]
-        record_path (tuple): [PATH for filtering s3 key path]
+        message (dict): S3 event notification
+        record_path (tuple): Patterns the object keys must match
+        workers (int): Objects fetched concurrently
+        limiter (S3RateLimiter): Optional limiter of S3 request rates
 
     Raises:
-        SQStoDCException: [Catch s3 ]
+        SQStoDCException: If any of the objects could not be loaded
 
     Returns:
-        Tuple[dict, str]: [description]
+        List[Tuple[dict, str]]: (metadata, uri) of each matching record
     """
-    data = None
-    uri = None
+    records = matching_s3_records(message, record_path)
+    if not records:
+        return []
 
-    if message.get("Records"):
-        for record in message.get("Records"):
-            bucket_name = dicttoolz.get_in(["s3", "bucket", "name"], record)
-            key = dicttoolz.get_in(["s3", "object", "key"], record)
-            if bucket_name and key:
-                if (
-                    record_path is None
-                    or len(record_path) == 0
-                    or any([PurePath(key).match(p) for p in record_path])
-                ):
-                    try:
-                        s3 = boto3.resource("s3")
-                        obj = s3.Object(bucket_name, key).get(
-                            ResponseCacheControl="no-cache"
-                        )
-                        data = load(obj["Body"].read())
-                        uri = get_s3_url(bucket_name, key)
-                    except Exception as e:
-                        raise SQStoDCException(
-                            f"Exception thrown when trying to load s3 object: '{e}'\n"
-                        )
+    # Clients, unlike resources, are safe to share between threads
+    s3 = s3_client(limiter)
+    if len(records) == 1:
+        return [_load_s3_metadata(s3, *records[0], limiter)]
+    with ThreadPoolExecutor(max_workers=min(workers, len(records))) as executor:
+        return list(executor.map(lambda r: _load_s3_metadata(s3, *r, limiter), records))
+
+
+def get_metadata_from_s3_record(
+    message: dict, record_path: tuple, limiter: S3RateLimiter = None
+) -> Tuple[dict, str]:
+    """Metadata and URI of the last matching record in an S3 event message,
+    see get_metadata_from_s3_records for all of them
+
+    Args:
+        message (dict): S3 event notification
+        record_path (tuple): Patterns the object keys must match
+        limiter (S3RateLimiter): Optional limiter of S3 request rates
+
+    Raises:
+        SQStoDCException: If the object could not be loaded
 
-    return data, uri
+    Returns:
+        Tuple[dict, str]: (metadata, uri), or (None, None) if nothing matched
+    """
+    records = matching_s3_records(message, record_path)
+    if not records:
+        return None, None
+    return _load_s3_metadata(s3_client(limiter), *records[-1], limiter)
 
 
 def get_s3_url(bucket_name, obj_key):
@@ -159,7 +320,7 @@ def get_uri(metadata, rel_value):
     return uri
 
 
-def do_archiving(metadata, dc: Datacube):
+def do_archiving(metadata, dc: "Datacube"):
     ids = [uuid.UUID(metadata.get("id"))]
     if ids:
         dc.index.datasets.archive(ids)
@@ -167,42 +328,83 @@ def do_archiving(metadata, dc: Datacube):
         raise SQStoDCException("Archive skipped as failed to get ID")
 
 
+def _to_dataset(metadata: dict, uri, doc2ds: "Doc2Dataset"):
+    if uri is None:
+        raise SQStoDCException("Failed to get URI from metadata doc")
+    try:
+        ds, err = doc2ds(metadata, uri)
+    except ValueError as e:
+        raise SQStoDCException(
+            f"Exception thrown when trying to create dataset: '{e}'\n The URI was {uri}"
+        )
+    if ds is None:
+        raise SQStoDCException(
+            f"Failed to create dataset with error {err}\n The URI was {uri}"
+        )
+    return ds
+
+
+def index_datasets(
+    datasets: List[Tuple[dict, str]],
+    dc: "Datacube",
+    doc2ds: "Doc2Dataset",
+    update=False,
+    allow_unsafe=False,
+):
+    """Add or update the (metadata, uri) of every dataset of a message in a
+    single transaction, so that a message is indexed either whole or not
+    """
+    from datacube.utils import changes
+
+    batch = [_to_dataset(metadata, uri, doc2ds) for metadata, uri in datasets]
+    if update:
+        unchanged = bulk_unchanged(dc, batch)
+        for ds in batch:
+            if ds.id in unchanged:
+                logging.info("Dataset %s is unchanged, not updating", ds.id)
+        batch = [ds for ds in batch if ds.id not in unchanged]
+        if batch:
+            updates = {}
+            if allow_unsafe:
+                updates = {tuple(): changes.allow_any}
+            update_datasets(dc, batch, updates_allowed=updates)
+    else:
+        added = add_datasets_if_absent(dc, batch)
+        for ds in batch:
+            if ds.id not in added:
+                # e.g. a redelivered message, which is handled all the same
+                logging.info("Dataset %s is already indexed", ds.id)
+
+
 def do_indexing(
     metadata: dict,
     uri,
-    dc: Datacube,
-    doc2ds: Doc2Dataset,
+    dc: "Datacube",
+    doc2ds: "Doc2Dataset",
     update=False,
     allow_unsafe=False,
 ):
-    if uri is not None:
-        try:
-            ds, err = doc2ds(metadata, uri)
-        except ValueError as e:
-            raise SQStoDCException(
-                f"Exception thrown when trying to create dataset: '{e}'\n The URI was {uri}"
-            )
-        if ds is not None:
-            if update:
-                updates = {}
-                if allow_unsafe:
-                    updates = {tuple(): changes.allow_any}
-                dc.index.datasets.update(ds, updates_allowed=updates)
-            else:
-                if dc.index.datasets.get(metadata.get("id")):
-                    raise SQStoDCException("Dataset already exists, not indexing")
-                dc.index.datasets.add(ds)
-        else:
-            raise SQStoDCException(
-                f"Failed to create dataset with error {err}\n The URI was {uri}"
-            )
-    else:
-        raise SQStoDCException("Failed to get URI from metadata doc")
+    index_datasets([(metadata, uri)], dc, doc2ds, update, allow_unsafe)
+
+
+def load_region_codes(region_code_list_uri: str) -> set:
+    import pandas as pd
+
+    region_codes = None
+    try:
+        region_codes = set(pd.read_csv(region_code_list_uri).values.ravel())
+    except FileNotFoundError as e:
+        logging.error(f"Could not find region_code file with error: {e}")
+    assert (
+        region_codes is not None and len(region_codes) > 0
+    ), f"No items found in the region_code list at URI: {region_code_list_uri}"
+    logging.info(f"Loaded a list of {len(region_codes)} region_codes ")
+    return region_codes
 
 
 def queue_to_odc(
     queue,
-    dc: Datacube,
+    dc: "Datacube",
     products: list,
     record_path=None,
     transform=None,
@@ -212,69 +414,268 @@ def queue_to_odc(
     allow_unsafe=False,
     odc_metadata_link=False,
     region_code_list_uri=None,
+    cache=None,
+    controller: AIMDController = None,
+    state: DaemonState = None,
+    journal: FailureJournal = None,
+    limiter: S3RateLimiter = None,
+    coalesce_window: float = 0,
+    reads: ReadRouter = None,
+    resolvers: Doc2DatasetCache = None,
     **kwargs,
 ) -> Tuple[int, int]:
+    from toolz import dicttoolz
 
     ds_success = 0
     ds_failed = 0
+    ds_coalesced = 0
 
     region_codes = None
     if region_code_list_uri:
-        try:
-            region_codes = set(pd.read_csv(region_code_list_uri).values.ravel())
-        except FileNotFoundError as e:
-            logging.error(f"Could not find region_code file with error: {e}")
-        assert (
-            len(region_codes) > 0
-        ), f"No items found in the region_code list at URI: {region_code_list_uri}"
-        logging.info(f"Loaded a list of {len(region_codes)} region_codes ")
+        region_codes = load_region_codes(region_code_list_uri)
+
+    if reads is None:
+        reads = ReadRouter(dc)
+    if resolvers is None:
+        resolvers = Doc2DatasetCache(dc.index, reads=reads, **kwargs)
+    doc2ds = resolvers.get(products)
 
-    doc2ds = Doc2Dataset(dc.index, products=products, **kwargs)
+    if controller is None:
+        controller = AIMDController(batch_size=1, min_batch_size=1, max_batch_size=10)
+    if journal is None:
+        journal = FailureJournal(None)
 
-    # This is a generator of messages
-    messages = get_messages(queue, limit)
+    # Number of datasets handled per message, for multi-record messages
+    handled = {}
+    progress = RateLog("messages")
 
-    for message in messages:
+    def _process(message):
+        stage = "message"
         try:
             # Extract metadata from message
             metadata = extract_metadata_from_message(message)
-            if archive:
+            action = message_action(message, update, archive)
+            if action == "archive":
                 # Archive metadata
+                stage = "write"
                 do_archiving(metadata, dc)
+                datasets = [(metadata, None)]
             else:
+                stage = "fetch"
                 if not record_path:
                     # Extract metadata and URI for indexing
-                    metadata, uri = get_metadata_uri(
-                        metadata, transform, odc_metadata_link
-                    )
+                    datasets = [
+                        get_metadata_uri(metadata, transform, odc_metadata_link, cache)
+                    ]
                 else:
-                    metadata, uri = get_metadata_from_s3_record(metadata, record_path)
+                    # Every matching record of an S3 event is a dataset
+                    datasets = get_metadata_from_s3_records(
+                        metadata, record_path, limiter=limiter
+                    )
+                    if not datasets:
+                        raise SQStoDCException(
+                            "No S3 records matching the record path in message"
+                        )
 
                 # If we have a region_code filter, do it here
                 if region_code_list_uri:
-                    region_code = dicttoolz.get_in(
-                        ["properties", "odc:region_code"], metadata
-                    )
-                    if region_code not in region_codes:
+                    allowed = [
+                        (m, u)
+                        for m, u in datasets
+                        if dicttoolz.get_in(["properties", "odc:region_code"], m)
+                        in region_codes
+                    ]
+                    if not allowed:
+                        region_code = dicttoolz.get_in(
+                            ["properties", "odc:region_code"], datasets[-1][0]
+                        )
                         # We  don't want to keep this one, so delete the message
                         message.delete()
-                        # And fail it...
+                        # And fail it, without journalling it for replay
+                        stage = None
                         raise SQStoDCException(
                             f"Region code {region_code} not in list of allowed region codes, ignoring this dataset."
                         )
+                    datasets = allowed
+
+                # Index the datasets on the primary, which skips any already
+                # indexed itself rather than trusting a possibly stale replica
+                stage = "write"
+                index_datasets(datasets, dc, doc2ds, action == "update", allow_unsafe)
+        except Exception as e:
+            if stage is not None:
+                dataset_id = None
+                if stage == "write" and metadata:
+                    dataset_id = metadata.get("id")
+                journal.record(
+                    message.message_id,
+                    stage,
+                    e,
+                    dataset_id=dataset_id,
+                    body=message.body,
+                    attributes=getattr(message, "message_attributes", None),
+                )
+            raise
+        # Success of every dataset in the message, so delete it.
+        handled[message.message_id] = len(datasets)
+        message.delete()
+
+    # This is a generator of lists of messages, one per poll of the queue
+    if coalesce_window:
+        # or one per window, polling for as many messages as possible
+        window = CoalescingWindow(coalesce_window)
+        batches = window.groups(
+            get_message_batches(queue, limit, lambda: 10, state, window.wait_time)
+        )
+    else:
+        batches = get_message_batches(
+            queue, limit, lambda: controller.batch_size, state
+        )
+    if state is not None:
+        state.ready = True
+
+    for batch in batches:
+        if state is not None and state.refresh_due(queue):
+            # Pick up product and region code changes in long running daemons,
+            # reloading products once per interval for queues that share them
+            logging.info("Refreshing products and region codes")
+            resolvers.get(products, max_age=state.refresh_interval / 2)
+            if region_code_list_uri:
+                region_codes = load_region_codes(region_code_list_uri)
+        doc2ds = resolvers.get(products)
+        if not batch:
+            continue
+
+        superseded = {}
+        if coalesce_window:
+            # Only the final message about each dataset is handled
+            groups = coalesce(batch, lambda m: dataset_key(m, record_path))
+            batch = [final for final, _ in groups]
+            superseded = {final.message_id: older for final, older in groups}
+
+        acknowledged = []
+        for message, err in controller.run(_process, batch):
+            if err is None:
+                ds_success += handled.pop(message.message_id, 1)
+                acknowledged.extend(superseded.get(message.message_id, []))
+                progress.success("Handled message %s", message.message_id)
+            elif isinstance(err, SQStoDCException) or is_overload(err):
+                # Messages that failed on an overloaded database are left
+                # on the queue to be retried once the controller backs off
+                progress.failure(err)
+                ds_failed += 1
+            elif is_fatal(err):
+                raise err
+            else:
+                # A bad message mustn't stop a daemon. It becomes visible
+                # again and after enough receives the queue's redrive policy
+                # moves it to the dead letter queue
+                progress.failure(
+                    "Unexpected error handling message %s: %r", message.message_id, err
+                )
+                logging.debug(
+                    "Traceback of message %s", message.message_id, exc_info=err
+                )
+                ds_failed += 1
 
-            # Index the dataset
-            do_indexing(metadata, uri, dc, doc2ds, update, allow_unsafe)
-            ds_success += 1
-            # Success, so delete the message.
-            message.delete()
-        except SQStoDCException as err:
-            logging.error(err)
-            ds_failed += 1
+        # Messages superseded by a failed one stay on the queue with it
+        if acknowledged:
+            delete_messages(queue, acknowledged)
+            ds_coalesced += len(acknowledged)
 
+    progress.close()
+    if ds_coalesced:
+        logging.info("Coalesced %s superseded messages", ds_coalesced)
     return ds_success, ds_failed
 
 
+def queues_to_odc(
+    routes: List[QueueRoute],
+    dc: "Datacube",
+    make_controller: Callable[[], AIMDController],
+    state: DaemonState = None,
+    journal: FailureJournal = None,
+    **kwargs,
+) -> Tuple[int, int]:
+    """Index from several queues at once, each polled by its own thread with
+    the products, transform, record path and region filter of its route
+
+    The threads share the database connection pool and product cache of
+    `dc`, the document cache, rate limiter, daemon state and journal, and
+    one Doc2Dataset per distinct product list. Other arguments are passed to
+    queue_to_odc for every queue, so a limit applies to each queue separately.
+
+    Arguments:
+        make_controller {Callable} -- Returns a new controller for a queue
+
+    Returns:
+        tuple -- Numbers of datasets handled and failed across all queues
+    """
+    import boto3
+    from odc.index.stac import stac_transform
+
+    if journal is None:
+        journal = FailureJournal(None)
+    lineage = {
+        option: kwargs.pop(option) for option in LINEAGE_OPTIONS if option in kwargs
+    }
+    resolvers = Doc2DatasetCache(dc.index, reads=kwargs.get("reads"), **lineage)
+
+    sqs = boto3.resource("sqs")
+    queues = [sqs.get_queue_by_name(QueueName=route.queue) for route in routes]
+
+    def _run(route: QueueRoute, queue) -> Tuple[int, int]:
+        route_journal = journal.part(route.params())
+        try:
+            return queue_to_odc(
+                queue,
+                dc,
+                list(route.products),
+                record_path=route.record_path,
+                transform=stac_transform if route.stac else None,
+                odc_metadata_link=route.odc_metadata_link,
+                region_code_list_uri=route.region_code_list_uri,
+                controller=make_controller(),
+                state=state,
+                journal=route_journal,
+                resolvers=resolvers,
+                **kwargs,
+            )
+        finally:
+            route_journal.close()
+
+    success, failed = 0, 0
+    error = None
+    with ThreadPoolExecutor(max_workers=len(routes)) as executor:
+        futures = {
+            executor.submit(_run, route, queue): route
+            for route, queue in zip(routes, queues)
+        }
+        for future in as_completed(futures):
+            route = futures[future]
+            try:
+                route_success, route_failed = future.result()
+            except Exception as e:
+                logging.error("Stopped indexing from %s: %s", route.queue, e)
+                if state is not None:
+                    # Drain the other queues rather than serve only some
+                    state.stopping.set()
+                error = error or e
+                continue
+            logging.info(
+                "Handled %s datasets from %s, %s failed",
+                route_success,
+                route.queue,
+                route_failed,
+            )
+            success += route_success
+            failed += route_failed
+
+    if error is not None:
+        raise error
+    return success, failed
+
+
 @click.command("sqs-to-dc")
 @click.option(
     "--skip-lineage",
@@ -297,6 +698,22 @@ def queue_to_odc(
     default=False,
     help="Default is no verification. Set to verify parent dataset definitions.",
 )
+@click.option(
+    "--trusted",
+    is_flag=True,
+    default=False,
+    help="Trust EO3 documents from a known producer: take the product named "
+    "in each document, skip lineage and product signature matching, and only "
+    "check that required fields are present",
+)
+@click.option(
+    "--config",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Poll every queue listed in this YAML file, each with its own "
+    "products, --stac, --odc-metadata-link, --record-path and "
+    "--region-code-list-uri, instead of QUEUE_NAME for PRODUCT",
+)
 @click.option(
     "--stac",
     is_flag=True,
@@ -347,12 +764,125 @@ def queue_to_odc(
     default=None,
     help="A path to a list (one item per line, in txt or gzip format) of valide region_codes to include",
 )
-@click.argument("queue_name", type=str, nargs=1)
-@click.argument("product", type=str, nargs=1)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep a local cache of documents fetched through --odc-metadata-link "
+    "in this directory and revalidate them with conditional requests",
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="Maximum size of the document cache in MB, least recently used "
+    "documents are evicted first",
+)
+@click.option(
+    "--target-latency",
+    type=float,
+    default=None,
+    help="Target database commit latency in seconds. If set, the number of "
+    "messages handled per batch and concurrently adapt to stay under it",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=1,
+    help="Maximum number of messages handled concurrently",
+)
+@click.option(
+    "--coalesce-window",
+    type=float,
+    default=0,
+    help="Hold messages for up to this many seconds and only handle the "
+    "latest sent about each dataset, acknowledging the ones it supersedes. "
+    "An `action` message attribute of ARCHIVED archives the dataset. At most "
+    f"{MAX_COALESCE_WINDOW:g} seconds, leaving the rest of the "
+    f"{VISIBILITY_TIMEOUT} second visibility timeout to handle held messages "
+    "before they reappear to other consumers",
+)
+@click.option(
+    "--s3-rate",
+    type=float,
+    default=None,
+    help="Limit S3 GET requests to this many per second overall. The rate "
+    "is halved whenever S3 throttles requests and recovers gradually",
+)
+@click.option(
+    "--s3-prefix-rate",
+    type=float,
+    default=None,
+    help="Limit S3 GET requests to this many per second per key prefix",
+)
+@click.option(
+    "--s3-prefix-depth",
+    type=int,
+    default=1,
+    help="Number of leading key components that make up a prefix for "
+    "--s3-prefix-rate",
+)
+@click.option(
+    "--daemon",
+    is_flag=True,
+    default=False,
+    help="Keep long polling the queue instead of exiting once it is empty. "
+    "SIGTERM stops polling and lets in-flight messages finish",
+)
+@click.option(
+    "--health-port",
+    type=int,
+    default=None,
+    help="In daemon mode, serve /healthz and /readyz on this port",
+)
+@click.option(
+    "--refresh-interval",
+    type=int,
+    default=600,
+    help="In daemon mode, seconds between reloading products and region codes",
+)
+@click.option(
+    "--replica-env",
+    default=None,
+    help="Datacube config environment of a read-only replica of the index "
+    "database. Existence checks, product loading and lineage lookups go to it "
+    "while it is up to date, writes always go to the default environment",
+)
+@click.option(
+    "--max-replica-lag",
+    type=float,
+    default=DEFAULT_MAX_LAG,
+    help="Seconds of replication lag above which reads fall back from "
+    "--replica-env to the default environment",
+)
+@click.option(
+    "--failure-journal",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the message id, stage and error class of every failure to "
+    "this file, for replay-to-dc to retry later",
+)
+@click.option(
+    "--log-sample",
+    type=int,
+    default=0,
+    help="Log one in N successfully indexed messages. By default only failures "
+    "and periodic summaries of rates are logged",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
+@click.argument("queue_name", type=str, nargs=1, required=False)
+@click.argument("product", type=str, nargs=1, required=False)
 def cli(
     skip_lineage,
     fail_on_missing_lineage,
     verify_lineage,
+    trusted,
+    config,
     stac,
     odc_metadata_link,
     limit,
@@ -361,39 +891,125 @@ def cli(
     allow_unsafe,
     record_path,
     region_code_list_uri,
+    cache_dir,
+    cache_size,
+    target_latency,
+    max_workers,
+    coalesce_window,
+    s3_rate,
+    s3_prefix_rate,
+    s3_prefix_depth,
+    daemon,
+    health_port,
+    refresh_interval,
+    replica_env,
+    max_replica_lag,
+    failure_journal,
+    log_sample,
+    log_json,
     queue_name,
     product,
 ):
     """ Iterate through messages on an SQS queue and add them to datacube"""
+    import boto3
+    from datacube import Datacube
+    from odc.index.stac import stac_transform
 
-    transform = None
-    if stac:
-        transform = stac_transform
+    setup_logging(sample_every=log_sample, json_format=log_json)
 
-    candidate_products = product.split()
+    routes = None
+    if config:
+        if (
+            queue_name
+            or product
+            or stac
+            or odc_metadata_link
+            or record_path
+            or region_code_list_uri
+        ):
+            raise click.UsageError(
+                "QUEUE_NAME, PRODUCT, --stac, --odc-metadata-link, --record-path "
+                "and --region-code-list-uri are set per queue in --config"
+            )
+        try:
+            routes = load_routes(config)
+        except ValueError as e:
+            raise click.UsageError(f"Invalid --config: {e}")
+    elif not (queue_name and product):
+        raise click.UsageError("QUEUE_NAME and PRODUCT are required without --config")
+    if coalesce_window < 0 or coalesce_window > MAX_COALESCE_WINDOW:
+        raise click.BadParameter(
+            f"must be between 0 and {MAX_COALESCE_WINDOW:g} seconds, so that "
+            "held messages are handled while hidden from other consumers",
+            param_hint="--coalesce-window",
+        )
 
-    sqs = boto3.resource("sqs")
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
+    cache = None
+    if cache_dir:
+        cache = DocumentCache(cache_dir, max_size=cache_size * 1024 * 1024)
 
-    # Do the thing
-    dc = Datacube()
-    success, failed = queue_to_odc(
-        queue,
-        dc,
-        candidate_products,
+    state = None
+    if daemon:
+        state = DaemonState(refresh_interval=refresh_interval)
+        state.install_signal_handlers()
+        if health_port:
+            serve_health(state, health_port)
+
+    journal = FailureJournal(
+        failure_journal, "sqs-to-dc", click.get_current_context().params
+    )
+
+    def _controller():
+        return AIMDController(
+            batch_size=1,
+            min_batch_size=1,
+            max_batch_size=10,
+            max_workers=max_workers,
+            target_latency=target_latency,
+        )
+
+    # Options shared by every queue
+    shared = dict(
         skip_lineage=skip_lineage,
         fail_on_missing_lineage=fail_on_missing_lineage,
         verify_lineage=verify_lineage,
-        transform=transform,
+        trusted=trusted,
         limit=limit,
         update=update,
         archive=archive,
         allow_unsafe=allow_unsafe,
-        record_path=record_path,
-        odc_metadata_link=odc_metadata_link,
-        region_code_list_uri=region_code_list_uri,
+        cache=cache,
+        state=state,
+        journal=journal,
+        limiter=limiter_from_options(s3_rate, s3_prefix_rate, s3_prefix_depth),
+        coalesce_window=coalesce_window,
     )
 
+    # Do the thing
+    dc = Datacube()
+    shared["reads"] = router_from_options(dc, replica_env, max_replica_lag)
+    if routes is not None:
+        success, failed = queues_to_odc(routes, dc, _controller, **shared)
+    else:
+        transform = None
+        if stac:
+            transform = stac_transform
+
+        sqs = boto3.resource("sqs")
+        queue = sqs.get_queue_by_name(QueueName=queue_name)
+        success, failed = queue_to_odc(
+            queue,
+            dc,
+            product.split(),
+            transform=transform,
+            record_path=record_path,
+            odc_metadata_link=odc_metadata_link,
+            region_code_list_uri=region_code_list_uri,
+            controller=_controller(),
+            **shared,
+        )
+    journal.close()
+
     result_msg = ""
     if update:
         result_msg += f"Updated {success} Dataset(s), "
@@ -5,14 +5,38 @@ import json
 import logging
 import os
 import sys
-from typing import Any, Dict, Generator, Iterable, List, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
 
 import click
-from datacube import Datacube
-from datacube.index.hl import Doc2Dataset
-from datacube.utils import changes
-from odc.index.stac import stac_transform, stac_transform_absolute
-from satsearch import Search
+
+from odc_index.control import AIMDController
+from odc_index.datasets import make_doc2ds
+from odc_index.db import add_datasets_if_absent, bulk_unchanged, update_datasets
+from odc_index.harvest import (
+    DEFAULT_OVERLAP_HOURS,
+    WATERMARK_FIELDS,
+    HarvestState,
+    Watermark,
+    format_time,
+)
+from odc_index.journal import FailureJournal
+from odc_index.logs import RateLog, setup_logging
+from odc_index.replica import DEFAULT_MAX_LAG, ReadRouter, router_from_options
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+    from datacube.index.hl import Doc2Dataset
+    from satsearch import Search
 
 
 def guess_location(metadata: dict) -> Tuple[str, bool]:
@@ -44,7 +68,7 @@ def guess_location(metadata: dict) -> Tuple[str, bool]:
 
 
 def get_items(
-    srch: Search, limit: bool
+    srch: "Search", limit: bool
 ) -> Generator[Tuple[dict, str, bool], None, None]:
     if limit:
         items = srch.items(limit=limit)
@@ -57,8 +81,10 @@ def get_items(
 
 
 def transform_items(
-    doc2ds: Doc2Dataset, items: Iterable[Tuple[Dict[str, Any], str, bool]]
+    doc2ds: "Doc2Dataset", items: Iterable[Tuple[Dict[str, Any], str, bool]]
 ) -> Generator[Tuple[dict, str], None, None]:
+    from odc.index.stac import stac_transform, stac_transform_absolute
+
     for metadata, uri, relative in items:
         try:
             if relative:
@@ -67,7 +93,7 @@ def transform_items(
                 metadata = stac_transform_absolute(metadata)
         except KeyError as e:
             logging.error(
-                f"Failed to handle item with KeyError: '{e}'\n The URI was {uri}"
+                "Failed to handle item with KeyError: '%s'\n The URI was %s", e, uri
             )
             yield None, uri
             continue
@@ -76,51 +102,131 @@ def transform_items(
             ds, err = doc2ds(metadata, uri)
         except ValueError as e:
             logging.error(
-                f"Exception thrown when trying to create dataset: '{e}'\n The URI was {uri}"
+                "Exception thrown when trying to create dataset: '%s'\n The URI was %s",
+                e,
+                uri,
             )
+            ds, err = None, e
         if ds is not None:
             yield ds, uri
         else:
             logging.error(
-                f"Failed to create dataset with error {err}\n The URI was {uri}"
+                "Failed to create dataset with error %s\n The URI was %s", err, uri
             )
             yield None, uri
 
 
 def index_update_datasets(
-    dc: Datacube, datasets: Tuple[dict, str], update: bool, allow_unsafe: bool
-) -> Tuple[int, int]:
+    dc: "Datacube",
+    datasets: Tuple[dict, str],
+    update: bool,
+    allow_unsafe: bool,
+    controller: AIMDController = None,
+    journal: FailureJournal = None,
+    watermark: Watermark = None,
+) -> Tuple[int, int, int]:
+    """Add or update datasets
+
+    Returns:
+        tuple -- Numbers of datasets written, failed and, in update mode,
+        skipped as unchanged
+    """
+    from datacube.utils import changes
+
     ds_added = 0
     ds_failed = 0
-
-    for dataset, uri in datasets:
-        if uri is not None:
-            if dataset is not None:
-                if update:
-                    updates = {}
-                    if allow_unsafe:
-                        updates = {tuple(): changes.allow_any}
-                    dc.index.datasets.update(dataset, updates_allowed=updates)
+    ds_unchanged = 0
+
+    if controller is None:
+        controller = AIMDController()
+    if journal is None:
+        journal = FailureJournal(None)
+    progress = RateLog("datasets")
+
+    # Datasets another indexer added first
+    present = set()
+
+    def _write(items):
+        # One call and one transaction per batch
+        batch = [dataset for dataset, _ in items]
+        if update:
+            updates = {}
+            if allow_unsafe:
+                updates = {tuple(): changes.allow_any}
+            update_datasets(dc, batch, updates_allowed=updates)
+        else:
+            added = add_datasets_if_absent(dc, batch)
+            present.update(ds.id for ds in batch if ds.id not in added)
+
+    # One batch per writer, and in update mode a single query per round to
+    # find unchanged datasets
+    for batches in controller.rounds(datasets):
+        unchanged = set()
+        if update:
+            # On the primary, as a stale replica could hide a recent update
+            unchanged = bulk_unchanged(
+                dc,
+                [
+                    dataset
+                    for batch in batches
+                    for dataset, uri in batch
+                    if dataset is not None
+                ],
+            )
+        to_write = []
+        for batch in batches:
+            writes = []
+            for dataset, uri in batch:
+                if uri is not None and dataset is not None:
+                    if dataset.id in unchanged:
+                        ds_unchanged += 1
+                    else:
+                        writes.append((dataset, uri))
                 else:
-                    ds_added += 1
-                    dc.index.datasets.add(dataset)
-            else:
+                    if uri is not None:
+                        journal.record(uri, "dataset", "Failed to create dataset")
+                    if watermark is not None:
+                        watermark.failed(uri)
+                    ds_failed += 1
+            if writes:
+                to_write.append(writes)
+
+        for (dataset, uri), err in controller.run_batches(_write, to_write):
+            if err is not None:
+                progress.failure(err)
+                journal.record(uri, "write", err, dataset_id=dataset.id)
+                if watermark is not None:
+                    watermark.failed(uri)
                 ds_failed += 1
-        else:
-            ds_failed += 1
+            elif dataset.id in present:
+                logging.debug("Dataset %s from %s is already indexed", dataset.id, uri)
+            else:
+                progress.success("Indexed %s from %s", dataset.id, uri)
+                ds_added += 1
 
-    return ds_added, ds_failed
+    progress.close()
+    if ds_unchanged:
+        logging.info("Skipped updating %s unchanged datasets", ds_unchanged)
+    if present:
+        logging.info("Skipped adding %s already indexed datasets", len(present))
+    return ds_added, ds_failed, ds_unchanged
 
 
 def stac_api_to_odc(
-    dc: Datacube,
+    dc: "Datacube",
     products: list,
     limit: int,
     update: bool,
     allow_unsafe: bool,
     config: dict,
+    controller: AIMDController = None,
+    journal: FailureJournal = None,
+    watermark: Watermark = None,
+    reads: ReadRouter = None,
     **kwargs,
-) -> Tuple[int, int]:
+) -> Tuple[int, int, int]:
+    from satsearch import Search
+
     # QA the BBOX
     if config["bbox"]:
         assert (
@@ -136,19 +242,109 @@ def stac_api_to_odc(
             "More than 10,000 items were returned by your query, which is greater than the API limit"
         )
 
+    if watermark is not None:
+        watermark.search(n_items)
     if n_items == 0:
         logging.warning("Didn't find any items, finishing.")
-        return 0, 0
+        return 0, 0, 0
 
     # Get a generator of (stac, uri, relative_uri) tuples
     potential_items = get_items(srch, limit)
+    if watermark is not None:
+        potential_items = watermark.track(potential_items)
 
     # Get a generator of (dataset, uri)
-    doc2ds = Doc2Dataset(dc.index, **kwargs)
+    doc2ds = make_doc2ds(dc.index, reads=reads, **kwargs)
     datasets = transform_items(doc2ds, potential_items)
 
     # Do the indexing of all the things
-    return index_update_datasets(dc, datasets, update, allow_unsafe)
+    return index_update_datasets(
+        dc, datasets, update, allow_unsafe, controller, journal, watermark
+    )
+
+
+def _harvest_search(
+    config: dict, collection: Optional[str], field: str, since: Optional[datetime]
+) -> dict:
+    """Search for the items of a collection from `since` on, oldest first"""
+    search = dict(config, collections=[collection] if collection else None)
+    search["sortby"] = [{"field": f"properties.{field}", "direction": "asc"}]
+    if since is not None:
+        if field == "datetime":
+            now = datetime.now(timezone.utc)
+            search["datetime"] = f"{format_time(since)}/{format_time(now)}"
+        else:
+            search["query"] = {"updated": {"gte": format_time(since)}}
+    return search
+
+
+def harvest(
+    dc: "Datacube",
+    products: list,
+    update: bool,
+    allow_unsafe: bool,
+    config: dict,
+    state: HarvestState,
+    field: str,
+    overlap: timedelta,
+    **kwargs,
+) -> Tuple[int, int, int]:
+    """Index the items of each collection that are newer than its watermark
+    less `overlap`, then advance and save the watermark
+
+    Items are asked for oldest first. While a search is cut short by the
+    API's limit on results, the next search starts from the latest item
+    seen, as long as items did come in order. The watermark only advances
+    once a search returned everything it found.
+    """
+    added, failed, unchanged = 0, 0, 0
+    for collection in config["collections"] or [None]:
+        watermark = Watermark(field, state.get(collection, field))
+        since = watermark.since(overlap)
+        logging.info(
+            "Harvesting %s since %s",
+            collection or "all collections",
+            format_time(since) if since else "the beginning",
+        )
+
+        while True:
+            c_added, c_failed, c_unchanged = stac_api_to_odc(
+                dc,
+                products,
+                None,
+                update,
+                allow_unsafe,
+                _harvest_search(config, collection, field, since),
+                watermark=watermark,
+                **kwargs,
+            )
+            added, failed = added + c_added, failed + c_failed
+            unchanged += c_unchanged
+            if not watermark.truncated:
+                break
+            if not watermark.in_order or watermark.latest in (None, since):
+                logging.warning(
+                    "Only harvested %s of %s items of %s, not advancing its "
+                    "watermark. Narrow the search to harvest the rest",
+                    watermark.seen,
+                    watermark.found,
+                    collection or "all collections",
+                )
+                break
+            # Page on from the latest item, which is queried again
+            since = watermark.latest
+
+        advanced = watermark.advanced()
+        if advanced is not None and advanced != watermark.previous:
+            state.set(collection, field, advanced)
+            state.save()
+            logging.info(
+                "Advanced the %s watermark of %s to %s",
+                field,
+                collection or "all collections",
+                format_time(advanced),
+            )
+    return added, failed, unchanged
 
 
 @click.command("sqs-to-dc")
@@ -170,6 +366,14 @@ def stac_api_to_odc(
     default=False,
     help="Allow unsafe changes to a dataset. Take care!",
 )
+@click.option(
+    "--trusted",
+    is_flag=True,
+    default=False,
+    help="Trust EO3 documents from a known producer: take the product named "
+    "in each document, skip lineage and product signature matching, and only "
+    "check that required fields are present",
+)
 @click.option(
     "--collections",
     type=str,
@@ -188,14 +392,93 @@ def stac_api_to_odc(
     default=None,
     help="Dates to search, either one day or an inclusive range, e.g. 2020-01-01 or 2020-01-01/2020-01-02",
 )
+@click.option(
+    "--harvest-state",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Harvest incrementally: only query items newer than the watermark "
+    "of each collection stored in this JSON file, less --overlap-hours, and "
+    "advance the watermarks once the items are indexed",
+)
+@click.option(
+    "--watermark-field",
+    type=click.Choice(WATERMARK_FIELDS),
+    default="datetime",
+    help="Item property the harvest watermark tracks. Use updated for "
+    "collections whose items are reprocessed",
+)
+@click.option(
+    "--overlap-hours",
+    type=float,
+    default=DEFAULT_OVERLAP_HOURS,
+    help="Hours before the watermark to query again, for late arriving items",
+)
+@click.option(
+    "--target-latency",
+    type=float,
+    default=None,
+    help="Target database commit latency in seconds. If set, the write batch "
+    "size and number of writers adapt to stay under it",
+)
+@click.option(
+    "--max-workers",
+    type=int,
+    default=1,
+    help="Maximum number of concurrent database writers",
+)
+@click.option(
+    "--replica-env",
+    default=None,
+    help="Datacube config environment of a read-only replica of the index "
+    "database. Existence checks, product loading and lineage lookups go to it "
+    "while it is up to date, writes always go to the default environment",
+)
+@click.option(
+    "--max-replica-lag",
+    type=float,
+    default=DEFAULT_MAX_LAG,
+    help="Seconds of replication lag above which reads fall back from "
+    "--replica-env to the default environment",
+)
+@click.option(
+    "--failure-journal",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the item URL, stage and error class of every failure to "
+    "this file, for replay-to-dc to retry later",
+)
+@click.option(
+    "--log-sample",
+    type=int,
+    default=0,
+    help="Log one in N successfully indexed datasets. By default only failures "
+    "and periodic summaries of rates are logged",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
 @click.argument("product", type=str, nargs=1)
 def cli(
     limit,
     update,
     allow_unsafe,
+    trusted,
     collections,
     bbox,
     datetime,
+    harvest_state,
+    watermark_field,
+    overlap_hours,
+    target_latency,
+    max_workers,
+    replica_env,
+    max_replica_lag,
+    failure_journal,
+    log_sample,
+    log_json,
     product,
 ):
     """
@@ -203,6 +486,14 @@ def cli(
     Note that you need to set the STAC_API_URL environment variable to
     something like https://earth-search.aws.element84.com/v0/
     """
+    from datacube import Datacube
+
+    setup_logging(sample_every=log_sample, json_format=log_json)
+
+    if harvest_state and (datetime or limit):
+        raise click.UsageError(
+            "--harvest-state can't be combined with --datetime or --limit"
+        )
 
     candidate_products = product.split()
 
@@ -219,13 +510,51 @@ def cli(
     if config["collections"]:
         config["collections"] = config["collections"].split(",")
 
+    journal = FailureJournal(
+        failure_journal, "stac-to-dc", click.get_current_context().params
+    )
+
     # Do the thing
     dc = Datacube()
-    added, failed = stac_api_to_odc(
-        dc, candidate_products, limit, update, allow_unsafe, config
-    )
+    reads = router_from_options(dc, replica_env, max_replica_lag)
+    controller = AIMDController(max_workers=max_workers, target_latency=target_latency)
+    if harvest_state:
+        added, failed, unchanged = harvest(
+            dc,
+            candidate_products,
+            update,
+            allow_unsafe,
+            config,
+            HarvestState(harvest_state),
+            watermark_field,
+            timedelta(hours=overlap_hours),
+            trusted=trusted,
+            controller=controller,
+            journal=journal,
+            reads=reads,
+        )
+    else:
+        added, failed, unchanged = stac_api_to_odc(
+            dc,
+            candidate_products,
+            limit,
+            update,
+            allow_unsafe,
+            config,
+            trusted=trusted,
+            controller=controller,
+            journal=journal,
+            reads=reads,
+        )
+    journal.close()
 
-    print(f"Added {added} Datasets, failed {failed} Datasets")
+    if update:
+        print(
+            f"Updated {added} Datasets, {unchanged} unchanged, "
+            f"failed {failed} Datasets"
+        )
+    else:
+        print(f"Added {added} Datasets, failed {failed} Datasets")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,299 @@
+"""Incremental crawling of THREDDS catalogs
+
+Every catalog fetched is recorded in a local CatalogCache together with its
+ETag/Last-Modified validators and the subcatalogs and datasets it lists.
+Repeat crawls revalidate catalogs with conditional requests and reuse the
+cached listing of unchanged ones instead of downloading and parsing them
+again, and only report datasets that are new or changed since they were
+last indexed. A catalog only lists references to its subcatalogs, which can
+change while it does not, so every subcatalog is still revalidated in turn;
+only a max_age skips requests altogether.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+_THREDDS = "{http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0}"
+_XLINK = "{http://www.w3.org/1999/xlink}"
+
+# Same defaults as thredds_crawler, which odc.thredds uses
+DEFAULT_SKIPS = [
+    ".*files.*",
+    ".*Individual Files.*",
+    ".*File_Access.*",
+    ".*Forecast Model Run.*",
+    ".*Constant Forecast Offset.*",
+    ".*Constant Forecast Date.*",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalogs (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    listing TEXT NOT NULL,
+    checked REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    url TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+);
+"""
+
+
+class Catalog(NamedTuple):
+    """Subcatalog URLs and (dataset URL, signature) pairs listed in a catalog"""
+
+    refs: List[str]
+    datasets: List[Tuple[str, str]]
+
+
+class CachedCatalog(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    catalog: Catalog
+    checked: float
+
+
+def _matches(patterns: List["re.Pattern"], *values: Optional[str]) -> bool:
+    return any(p.match(v) for p in patterns for v in values if v)
+
+
+def parse_catalog(
+    url: str, content: bytes, skips: List[str], select: List[str]
+) -> Catalog:
+    """Parse a THREDDS catalog XML document
+
+    Arguments:
+        url {str} -- URL the catalog was fetched from, to resolve links against
+        skips {List[str]} -- Regexes of catalog and dataset names to leave out
+        select {List[str]} -- Regexes of dataset IDs to keep, all if empty
+
+    Returns:
+        Catalog -- Subcatalogs to crawl and HTTPServer URLs of datasets
+    """
+    skip_patterns = [re.compile(s) for s in skips]
+    select_patterns = [re.compile(s) for s in select]
+    root = ElementTree.fromstring(content)
+
+    bases = [
+        s.get("base")
+        for s in root.iter(f"{_THREDDS}service")
+        if (s.get("serviceType") or "").lower() == "httpserver"
+    ]
+
+    refs = []
+    for ref in root.iter(f"{_THREDDS}catalogRef"):
+        href = ref.get(f"{_XLINK}href")
+        title = ref.get(f"{_XLINK}title") or ref.get("name")
+        if not href:
+            continue
+        ref_url = urljoin(url, href)
+        if not _matches(skip_patterns, ref_url, title, ref.get("ID")):
+            refs.append(ref_url)
+
+    datasets = []
+    for dataset in root.iter(f"{_THREDDS}dataset"):
+        url_path = dataset.get("urlPath")
+        if not url_path or not bases:
+            continue
+        ds_id = dataset.get("ID") or url_path
+        if _matches(skip_patterns, dataset.get("name"), ds_id):
+            continue
+        if select_patterns and not _matches(select_patterns, ds_id):
+            continue
+
+        modified = dataset.find(f"{_THREDDS}date[@type='modified']")
+        size = dataset.find(f"{_THREDDS}dataSize")
+        signature = "|".join(
+            e.text.strip() if e is not None and e.text else "" for e in (modified, size)
+        )
+        datasets.append((urljoin(url, bases[0] + url_path), signature))
+
+    return Catalog(refs, datasets)
+
+
+class CatalogCache:
+    """SQLite backed record of crawled catalogs and indexed datasets
+
+    Arguments:
+        path {str} -- Directory to keep the cache database in
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(path, "catalogs.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def lookup(self, url: str) -> Optional[CachedCatalog]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, listing, checked FROM catalogs "
+                "WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        refs, datasets = json.loads(row[2])
+        return CachedCatalog(
+            row[0], row[1], Catalog(refs, [tuple(d) for d in datasets]), row[3]
+        )
+
+    def reused(self):
+        """Record that a cached catalog was used without revalidating it"""
+        with self._lock:
+            self.hits += 1
+
+    def revalidated(self, url: str):
+        """Record that a cached catalog is still current"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE catalogs SET checked = ? WHERE url = ?", (time.time(), url)
+            )
+            self.hits += 1
+
+    def store(
+        self,
+        url: str,
+        catalog: Catalog,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        self.misses += 1
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO catalogs "
+                "(url, etag, last_modified, listing, checked) VALUES (?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    json.dumps([catalog.refs, catalog.datasets]),
+                    time.time(),
+                ),
+            )
+
+    def new_or_changed(
+        self, datasets: Iterable[Tuple[str, str]]
+    ) -> List[Tuple[str, str]]:
+        """Datasets not recorded as indexed with the same signature"""
+        with self._lock:
+            return [
+                (url, signature)
+                for url, signature in datasets
+                if self._db.execute(
+                    "SELECT 1 FROM datasets WHERE url = ? AND signature = ?",
+                    (url, signature),
+                ).fetchone()
+                is None
+            ]
+
+    def mark_indexed(self, datasets: Iterable[Tuple[str, str]]):
+        """Record datasets as indexed, so later crawls skip them until
+        their signature changes
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO datasets (url, signature) VALUES (?, ?)",
+                list(datasets),
+            )
+            self._db.execute("COMMIT")
+
+
+def crawl_catalog(
+    root_url: str,
+    skips: List[str],
+    select: List[str],
+    cache: Optional[CatalogCache] = None,
+    workers: int = 8,
+    max_age: float = 0,
+    session=None,
+) -> Iterator[Tuple[str, str]]:
+    """Crawl a THREDDS catalog and its subcatalogs concurrently
+
+    With a cache, catalogs are revalidated with conditional requests and the
+    cached listing is used for those the server reports as not modified,
+    which saves their body but not requests for their subcatalogs. Catalogs
+    checked less than `max_age` seconds ago are not requested at all.
+
+    Yields:
+        tuple -- (HTTPServer URL, signature) of every selected dataset
+    """
+    import requests
+
+    session = session or requests.Session()
+    skips = DEFAULT_SKIPS + list(skips)
+
+    def _visit(url: str) -> Catalog:
+        entry = cache.lookup(url) if cache is not None else None
+        headers = {}
+        if entry is not None:
+            if max_age and time.time() - entry.checked < max_age:
+                cache.reused()
+                return entry.catalog
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        response = session.get(url, headers=headers, timeout=60)
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated(url)
+            return entry.catalog
+        response.raise_for_status()
+
+        catalog = parse_catalog(url, response.content, skips, select)
+        if cache is not None:
+            cache.store(
+                url,
+                catalog,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        return catalog
+
+    seen = {root_url}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = {executor.submit(_visit, root_url): root_url}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    catalog = future.result()
+                except (requests.RequestException, ElementTree.ParseError) as e:
+                    logging.error(f"Failed to crawl {url}: {e}")
+                    continue
+                for ref in catalog.refs:
+                    if ref not in seen:
+                        seen.add(ref)
+                        pending[executor.submit(_visit, ref)] = ref
+                yield from catalog.datasets
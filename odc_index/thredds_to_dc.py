@@ -3,48 +3,126 @@ and dump them into a Datacube instance
 """
 import sys
 import logging
+from datetime import datetime
 from typing import Tuple
 
 import click
-from odc.thredds import thredds_find_glob, download_yamls
-from odc.index import from_yaml_doc_stream
-from datacube import Datacube
 
-from typing import List, Tuple
+from odc_index.cache import DocumentCache
+from odc_index import fetch
+from odc_index.datasets import doc_stream_to_datasets
+from odc_index.db import (
+    add_datasets_if_absent,
+    bulk_has_location,
+    bulk_unchanged,
+    update_datasets,
+)
+from odc_index.journal import FailureJournal
+from odc_index.logs import RateLog, setup_logging
+from odc_index.predicates import key_filter_from_options
+from odc_index.prepared import prepare_datasets
+from odc_index.replica import DEFAULT_MAX_LAG, router_from_options
+from odc_index.thredds import CatalogCache, crawl_catalog
+from odc_index.shard import (
+    SHARD_BY,
+    Shard,
+    in_shard,
+    shard_name,
+    shard_option_callback,
+)
+
+from typing import TYPE_CHECKING, List, Set, Tuple
+
+if TYPE_CHECKING:
+    from datacube import Datacube
+
+
+def _location(url: str) -> str:
+    # Datasets are indexed under https:// whatever the scheme crawled
+    return "https://" + url.split("://", 1)[-1]
+
+
+def _downloaded(yaml_content_list, journal: FailureJournal):
+    for content, target, err in yaml_content_list:
+        if content is None:
+            logging.error("Failed to download https://%s: %s", target, err)
+            journal.record(_location(target), "fetch", err or "Fetch failed")
+        else:
+            yield _location(target), content
 
 
 def dump_list_to_odc(
     yaml_content_list: List[Tuple[bytes, str, str]],
-    dc: Datacube,
+    dc: "Datacube",
     products: List[str],
+    journal: FailureJournal = None,
+    update_uris: Set[str] = frozenset(),
+    written: Set[str] = None,
     **kwargs,
 ):
-    expand_stream = (
-        ("https://" + d[1], d[0]) for d in yaml_content_list if d[0] is not None
-    )
+    """Add the datasets of downloaded documents, updating those at
+    `update_uris` instead
+
+    Arguments:
+        update_uris {set} -- Locations of changed documents whose datasets
+            are already indexed
+        written {set} -- If given, collects the locations of the datasets
+            added, updated or found unchanged, which the index now matches
+
+    Returns:
+        tuple -- Numbers of datasets added and failed
+    """
+    if journal is None:
+        journal = FailureJournal(None)
 
-    ds_stream = from_yaml_doc_stream(
-        expand_stream, dc.index, products=products, **kwargs
+    ds_stream = doc_stream_to_datasets(
+        _downloaded(yaml_content_list, journal),
+        dc.index,
+        products=products,
+        **kwargs,
     )
     ds_added = 0
+    ds_updated = 0
+    ds_unchanged = 0
     ds_failed = 0
+    ds_present = 0
+    progress = RateLog("datasets")
     # Consume chained streams to DB
-    for result in ds_stream:
-        ds, err = result
+    for uri, ds, err, stage in ds_stream:
         if err is not None:
-            logging.error(err)
+            progress.failure(err)
+            journal.record(uri, stage, err)
             ds_failed += 1
-        else:
-            logging.info(ds)
-            # TODO: Potentially wrap this in transactions and batch to DB
-            # TODO: Capture UUID's from YAML and perform a bulk has
-            try:
-                dc.index.datasets.add(ds)
+            continue
+        try:
+            if uri in update_uris:
+                if ds.id in bulk_unchanged(dc, [ds]):
+                    ds_unchanged += 1
+                else:
+                    update_datasets(dc, [ds])
+                    progress.success("Updated %s from %s", ds.id, uri)
+                    ds_updated += 1
+            elif add_datasets_if_absent(dc, [ds]):
+                progress.success("Indexed %s from %s", ds.id, uri)
                 ds_added += 1
-            except Exception as e:
-                logging.error(e)
-                ds_failed += 1
+            else:
+                ds_present += 1
+                continue
+        except Exception as e:
+            progress.failure(e)
+            journal.record(uri, "write", e, dataset_id=ds.id)
+            ds_failed += 1
+            continue
+        if written is not None:
+            written.add(uri)
 
+    progress.close()
+    if ds_updated or ds_unchanged:
+        logging.info(
+            "Updated %s changed datasets, %s were unchanged", ds_updated, ds_unchanged
+        )
+    if ds_present:
+        logging.info("Skipped adding %s already indexed datasets", ds_present)
     return ds_added, ds_failed
 
 
@@ -70,34 +148,261 @@ def dump_list_to_odc(
     default=False,
     help="Default is no verification. Set to verify parent dataset definitions.",
 )
+@click.option(
+    "--trusted",
+    is_flag=True,
+    default=False,
+    help="Trust EO3 documents from a known producer: take the product named "
+    "in each document, skip lineage and product signature matching, and only "
+    "check that required fields are present",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Keep a local cache of fetched documents in this directory and "
+    "revalidate them with conditional requests on later runs",
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=1024,
+    help="Maximum size of the document cache in MB, least recently used "
+    "documents are evicted first",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Requires --cache-dir. Revalidate catalogs crawled on earlier runs "
+    "with conditional requests and only index datasets that are new or changed, "
+    "updating changed ones that are already indexed. An unchanged catalog saves its download and parsing, but its subcatalogs "
+    "are still requested, since they can change on their own",
+)
+@click.option(
+    "--catalog-max-age",
+    type=int,
+    default=0,
+    help="With --incremental, trust catalogs checked less than this many "
+    "seconds ago without requesting them at all. This is what saves requests "
+    "on unchanged subtrees",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=shard_option_callback,
+    help="Only process shard i of N, given as 'i/N' with 0 <= i < N, so that "
+    "N replicas together cover the source exactly once",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(SHARD_BY),
+    default="key",
+    help="Assign individual dataset URLs to shards, or whole top level "
+    "prefixes below the catalog URI",
+)
+@click.option(
+    "--key-template",
+    default=None,
+    help="Parse fields such as {date}, {year}/{month}/{day}, {path}/{row}, "
+    "{tile} or {region} from the end of each key, e.g. "
+    "'{path}/{row}/{year}/{month}/{day}/*.yaml'. Keys that do not match "
+    "are skipped before they are fetched",
+)
+@click.option(
+    "--from-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Skip keys dated before this day, requires --key-template",
+)
+@click.option(
+    "--to-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Skip keys dated after this day, requires --key-template",
+)
+@click.option(
+    "--region-code",
+    "region_codes",
+    multiple=True,
+    help="Only index keys with this region code: the {region} or {tile} field, "
+    "or {path} and {row} joined. Can be repeated. Requires --key-template",
+)
+@click.option(
+    "--prepare-to",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Only prepare datasets, writing them to this file, gzip compressed "
+    "if it ends in .gz, for load-dc to bulk load later. The database is only "
+    "read, for products and, unless skipped, lineage. Lineage datasets the "
+    "documents carry are prepared too",
+)
+@click.option(
+    "--replica-env",
+    default=None,
+    help="Datacube config environment of a read-only replica of the index "
+    "database. Existence checks, product loading and lineage lookups go to it "
+    "while it is up to date, writes always go to the default environment",
+)
+@click.option(
+    "--max-replica-lag",
+    type=float,
+    default=DEFAULT_MAX_LAG,
+    help="Seconds of replication lag above which reads fall back from "
+    "--replica-env to the default environment",
+)
+@click.option(
+    "--failure-journal",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Append the URL, stage and error class of every failure to this "
+    "file, for replay-to-dc to retry later",
+)
+@click.option(
+    "--log-sample",
+    type=int,
+    default=0,
+    help="Log one in N successfully indexed datasets. By default only failures "
+    "and periodic summaries of rates are logged",
+)
+@click.option(
+    "--log-json",
+    is_flag=True,
+    default=False,
+    help="Log JSON objects instead of plain lines",
+)
 @click.argument("uri", type=str, nargs=1)
 @click.argument("product", type=str, nargs=1)
 def cli(
     skip_lineage: bool,
     fail_on_missing_lineage: bool,
     verify_lineage: bool,
+    trusted: bool,
+    cache_dir: str,
+    cache_size: int,
+    incremental: bool,
+    catalog_max_age: int,
+    shard: Shard,
+    shard_by: str,
+    key_template: str,
+    from_date: datetime,
+    to_date: datetime,
+    region_codes: Tuple[str, ...],
+    prepare_to: str,
+    replica_env: str,
+    max_replica_lag: float,
+    failure_journal: str,
+    log_sample: int,
+    log_json: bool,
     uri: str,
     product: str,
 ):
+    from datacube import Datacube
+    from odc.thredds import thredds_find_glob, download_yamls
+
+    setup_logging(sample_every=log_sample, json_format=log_json)
+
+    if incremental and not cache_dir:
+        raise click.UsageError("--incremental requires --cache-dir")
+    try:
+        key_filter = key_filter_from_options(
+            key_template, from_date, to_date, region_codes
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
     skips = [".*NBAR.*", ".*SUPPLEMENTARY.*", ".*NBART.*", ".*/QA/.*"]
     select = [".*ARD-METADATA.yaml"]
     candidate_products = product.split()
     print(f"Crawling {uri} on Thredds")
     print(f"Matching to {candidate_products}")
-    yaml_urls = thredds_find_glob(uri, skips, select)
-    print(f"Found {len(yaml_urls)} datasets")
+    catalog_cache, changed = None, None
+    if incremental:
+        catalog_cache = CatalogCache(cache_dir)
+        root = uri if uri.endswith(".xml") else uri + "/catalog.xml"
+        crawled = list(
+            crawl_catalog(root, skips, select, catalog_cache, max_age=catalog_max_age)
+        )
+        changed = catalog_cache.new_or_changed(crawled)
+        yaml_urls = [u for u, _ in changed]
+        print(
+            f"Found {len(crawled)} datasets, {len(changed)} new or changed, "
+            f"{catalog_cache.hits} catalogs unchanged"
+        )
+    else:
+        yaml_urls = thredds_find_glob(uri, skips, select)
+        print(f"Found {len(yaml_urls)} datasets")
+    if shard is not None:
+        yaml_urls = [
+            u for u in yaml_urls if in_shard(shard_name(u, uri, shard_by), shard)
+        ]
+        print(f"Keeping {len(yaml_urls)} datasets in shard {shard}")
+    if key_filter is not None:
+        yaml_urls = [u for u in yaml_urls if key_filter(u)]
+        print(f"Keeping {len(yaml_urls)} datasets matching the key filters")
 
-    yaml_contents = download_yamls(yaml_urls)
+    cache = None
+    if cache_dir:
+        cache = DocumentCache(cache_dir, max_size=cache_size * 1024 * 1024)
+        yaml_contents = fetch.download_yamls(yaml_urls, cache)
+    else:
+        yaml_contents = download_yamls(yaml_urls)
+
+    journal = FailureJournal(
+        failure_journal, "thredds-to-dc", click.get_current_context().params
+    )
 
     # Consume generator and fetch YAML's
     dc = Datacube()
-    added, failed = dump_list_to_odc(
-        yaml_contents,
-        dc,
-        candidate_products,
-        skip_lineage=skip_lineage,
-        fail_on_missing_lineage=fail_on_missing_lineage,
-        verify_lineage=verify_lineage,
-    )
+    reads = router_from_options(dc, replica_env, max_replica_lag)
+    update_uris, written = set(), set()
+    if catalog_cache is not None and not prepare_to:
+        # Changed documents already in the index are updated rather than
+        # added. This must see recent writes, so it never goes to the replica
+        update_uris = bulk_has_location(dc, [_location(u) for u in yaml_urls])
+    if prepare_to:
+        added, failed = prepare_datasets(
+            doc_stream_to_datasets(
+                _downloaded(yaml_contents, journal),
+                dc.index,
+                products=candidate_products,
+                skip_lineage=skip_lineage,
+                fail_on_missing_lineage=fail_on_missing_lineage,
+                verify_lineage=verify_lineage,
+                trusted=trusted,
+                reads=reads,
+            ),
+            prepare_to,
+            journal,
+        )
+        print(f"Prepared {added} Datasets, Failed {failed} Datasets")
+    else:
+        added, failed = dump_list_to_odc(
+            yaml_contents,
+            dc,
+            candidate_products,
+            skip_lineage=skip_lineage,
+            fail_on_missing_lineage=fail_on_missing_lineage,
+            verify_lineage=verify_lineage,
+            trusted=trusted,
+            journal=journal,
+            update_uris=update_uris,
+            written=written,
+            reads=reads,
+        )
+        print(f"Added {added} Datasets, Failed {failed} Datasets")
+    journal.close()
+
+    if catalog_cache is not None:
+        # Only skip datasets on later runs once the index matches them
+        catalog_cache.mark_indexed(
+            (u, signature) for u, signature in changed if _location(u) in written
+        )
+        catalog_cache.close()
+    if cache is not None:
+        print(f"Document cache: {cache.hits} unchanged, {cache.misses} fetched")
+        cache.close()
+
 
-    print(f"Added {added} Datasets, Failed {failed} Datasets")
+if __name__ == "__main__":
+    cli()
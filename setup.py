@@ -28,6 +28,9 @@ setuptools.setup(
         thredds-to-dc=odc_index.thredds_to_dc:cli
         sqs-to-dc=odc_index.sqs_to_dc:cli
         stac-to-dc=odc_index.stac_api_to_dc:cli
+        replay-to-dc=odc_index.replay_to_dc:cli
+        relocate-dc=odc_index.relocate_dc:cli
+        load-dc=odc_index.load_dc:cli
     """,
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -0,0 +1,51 @@
+"""
+Test for the local document cache
+"""
+import os
+
+from odc_index.cache import DocumentCache
+
+
+def test_store_and_revalidate(tmp_path):
+    cache = DocumentCache(str(tmp_path))
+    cache.store("https://example.com/a.yaml", b"id: a\n", etag='"abc"')
+
+    assert cache.conditional_headers("https://example.com/a.yaml") == {
+        "If-None-Match": '"abc"'
+    }
+    assert cache.revalidated("https://example.com/a.yaml") == b"id: a\n"
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_unvalidated_documents_not_cached(tmp_path):
+    cache = DocumentCache(str(tmp_path))
+    cache.store("https://example.com/a.yaml", b"id: a\n")
+
+    assert cache.lookup("https://example.com/a.yaml") is None
+    assert cache.conditional_headers("https://example.com/a.yaml") == {}
+
+
+def test_identical_bodies_stored_once(tmp_path):
+    cache = DocumentCache(str(tmp_path))
+    cache.store("s3://bucket/a.yaml", b"id: a\n" * 100, etag='"1"')
+    size = cache.size()
+    cache.store("s3://bucket/b.yaml", b"id: a\n" * 100, etag='"1"')
+
+    assert cache.size() == size
+    assert (
+        cache.lookup("s3://bucket/a.yaml").digest
+        == cache.lookup("s3://bucket/b.yaml").digest
+    )
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_size=600)
+    for i in range(4):
+        cache.store(f"s3://bucket/{i}.yaml", os.urandom(200), etag=f'"{i}"')
+        # Keep the first document warm
+        cache.revalidated("s3://bucket/0.yaml")
+
+    assert cache.size() <= 600
+    assert cache.lookup("s3://bucket/0.yaml") is not None
+    assert cache.lookup("s3://bucket/1.yaml") is None
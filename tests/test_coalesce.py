@@ -0,0 +1,70 @@
+"""
+Test for coalescing SQS messages about the same dataset
+"""
+import json
+
+from odc_index.coalesce import CoalescingWindow, coalesce
+from odc_index.sqs_to_dc import dataset_key, message_action
+
+
+class Message:
+    def __init__(self, message_id, dataset_id, sent, action=None):
+        self.message_id = message_id
+        self.body = json.dumps({"Message": json.dumps({"id": dataset_id})})
+        self.attributes = {"SentTimestamp": str(sent)}
+        self.message_attributes = {}
+        if action is not None:
+            self.message_attributes["action"] = {
+                "DataType": "String",
+                "StringValue": action,
+            }
+
+
+def test_final_message_supersedes_the_others():
+    add = Message("1", "a", sent=100)
+    other = Message("2", "b", sent=110)
+    archive = Message("3", "a", sent=120, action="ARCHIVED")
+    # Received out of the order they were sent in
+    update = Message("4", "a", sent=105)
+    broken = Message("5", None, sent=130)
+    broken.body = "not json"
+
+    groups = coalesce([add, other, archive, update, broken], dataset_key)
+    assert [
+        (final.message_id, [m.message_id for m in older]) for final, older in groups
+    ] == [
+        ("2", []),
+        ("3", ["1", "4"]),
+        ("5", []),
+    ]
+    assert message_action(groups[1][0]) == "archive"
+    assert message_action(add) == "add"
+    assert message_action(add, update=True) == "update"
+    assert message_action(add, archive=True) == "archive"
+
+
+def test_s3_events_coalesce_by_object():
+    record = {"s3": {"bucket": {"name": "bucket"}, "object": {"key": "a/b.yaml"}}}
+    message = Message("1", None, sent=0)
+    message.body = json.dumps({"Message": json.dumps({"Records": [record]})})
+
+    assert dataset_key(message, ("*.yaml",)) == (("bucket", "a/b.yaml"),)
+    assert dataset_key(message, ("*.json",)) is None
+
+
+def test_window_groups_polls():
+    window = CoalescingWindow(3600, max_messages=3)
+    assert window.wait_time() is None
+
+    def polls():
+        yield [1]
+        assert 1 <= window.wait_time() <= 3600
+        yield []
+        yield [2, 3]
+        assert window.wait_time() is None
+        yield [4]
+
+    assert list(window.groups(polls())) == [[1, 2, 3], [4]]
+
+    window = CoalescingWindow(0)
+    assert list(window.groups([[1], [], [2, 3]])) == [[1], [2, 3]]
@@ -0,0 +1,45 @@
+"""
+Test for reading compressed metadata documents
+"""
+import gzip
+import io
+
+import pytest
+
+from odc_index.compression import (
+    compression_of,
+    decompress,
+    read_body,
+    uncompressed_name,
+)
+
+DOCUMENT = b"id: 7e1c5a34-1b7e-4c6a-9d1e-0c2f4c6f1a9b\nproduct: {name: ls8}\n"
+
+
+def test_compression_of():
+    assert compression_of("s3://bucket/a.yaml.gz") == "gzip"
+    assert compression_of("s3://bucket/a.json.zst") == "zstd"
+    assert compression_of("s3://bucket/a.yaml", content_encoding="gzip") == "gzip"
+    assert compression_of("s3://bucket/a.yaml", head=gzip.compress(b"x")[:4]) == "gzip"
+    assert compression_of("s3://bucket/a.yaml", head=b"id: ") is None
+    assert uncompressed_name("s3://bucket/a.json.gz") == "s3://bucket/a.json"
+
+
+@pytest.mark.parametrize("url", ["a.yaml.gz", "a.yaml"])
+def test_read_body_gzip(url):
+    # Detected from the extension or the magic bytes alike
+    assert read_body(io.BytesIO(gzip.compress(DOCUMENT)), url) == DOCUMENT
+    assert read_body(io.BytesIO(DOCUMENT), "a.yaml") == DOCUMENT
+
+
+def test_decompress():
+    assert decompress(gzip.compress(DOCUMENT), "a.yaml") == DOCUMENT
+    # Already decoded, e.g. by requests for a Content-Encoding
+    assert decompress(DOCUMENT, "a.yaml.gz") == DOCUMENT
+
+
+def test_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    compressed = zstandard.ZstdCompressor().compress(DOCUMENT)
+    assert read_body(io.BytesIO(compressed), "a.yaml") == DOCUMENT
+    assert decompress(compressed, "a.yaml.zst") == DOCUMENT
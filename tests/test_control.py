@@ -0,0 +1,99 @@
+"""
+Test for adaptive write batch and concurrency control
+"""
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from odc_index.control import AIMDController, is_fatal, is_overload
+
+
+def test_fixed_without_target_latency():
+    controller = AIMDController(batch_size=50, max_workers=4)
+    controller.record([10.0, 10.0], errors=2)
+
+    assert controller.batch_size == 50
+    assert controller.workers == 1
+    assert controller.delay == 0
+
+
+def test_additive_increase():
+    controller = AIMDController(
+        batch_size=50, min_batch_size=10, max_workers=4, target_latency=1.0
+    )
+    controller.record([0.1, 0.2], errors=0)
+
+    assert controller.batch_size == 60
+    assert controller.workers == 2
+
+
+def test_multiplicative_decrease_on_latency():
+    controller = AIMDController(
+        batch_size=100, workers=4, max_workers=4, target_latency=1.0
+    )
+    controller.record([2.0, 3.0], errors=0)
+
+    assert controller.batch_size == 50
+    assert controller.workers == 2
+    assert controller.delay > 0
+
+
+def test_run_reports_errors_and_backs_off_on_overload():
+    controller = AIMDController(batch_size=20, min_batch_size=10, target_latency=1.0)
+
+    def write(item):
+        if item % 2:
+            raise OperationalError("INSERT", {}, Exception("too many connections"))
+
+    results = controller.run(write, list(range(4)))
+
+    assert [item for item, err in results if err is not None] == [1, 3]
+    assert controller.batch_size == 10
+
+
+def test_batches_follow_batch_size():
+    controller = AIMDController(batch_size=10, min_batch_size=1)
+    batches = controller.batches(range(25))
+
+    assert len(next(batches)) == 10
+    controller.batch_size = 3
+    assert len(next(batches)) == 3
+    assert sum(len(b) for b in batches) == 12
+
+
+def test_error_classes():
+    overload = OperationalError("SELECT 1", {}, Exception("too many connections"))
+    missing = ProgrammingError("SELECT 1", {}, Exception("no such table"))
+    duplicate = IntegrityError("INSERT", {}, Exception("duplicate key"))
+
+    assert is_overload(overload) and not is_fatal(overload)
+    assert is_fatal(missing) and not is_overload(missing)
+    assert not is_fatal(duplicate) and not is_overload(duplicate)
+    assert not is_fatal(ValueError("bad document"))
+
+
+def test_rounds_have_a_batch_per_worker():
+    controller = AIMDController(
+        batch_size=10, min_batch_size=1, workers=2, max_workers=4
+    )
+    rounds = controller.rounds(range(45))
+
+    assert [len(b) for b in next(rounds)] == [10, 10]
+    controller.workers = 3
+    assert [len(b) for b in next(rounds)] == [10, 10, 5]
+    assert next(rounds, None) is None
+
+
+def test_failed_batches_are_retried_one_at_a_time():
+    controller = AIMDController(batch_size=3, min_batch_size=1)
+    calls = []
+
+    def write(batch):
+        calls.append(batch)
+        if 4 in batch:
+            raise ValueError("bad dataset")
+        if 7 in batch:
+            raise OperationalError("INSERT", {}, Exception("too many connections"))
+
+    results = controller.run_batches(write, [[1, 2], [3, 4, 5], [6, 7]])
+
+    assert [item for item, err in results if err is not None] == [4, 6, 7]
+    assert calls == [[1, 2], [3, 4, 5], [6, 7], [3], [4], [5]]
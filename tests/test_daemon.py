@@ -0,0 +1,61 @@
+"""
+Test for daemon mode support
+"""
+import urllib.error
+import urllib.request
+
+import pytest
+
+from odc_index.daemon import DaemonState, serve_health
+
+
+def _status(server, path):
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    try:
+        return urllib.request.urlopen(url).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture
+def state_and_server():
+    state = DaemonState()
+    server = serve_health(state, 0, "127.0.0.1")
+    yield state, server
+    server.shutdown()
+
+
+def test_readiness_follows_state(state_and_server):
+    state, server = state_and_server
+
+    assert _status(server, "/healthz") == 200
+    assert _status(server, "/readyz") == 503
+    state.ready = True
+    assert _status(server, "/readyz") == 200
+    state.stopping.set()
+    assert _status(server, "/readyz") == 503
+    assert _status(server, "/other") == 404
+
+
+def test_liveness_needs_heartbeat(state_and_server):
+    state, server = state_and_server
+    state.max_idle = 0
+
+    assert _status(server, "/healthz") == 503
+
+
+def test_refresh_due():
+    state = DaemonState(refresh_interval=0)
+    assert state.refresh_due()
+
+    state = DaemonState(refresh_interval=3600)
+    assert not state.refresh_due()
+
+
+def test_refresh_due_per_key():
+    state = DaemonState(refresh_interval=0)
+    assert state.refresh_due("ls8-queue")
+    state.refresh_interval = 3600
+    assert not state.refresh_due("ls8-queue")
+    state._started -= 3600
+    assert state.refresh_due("s2-queue")
@@ -0,0 +1,51 @@
+"""
+Test for the checks trusted documents still go through
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from odc_index.datasets import Doc2DatasetCache, TrustedDoc2Dataset, _missing_fields
+
+DOCUMENT = {
+    "$schema": "https://schemas.opendatacube.org/dataset",
+    "id": "7e1c5a34-1b7e-4c6a-9d1e-0c2f4c6f1a9b",
+    "product": {"name": "ga_ls8c_ard_3"},
+    "crs": "epsg:32655",
+    "properties": {"datetime": "2020-01-01T00:00:00Z"},
+    "measurements": {"nbart_red": {"path": "red.tif"}},
+}
+
+
+class FakeProducts:
+    def __init__(self, names):
+        self.names = names
+
+    def get_by_name(self, name):
+        return SimpleNamespace(name=name) if name in self.names else None
+
+
+def test_missing_fields():
+    assert _missing_fields(DOCUMENT) == []
+    doc = dict(DOCUMENT, product={}, measurements={})
+    del doc["crs"]
+    assert _missing_fields(doc) == ["product.name", "crs", "measurements"]
+
+
+def test_trusted_products_must_exist():
+    index = SimpleNamespace(products=FakeProducts({"ga_ls8c_ard_3"}))
+    doc2ds = TrustedDoc2Dataset(index, ["ga_ls8c_ard_3"])
+    assert list(doc2ds.products) == ["ga_ls8c_ard_3"]
+    with pytest.raises(ValueError):
+        TrustedDoc2Dataset(index, ["ga_ls8c_ard_3", "ga_ls9c_ard_3"])
+
+
+def test_resolvers_are_shared_per_product_list():
+    index = SimpleNamespace(products=FakeProducts({"ga_ls8c_ard_3", "ga_ls9c_ard_3"}))
+    resolvers = Doc2DatasetCache(index, trusted=True)
+    ls8 = resolvers.get(["ga_ls8c_ard_3"])
+    assert resolvers.get(["ga_ls8c_ard_3"]) is ls8
+    assert resolvers.get(["ga_ls9c_ard_3"]) is not ls8
+    # A refresh rebuilds only what is older than max_age
+    assert resolvers.get(["ga_ls8c_ard_3"], max_age=60) is ls8
+    assert resolvers.get(["ga_ls8c_ard_3"], max_age=0) is not ls8
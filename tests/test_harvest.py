@@ -0,0 +1,124 @@
+"""
+Test for harvest watermarks
+"""
+from datetime import datetime, timedelta, timezone
+
+from odc_index import stac_api_to_dc
+from odc_index.harvest import HarvestState, Watermark, parse_time
+
+
+def _items(*times):
+    for i, time in enumerate(times):
+        yield {"properties": {"updated": time}}, f"https://stac/items/{i}", False
+
+
+def test_watermark_advances_to_latest():
+    watermark = Watermark("updated", parse_time("2020-01-01T00:00:00Z"))
+    assert watermark.since(timedelta(hours=24)) == parse_time("2019-12-31T00:00:00Z")
+    list(watermark.track(_items("2020-01-02T00:00:00Z", "2020-01-03T00:00:00Z")))
+    assert watermark.advanced() == parse_time("2020-01-03T00:00:00Z")
+
+
+def test_watermark_stops_before_failures():
+    watermark = Watermark("updated", parse_time("2020-01-01T00:00:00Z"))
+    items = list(
+        watermark.track(
+            _items(
+                "2020-01-04T00:00:00Z", "2020-01-02T00:00:00Z", "2020-01-03T00:00:00Z"
+            )
+        )
+    )
+    watermark.failed(items[2][1])
+    assert watermark.advanced() == parse_time("2020-01-02T23:59:59Z")
+
+    # Failures without a known time hold the watermark where it was
+    watermark.failed(None)
+    assert watermark.advanced() == watermark.previous
+
+
+def test_truncated_search_holds_the_watermark():
+    watermark = Watermark("updated", parse_time("2020-01-01T00:00:00Z"))
+    watermark.search(found=3)
+    list(watermark.track(_items("2020-01-03T00:00:00Z", "2020-01-02T00:00:00Z")))
+    assert watermark.truncated
+    assert not watermark.in_order
+    assert watermark.advanced() == watermark.previous
+
+
+def _api(times, page_limit):
+    """Fake stac_api_to_odc over items with these updated times, returning
+    at most page_limit of them per search, oldest first
+    """
+    searches = []
+
+    def search(dc, products, limit, update, allow_unsafe, config, watermark, **kw):
+        searches.append(config)
+        since = config.get("query", {}).get("updated", {}).get("gte")
+        found = [
+            t for t in times if since is None or parse_time(t) >= parse_time(since)
+        ]
+        watermark.search(len(found))
+        list(watermark.track(_items(*sorted(found)[:page_limit])))
+        return len(found[:page_limit]), 0, 0
+
+    return search, searches
+
+
+def test_harvest_pages_past_the_api_limit(tmp_path, monkeypatch):
+    times = [f"2020-01-0{day}T00:00:00Z" for day in range(1, 8)]
+    search, searches = _api(times, page_limit=3)
+    monkeypatch.setattr(stac_api_to_dc, "stac_api_to_odc", search)
+    state = HarvestState(str(tmp_path / "state.json"))
+
+    stac_api_to_dc.harvest(
+        None, [], False, False, {"collections": None}, state, "updated", timedelta()
+    )
+
+    # Each search starts from the latest item of the one before
+    assert [s.get("query", {}).get("updated", {}).get("gte") for s in searches] == [
+        None,
+        "2020-01-03T00:00:00Z",
+        "2020-01-05T00:00:00Z",
+    ]
+    assert searches[0]["sortby"] == [
+        {"field": "properties.updated", "direction": "asc"}
+    ]
+    assert state.get(None, "updated") == parse_time("2020-01-07T00:00:00Z")
+
+
+def test_harvest_without_progress_holds_the_watermark(tmp_path, monkeypatch):
+    search, searches = _api(["2020-01-01T00:00:00Z"] * 5, page_limit=3)
+    monkeypatch.setattr(stac_api_to_dc, "stac_api_to_odc", search)
+    state = HarvestState(str(tmp_path / "state.json"))
+
+    stac_api_to_dc.harvest(
+        None, [], False, False, {"collections": None}, state, "updated", timedelta()
+    )
+
+    assert len(searches) == 2
+    assert state.get(None, "updated") is None
+
+
+def test_harvest_state(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = HarvestState(path)
+    assert state.get("sentinel-s2-l2a-cogs", "datetime") is None
+    state.set("sentinel-s2-l2a-cogs", "datetime", parse_time("2020-01-01T10:00:00Z"))
+    state.save()
+
+    state = HarvestState(path)
+    assert state.get("sentinel-s2-l2a-cogs", "datetime") == parse_time(
+        "2020-01-01T10:00:00Z"
+    )
+    assert state.get(None, "datetime") is None
+
+
+def test_parse_time():
+    assert parse_time("2020-01-01T00:00:00.12Z") == datetime(
+        2020, 1, 1, 0, 0, 0, 120000, tzinfo=timezone.utc
+    )
+    assert parse_time("2020-01-01T00:00:00.123456Z") == datetime(
+        2020, 1, 1, 0, 0, 0, 123456, tzinfo=timezone.utc
+    )
+    assert parse_time("2020-01-01T10:00:00+10:00") == parse_time("2020-01-01T00:00:00Z")
+    assert parse_time("2020-01-01T00:00:00") == parse_time("2020-01-01T00:00:00Z")
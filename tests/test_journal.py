@@ -0,0 +1,120 @@
+"""
+Test for the failure journal and replay queue
+"""
+from odc_index.journal import FailureJournal, group_runs, read_journal
+from odc_index.replay_to_dc import JournalQueue, not_indexed
+from odc_index.sqs_to_dc import message_action
+
+
+def test_record_and_read(tmp_path):
+    path = str(tmp_path / "failures.jsonl")
+    with FailureJournal(path, "s3-to-dc", {"product": "ls8"}) as journal:
+        journal.record("s3://bucket/a.yaml", "parse", ValueError("bad yaml"))
+        journal.record("s3://bucket/b.yaml", "write", "Error", dataset_id="abc")
+
+    failures = list(read_journal(path))
+    assert [f.source for f in failures] == ["s3://bucket/a.yaml", "s3://bucket/b.yaml"]
+    assert failures[0].tool == "s3-to-dc"
+    assert failures[0].params == {"product": "ls8"}
+    assert failures[0].error_class == "ValueError"
+    assert failures[1].dataset_id == "abc"
+
+
+def test_later_runs_replace_earlier_failures(tmp_path):
+    path = str(tmp_path / "failures.jsonl")
+    with FailureJournal(path, "s3-to-dc", {"product": "ls8"}) as journal:
+        journal.record("s3://bucket/a.yaml", "fetch", "timeout")
+    with FailureJournal(path, "s3-to-dc", {"product": "ls7"}) as journal:
+        journal.record("s3://bucket/a.yaml", "write", "duplicate")
+        journal.record("s3://bucket/b.yaml", "write", "duplicate")
+
+    failures = list(read_journal(path))
+    assert len(failures) == 2
+    assert failures[0].stage == "write"
+    assert len(group_runs(failures)) == 1
+
+
+def test_disabled_journal_records_nothing():
+    journal = FailureJournal(None)
+    journal.record("s3://bucket/a.yaml", "fetch", "timeout")
+    assert journal.count == 0
+
+
+def test_journal_queue(tmp_path):
+    path = str(tmp_path / "failures.jsonl")
+    with FailureJournal(path, "sqs-to-dc", {}) as journal:
+        for i in range(3):
+            journal.record(f"message-{i}", "fetch", "timeout", body="{}")
+
+    queue = JournalQueue(list(read_journal(path)))
+    assert len(queue.receive_messages(MaxNumberOfMessages=2)) == 2
+    assert [m.message_id for m in queue.receive_messages(MaxNumberOfMessages=2)] == [
+        "message-2"
+    ]
+    assert queue.receive_messages() == []
+
+
+def test_parts_replay_with_their_own_params(tmp_path):
+    path = str(tmp_path / "failures.jsonl")
+    with FailureJournal(path, "sqs-to-dc", {"config": "queues.yaml"}) as journal:
+        ls8 = journal.part({"queue_name": "ls8-queue", "product": "ls8"})
+        s2 = journal.part({"queue_name": "s2-queue", "product": "s2"})
+        ls8.record("message-1", "fetch", "timeout", body="{}")
+        s2.record("message-2", "fetch", "timeout", body="{}")
+        ls8.record("message-3", "fetch", "timeout", body="{}")
+        ls8.close()
+        s2.close()
+        assert journal.count == 3
+
+    failures = list(read_journal(path))
+    assert [f.params["product"] for f in failures] == ["ls8", "s2", "ls8"]
+    assert failures[0].params["config"] == "queues.yaml"
+    assert [[f.source for f in run] for run in group_runs(failures)] == [
+        ["message-1", "message-3"],
+        ["message-2"],
+    ]
+
+
+class Datasets:
+    def __init__(self, indexed):
+        self.indexed = indexed
+
+    def bulk_has(self, ids):
+        return [str(i) in self.indexed for i in ids]
+
+
+class Index:
+    def __init__(self, indexed):
+        self.datasets = Datasets(indexed)
+
+
+class Datacube:
+    def __init__(self, indexed):
+        self.index = Index(indexed)
+
+
+def test_archived_messages_replay_as_archives(tmp_path):
+    path = str(tmp_path / "failures.jsonl")
+    added = "00000000-0000-0000-0000-000000000001"
+    archived = "00000000-0000-0000-0000-000000000002"
+    action = {"action": {"DataType": "String", "StringValue": "ARCHIVED"}}
+    with FailureJournal(path, "sqs-to-dc", {"product": "ls8"}) as journal:
+        journal.record("message-1", "write", "timeout", dataset_id=added, body="{}")
+        journal.record(
+            "message-2",
+            "write",
+            "timeout",
+            dataset_id=archived,
+            body="{}",
+            attributes=action,
+        )
+
+    failures = list(read_journal(path))
+    assert failures[1].attributes == action
+
+    # Both datasets are indexed, but only the archive is still to be done
+    remaining = not_indexed(Datacube({added, archived}), failures)
+    assert [f.source for f in remaining] == ["message-2"]
+
+    (message,) = JournalQueue(remaining).receive_messages()
+    assert message_action(message) == "archive"
@@ -0,0 +1,115 @@
+"""
+Test for concurrent S3 listing against an in-memory bucket
+"""
+import time
+
+from odc_index.listing import could_match, match_parts, s3_find_parallel
+from odc_index.shard import Shard, in_shard
+
+KEYS = [
+    "L2/2020/01/01/a/ARD-METADATA.yaml",
+    "L2/2020/01/01/a/band.tif",
+    "L2/2020/01/02/b/ARD-METADATA.yaml",
+    "L2/2020/02/01/c/ARD-METADATA.yaml",
+    "L2/2021/01/01/d/ARD-METADATA.yaml",
+    "L2/ARD-METADATA.yaml",
+    "other/2020/ARD-METADATA.yaml",
+]
+
+
+class FakeS3:
+    """list_objects_v2 over a fixed set of keys, two results per page"""
+
+    def __init__(self, keys, page_size=2):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.calls = 0
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        self.calls += 1
+        entries = []
+        for key in self.keys:
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix) :]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if ("prefix", common) not in entries:
+                    entries.append(("prefix", common))
+            else:
+                entries.append(("key", key))
+
+        start = int(ContinuationToken or 0)
+        page = entries[start : start + self.page_size]
+        response = {
+            "Contents": [{"Key": v} for t, v in page if t == "key"],
+            "CommonPrefixes": [{"Prefix": v} for t, v in page if t == "prefix"],
+            "IsTruncated": start + self.page_size < len(entries),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + self.page_size)
+        return response
+
+
+def _find(uri, **kwargs):
+    return sorted(o.url for o in s3_find_parallel(uri, parallelism=4, **kwargs))
+
+
+def test_match_parts():
+    assert match_parts(["a", "b", "x.yaml"], ["**", "*.yaml"])
+    assert match_parts(["x.yaml"], ["**", "*.yaml"])
+    assert not match_parts(["a", "x.tif"], ["**", "*.yaml"])
+    assert match_parts(["2020", "01", "x.yaml"], ["2020", "*", "*.yaml"])
+    assert not match_parts(["2020", "x.yaml"], ["2020", "*", "*.yaml"])
+
+    assert could_match(["2020"], ["2020", "*", "*.yaml"])
+    assert not could_match(["2021"], ["2020", "*", "*.yaml"])
+    assert not could_match(["2020", "01"], ["*", "*.yaml"])
+
+
+def test_recursive_glob():
+    s3 = FakeS3(KEYS)
+    expected = sorted(
+        f"s3://bucket/{k}" for k in KEYS if k.startswith("L2/") and k.endswith(".yaml")
+    )
+    for depth in (0, 1, 10):
+        assert _find("s3://bucket/L2/**/*.yaml", fanout_depth=depth, s3=s3) == expected
+
+
+def test_prunes_prefixes():
+    s3 = FakeS3(KEYS)
+    assert _find("s3://bucket/L2/2020/*/01/*/ARD-METADATA.yaml", s3=s3) == [
+        "s3://bucket/L2/2020/01/01/a/ARD-METADATA.yaml",
+        "s3://bucket/L2/2020/02/01/c/ARD-METADATA.yaml",
+    ]
+
+
+def test_shards_cover_keys_exactly_once():
+    s3 = FakeS3(KEYS)
+    everything = _find("s3://bucket/L2/**/*.yaml", s3=s3)
+    for by in ("key", "prefix"):
+        shards = [
+            _find("s3://bucket/L2/**/*.yaml", shard=Shard(i, 3), by=by, s3=s3)
+            for i in range(3)
+        ]
+        assert sorted(sum(shards, [])) == everything
+
+
+def test_single_level_globs_shard_by_key():
+    keys = [f"L2/{i}.yaml" for i in range(20)]
+    s3 = FakeS3(keys)
+    found = _find("s3://bucket/L2/*.yaml", shard=Shard(1, 3), by="prefix", s3=s3)
+    # The same keys as s3_find_shard, which falls back to sharding by key
+    assert found == sorted(
+        f"s3://bucket/{k}" for k in keys if in_shard(f"s3://bucket/{k}", Shard(1, 3))
+    )
+
+
+def test_listing_stays_ahead_of_the_consumer_by_a_bounded_amount():
+    s3 = FakeS3([f"L2/{i:03}/ARD-METADATA.yaml" for i in range(200)], page_size=1000)
+    listing = s3_find_parallel("s3://bucket/L2/*/ARD-METADATA.yaml", 2, s3=s3)
+    next(listing)
+    # Give the threads time to list everything they were handed
+    time.sleep(0.2)
+    listing.close()
+    assert s3.calls <= 1 + 2 * 2 + 1
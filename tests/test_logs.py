@@ -0,0 +1,93 @@
+"""
+Test for sampled and queued logging
+"""
+import json
+import logging
+
+from odc_index.logs import (
+    JsonFormatter,
+    RateLog,
+    _DeferredQueueHandler,
+    setup_logging,
+)
+
+
+class _Capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    capture = _Capture()
+    logger.handlers = [capture]
+    return logger, capture
+
+
+def test_successes_are_sampled():
+    logger, capture = _logger("test_sampled")
+    progress = RateLog(every=10, interval=3600, logger=logger)
+    for i in range(25):
+        progress.success("Indexed %s", i)
+    progress.failure("Failed %s", "x")
+
+    messages = [r.getMessage() for r in capture.records]
+    assert messages == ["Indexed 9", "Indexed 19", "Failed x"]
+
+    progress.close()
+    assert "25 datasets succeeded" in capture.records[-1].getMessage()
+
+
+def test_summaries_replace_per_item_lines():
+    logger, capture = _logger("test_summaries")
+    progress = RateLog("messages", every=0, interval=0, logger=logger)
+    progress.success("Handled %s", 1)
+    progress.success("Handled %s", 2)
+
+    messages = [r.getMessage() for r in capture.records]
+    assert len(messages) == 2
+    assert all("1 messages succeeded" in m for m in messages)
+
+
+def test_formatting_is_deferred():
+    class Expensive:
+        formatted = False
+
+        def __str__(self):
+            Expensive.formatted = True
+            return "expensive"
+
+    records = []
+    handler = _DeferredQueueHandler(records)
+    handler.enqueue = records.append
+    logger = logging.getLogger("test_deferred")
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.error("%s", Expensive())
+
+    assert not Expensive.formatted
+    entry = json.loads(JsonFormatter().format(records[0]))
+    assert entry["message"] == "expensive"
+    assert entry["level"] == "ERROR"
+
+
+def test_setup_logging(capsys):
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    try:
+        listener = setup_logging(json_format=True)
+        logging.getLogger("test_setup").info("Indexed %s", "a")
+        # Wait for the listener thread to handle the record
+        listener.queue.join()
+    finally:
+        root.handlers, root.level = handlers, level
+
+    entry = json.loads(capsys.readouterr().err.strip().splitlines()[-1])
+    assert entry["message"] == "Indexed a"
+    assert entry["logger"] == "test_setup"
@@ -0,0 +1,58 @@
+"""
+Test for filtering keys on fields parsed with key templates
+"""
+from datetime import date
+
+import pytest
+
+from odc_index.predicates import KeyFilter, compile_template, date_span
+
+LANDSAT = "s3://dea-public-data/baseline/ga_ls8c_ard_3/{}/{}/{}/ga_ls8c_ard_3.yaml"
+LANDSAT_TEMPLATE = "ga_ls8c_ard_3/{path}/{row}/{year}/{month}/{day}/*.yaml"
+
+
+def _landsat(path, row, day):
+    return LANDSAT.format(path, row, day.replace("-", "/"))
+
+
+def test_compile_template():
+    pattern = compile_template("S2MSIARD/{date}/*_T{tile}_*/ARD-METADATA.yaml")
+    m = pattern.search(
+        "L2/sentinel-2-nrt/S2MSIARD/2020-05-01/"
+        "S2A_OPER_MSI_ARD_TL_VGS1_20200501T012035_A025357_T56LLM_N02.09"
+        "/ARD-METADATA.yaml"
+    )
+    assert m.groupdict() == {"date": "2020-05-01", "tile": "56LLM"}
+    # Only matches at a path component boundary
+    assert pattern.search("xS2MSIARD/2020-05-01/a_T56LLM_b/ARD-METADATA.yaml") is None
+    with pytest.raises(ValueError):
+        compile_template("{date}/{date}")
+
+
+def test_date_span():
+    assert date_span({"date": "20200229"}) == (date(2020, 2, 29),) * 2
+    assert date_span({"year": "2020", "month": "02"}) == (
+        date(2020, 2, 1),
+        date(2020, 2, 29),
+    )
+    assert date_span({"tile": "56LLM"}) is None
+
+
+def test_key_filter():
+    key_filter = KeyFilter(
+        LANDSAT_TEMPLATE,
+        from_date=date(2020, 1, 1),
+        to_date=date(2020, 1, 31),
+        region_codes=["088080", "089080"],
+    )
+    assert key_filter(_landsat("088", "080", "2020-01-15"))
+    assert not key_filter(_landsat("088", "080", "2019-12-31"))
+    assert not key_filter(_landsat("088", "080", "2020-02-01"))
+    assert not key_filter(_landsat("090", "080", "2020-01-15"))
+    assert not key_filter("s3://dea-public-data/baseline/other/dataset.yaml")
+    assert (key_filter.kept, key_filter.dropped) == (1, 4)
+
+    # Partial dates keep keys whose period overlaps the window
+    key_filter = KeyFilter("{year}/{month}/*.yaml", from_date=date(2020, 1, 31))
+    assert key_filter("s3://bucket/2020/01/a.yaml")
+    assert not key_filter("s3://bucket/2019/12/a.yaml")
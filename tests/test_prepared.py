@@ -0,0 +1,56 @@
+"""
+Test for prepared dataset files and their COPY stream
+"""
+import gzip
+import json
+from types import SimpleNamespace
+
+from odc_index import prepared
+from odc_index.db import _LineReader
+from odc_index.journal import FailureJournal
+from odc_index.prepared import prepare_datasets, read_prepared
+
+
+def test_read_prepared(tmp_path):
+    path = str(tmp_path / "prepared.jsonl.gz")
+    with gzip.open(path, "wb") as f:
+        f.write(b'{"id":"a"}\n\n{"id":"b"}\n')
+    assert list(read_prepared(path)) == [b'{"id":"a"}', b'{"id":"b"}']
+
+
+def test_failures_are_journaled(tmp_path):
+    path = str(tmp_path / "prepared.jsonl")
+    journal = FailureJournal(str(tmp_path / "journal.jsonl"), "s3-to-dc", {})
+    stream = [("s3://bucket/a.yaml", None, "Failed to parse", "parse")]
+    assert prepare_datasets(stream, path, journal) == (0, 1)
+    assert journal.count == 1
+    assert list(read_prepared(path)) == []
+
+
+def test_line_reader():
+    reader = _LineReader([b'{"id":"a"}', b'{"id":"b"}'])
+    assert reader.read(4) == b'{"id'
+    assert reader.read() == b'":"a"}\n{"id":"b"}\n'
+    assert reader.read(8192) == b""
+
+
+def test_lineage_is_prepared_first(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepared, "prepared_row", lambda ds: {"id": ds.id})
+    level1 = SimpleNamespace(id="level1", sources={})
+    ard = SimpleNamespace(id="ard", sources={"level1": level1})
+    fc = SimpleNamespace(id="fc", sources={"ard": ard})
+    wofs = SimpleNamespace(id="wofs", sources={"ard": ard})
+    stream = [
+        ("s3://bucket/fc.yaml", fc, None, None),
+        ("s3://bucket/wofs.yaml", wofs, None, None),
+    ]
+
+    path = str(tmp_path / "prepared.jsonl")
+    assert prepare_datasets(stream, path) == (2, 0)
+    # Shared lineage is only written once, before the first dataset that needs it
+    assert [json.loads(line)["id"] for line in read_prepared(path)] == [
+        "level1",
+        "ard",
+        "fc",
+        "wofs",
+    ]
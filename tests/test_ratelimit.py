@@ -0,0 +1,68 @@
+"""
+Test for S3 request rate limiting
+"""
+import time
+
+import pytest
+
+from odc_index.ratelimit import S3RateLimiter, TokenBucket, is_throttle, s3_client
+
+
+class ThrottleError(Exception):
+    def __init__(self, code="SlowDown", status=503):
+        super().__init__(code)
+        self.response = {
+            "Error": {"Code": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+def test_is_throttle():
+    assert is_throttle(ThrottleError())
+    assert is_throttle(ThrottleError("InternalError", 503))
+    assert not is_throttle(ThrottleError("NoSuchKey", 404))
+    assert not is_throttle(ValueError())
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(100)
+    start = time.monotonic()
+    for _ in range(150):
+        bucket.acquire()
+    # A burst of 100, then 50 more at 100 per second
+    assert time.monotonic() - start >= 0.45
+
+    bucket.decrease()
+    assert bucket.rate == 50
+    bucket.increase()
+    assert bucket.rate == 51
+
+
+def test_throttled_requests_are_retried(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    calls = []
+
+    def get_object(Bucket, Key):
+        calls.append(Key)
+        if len(calls) < 3:
+            raise ThrottleError()
+        return {"Body": b""}
+
+    limiter = S3RateLimiter(rate=1000, prefix_rate=1000, prefix_depth=2)
+    assert limiter.call(get_object, "bucket", "L2/s2/2020/a.yaml") == {"Body": b""}
+    assert limiter.throttled == 2
+    assert list(limiter._prefixes) == ["bucket/L2/s2"]
+    assert limiter._prefixes["bucket/L2/s2"].rate < 1000
+
+    def always_throttled(Bucket, Key):
+        raise ThrottleError()
+
+    with pytest.raises(ThrottleError):
+        S3RateLimiter(rate=1000, retries=2).call(always_throttled, "bucket", "key")
+
+
+def test_limited_clients_leave_retries_to_the_limiter():
+    client = s3_client(S3RateLimiter(rate=10))
+    # botocore keeps no retries as a single attempt in total
+    assert client.meta.config.retries["total_max_attempts"] == 1
+    assert "total_max_attempts" not in s3_client().meta.config.retries
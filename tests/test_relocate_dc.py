@@ -0,0 +1,23 @@
+"""
+Test for mapping listed documents back to their old locations
+"""
+from odc_index.relocate_dc import listed_pairs
+
+
+def test_listed_pairs():
+    urls = [
+        "s3://new-bucket/ls8/088/080/a.yaml",
+        "s3://new-bucket/ls8/088/081/b.yaml",
+        "s3://elsewhere/ls8/088/082/c.yaml",
+        "s3://new-bucket/ls8/088/083/d.yaml",
+    ]
+    batches = list(
+        listed_pairs(urls, "https://old.example/ls8/", "s3://new-bucket/ls8/", 2)
+    )
+    assert batches == [
+        [
+            ("https://old.example/ls8/088/080/a.yaml", urls[0]),
+            ("https://old.example/ls8/088/081/b.yaml", urls[1]),
+        ],
+        [("https://old.example/ls8/088/083/d.yaml", urls[3])],
+    ]
@@ -0,0 +1,84 @@
+"""
+Test for routing reads to a replica
+"""
+from odc_index.datasets import RoutedDoc2Dataset, make_doc2ds
+from odc_index.replica import ReadRouter
+
+
+class Products:
+    def __init__(self, name):
+        self.name = name
+
+    def get_by_name(self, product):
+        return f"{product} from the {self.name}"
+
+
+class Index:
+    def __init__(self, name):
+        self.products = Products(name)
+
+
+class Datacube:
+    def __init__(self, name):
+        self.index = Index(name)
+
+
+def test_reads_fall_back_to_the_primary():
+    primary, replica = Datacube("primary"), Datacube("replica")
+    lags = iter([5.0, 60.0, ConnectionError("replica is down"), 0.0])
+
+    def lag(dc):
+        assert dc is replica
+        value = next(lags)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    reads = ReadRouter(primary, replica, max_lag=30, check_interval=0, lag=lag)
+    assert reads.reader() is replica
+    assert reads.reader() is primary
+    assert reads.reader() is primary
+    assert reads.reader() is replica
+    assert reads.fallbacks == 1
+
+    reads = ReadRouter(primary, replica, max_lag=30, check_interval=3600, lag=lag)
+    lags = iter([0.0])
+    assert reads.reader() is replica
+    # The lag is not measured again within the check interval
+    assert reads.reader() is replica
+
+
+def test_primary_alone():
+    primary = Datacube("primary")
+    reads = ReadRouter(primary)
+    assert reads.reader() is primary
+    assert not reads.replica_ok()
+
+
+def test_products_load_from_the_replica():
+    primary, replica = Datacube("primary"), Datacube("replica")
+    lags = iter([0.0, 60.0])
+    reads = ReadRouter(primary, replica, check_interval=0, lag=lambda dc: next(lags))
+
+    doc2ds = make_doc2ds(primary.index, ["ls8"], trusted=True, reads=reads)
+    assert isinstance(doc2ds, RoutedDoc2Dataset)
+    assert doc2ds._replica.products == {"ls8": "ls8 from the replica"}
+    assert doc2ds._primary is None
+
+
+def test_lineage_lookups_fall_back_to_the_primary():
+    primary, replica = Datacube("primary"), Datacube("replica")
+    lags = iter([0.0, 60.0, 60.0])
+    reads = ReadRouter(primary, replica, check_interval=0, lag=lambda dc: next(lags))
+    made = []
+
+    def make(index):
+        made.append(index)
+        return lambda doc, uri: (index.products.name, uri)
+
+    doc2ds = RoutedDoc2Dataset(reads, make, primary.index)
+    assert doc2ds({}, "a.yaml") == ("replica", "a.yaml")
+    assert doc2ds({}, "b.yaml") == ("primary", "b.yaml")
+    assert doc2ds({}, "c.yaml") == ("primary", "c.yaml")
+    # The primary's products are only loaded once, on the first fallback
+    assert made == [replica.index, primary.index]
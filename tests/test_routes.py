@@ -0,0 +1,73 @@
+"""
+Test for multi-queue sqs-to-dc configs
+"""
+import pytest
+
+from odc_index.routes import QueueRoute, load_routes, parse_routes
+
+CONFIG = """
+queues:
+  - queue: dea-ls8-ard
+    products: ga_ls8c_ard_3 ga_ls8c_ard_provisional_3
+    stac: true
+    odc_metadata_link: STAC-LINKS-REL:odc_yaml
+  - queue: dea-s2-nrt
+    products: [s2a_nrt_granule, s2b_nrt_granule]
+    record_path:
+      - L2/sentinel-2-nrt/S2MSIARD/*/*/ARD-METADATA.yaml
+    region_code_list_uri: region_codes.csv
+"""
+
+
+def test_load_routes(tmp_path):
+    path = tmp_path / "queues.yaml"
+    path.write_text(CONFIG)
+
+    ls8, s2 = load_routes(str(path))
+    assert ls8 == QueueRoute(
+        queue="dea-ls8-ard",
+        products=("ga_ls8c_ard_3", "ga_ls8c_ard_provisional_3"),
+        stac=True,
+        odc_metadata_link="STAC-LINKS-REL:odc_yaml",
+    )
+    assert s2.products == ("s2a_nrt_granule", "s2b_nrt_granule")
+    assert s2.record_path == ("L2/sentinel-2-nrt/S2MSIARD/*/*/ARD-METADATA.yaml",)
+    assert not s2.stac
+    assert s2.params() == {
+        "queue_name": "dea-s2-nrt",
+        "product": "s2a_nrt_granule s2b_nrt_granule",
+        "stac": False,
+        "odc_metadata_link": None,
+        "record_path": ["L2/sentinel-2-nrt/S2MSIARD/*/*/ARD-METADATA.yaml"],
+        "region_code_list_uri": "region_codes.csv",
+    }
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        None,
+        {"queues": []},
+        {"queues": ["dea-ls8-ard"]},
+        {"queues": [{"products": "ls8"}]},
+        {"queues": [{"queue": "dea-ls8-ard"}]},
+        {"queues": [{"queue": "dea-ls8-ard", "products": "ls8", "update": True}]},
+        {"queues": [{"queue": "dea-ls8-ard", "products": [1]}]},
+        {
+            "queues": [
+                {"queue": "a", "products": "ls8"},
+                {"queue": "a", "products": "ls7"},
+            ]
+        },
+    ],
+)
+def test_invalid_routes(config):
+    with pytest.raises(ValueError):
+        parse_routes(config)
+
+
+def test_unparseable_config(tmp_path):
+    path = tmp_path / "queues.yaml"
+    path.write_text("queues: [")
+    with pytest.raises(ValueError):
+        load_routes(str(path))
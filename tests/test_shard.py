@@ -0,0 +1,42 @@
+"""
+Test for deterministic sharding
+"""
+import pytest
+
+from odc_index.shard import Shard, in_shard, parse_shard, shard_of, top_level_prefix
+
+
+def test_parse_shard():
+    assert parse_shard("2/8") == Shard(2, 8)
+
+    for bad in ["8/8", "-1/8", "1", "a/b", "0/0"]:
+        with pytest.raises(ValueError):
+            parse_shard(bad)
+
+
+def test_shards_cover_names_exactly_once():
+    names = [f"s3://bucket/prefix/{i}/metadata.yaml" for i in range(1000)]
+    shards = [Shard(i, 4) for i in range(4)]
+
+    for name in names:
+        assert sum(in_shard(name, shard) for shard in shards) == 1
+    # Stable across calls and roughly balanced
+    assert shard_of(names[0], 4) == shard_of(names[0], 4)
+    assert all(
+        150 < sum(in_shard(name, shard) for name in names) < 350 for shard in shards
+    )
+
+
+def test_top_level_prefix():
+    root = "http://dapds00.nci.org.au/thredds/catalog/if87/2018-11-29/"
+    url = (
+        "http://dapds00.nci.org.au/thredds/fileServer/if87/2018-11-29/"
+        "S2A_OPER_MSI_ARD_TL_EPAE_20181129T012952_A017945_T56LLM_N02.07/ARD-METADATA.yaml"
+    )
+    assert (
+        top_level_prefix(url, root)
+        == "S2A_OPER_MSI_ARD_TL_EPAE_20181129T012952_A017945_T56LLM_N02.07"
+    )
+    assert (
+        top_level_prefix("http://elsewhere/a.yaml", root) == "http://elsewhere/a.yaml"
+    )
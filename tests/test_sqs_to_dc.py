@@ -17,6 +17,7 @@ from odc_index.sqs_to_dc import (
     get_metadata_uri,
     get_metadata_from_s3_record,
     get_s3_url,
+    matching_s3_records,
 )
 
 
@@ -46,6 +47,27 @@ def test_get_metadata_s3_object(sentinel_2_nrt_message, sentinel_2_nrt_record_pa
     )
 
 
+def test_matching_s3_records(sentinel_2_nrt_record_path):
+    keys = [
+        "L2/sentinel-2-nrt/S2MSIARD/2020-08-21/A/ARD-METADATA.yaml",
+        "L2/sentinel-2-nrt/S2MSIARD/2020-08-21/A/NBAR/band.tif",
+        "L2/sentinel-2-nrt/S2MSIARD/2020-08-21/B/ARD-METADATA.yaml",
+    ]
+    message = {
+        "Records": [
+            {"s3": {"bucket": {"name": "dea-public-data"}, "object": {"key": key}}}
+            for key in keys
+        ]
+    }
+
+    assert matching_s3_records(message, sentinel_2_nrt_record_path) == [
+        ("dea-public-data", keys[0]),
+        ("dea-public-data", keys[2]),
+    ]
+    assert len(matching_s3_records(message, None)) == 3
+    assert matching_s3_records({}, sentinel_2_nrt_record_path) == []
+
+
 def test_get_metadata_uri(ga_ls8c_ard_3_message, ga_ls8c_ard_3_yaml):
     actual_doc, uri = get_metadata_uri(
         ga_ls8c_ard_3_message, None, "STAC-LINKS-REL:odc_yaml"
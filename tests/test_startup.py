@@ -0,0 +1,63 @@
+"""
+Startup regression tests for the command line tools, which are launched
+as short lived jobs so must not pay for heavy imports they do not use
+"""
+import subprocess
+import sys
+import time
+
+import pytest
+
+CLI_MODULES = [
+    "odc_index.load_dc",
+    "odc_index.relocate_dc",
+    "odc_index.replay_to_dc",
+    "odc_index.s3_to_dc",
+    "odc_index.sqs_to_dc",
+    "odc_index.stac_api_to_dc",
+    "odc_index.thredds_to_dc",
+]
+
+# Only imported once a code path needs them
+HEAVY_MODULES = {
+    "boto3",
+    "datacube",
+    "odc.aio",
+    "odc.index",
+    "odc.thredds",
+    "pandas",
+    "requests",
+    "satsearch",
+    "sqlalchemy",
+    "toolz",
+}
+
+# Generous wall time budget for `--help`, in seconds
+HELP_BUDGET = 2.0
+
+
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_import_is_lazy(module):
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print(' '.join(sys.modules))"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    assert HEAVY_MODULES.isdisjoint(result.stdout.split())
+
+
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_help_startup_time(module):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-m", module, "--help"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    assert "Usage:" in result.stdout
+    assert elapsed < HELP_BUDGET, f"{module} --help took {elapsed:.2f}s"
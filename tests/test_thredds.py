@@ -0,0 +1,148 @@
+"""
+Test for incremental THREDDS crawling against canned catalogs
+"""
+from types import SimpleNamespace
+
+from odc_index import thredds_to_dc
+from odc_index.thredds import CatalogCache, crawl_catalog, parse_catalog
+
+ROOT = "http://thredds.example/thredds/catalog/if87/catalog.xml"
+
+CATALOG = """<?xml version="1.0" encoding="UTF-8"?>
+<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"
+         xmlns:xlink="http://www.w3.org/1999/xlink">
+  <service name="all" serviceType="Compound" base="">
+    <service name="http" serviceType="HTTPServer" base="/thredds/fileServer/" />
+  </service>
+  <dataset name="{name}" ID="{path}">
+    {refs}
+    <dataset name="ARD-METADATA.yaml" ID="{path}/ARD-METADATA.yaml"
+             urlPath="{path}/ARD-METADATA.yaml">
+      <dataSize units="Kbytes">12</dataSize>
+      <date type="modified">{modified}</date>
+    </dataset>
+  </dataset>
+</catalog>
+"""
+
+REF = '<catalogRef xlink:href="{0}/catalog.xml" xlink:title="{0}" name="" />'
+
+
+def _catalog(path, refs=(), modified="2020-01-01T00:00:00Z"):
+    return CATALOG.format(
+        name=path.split("/")[-1],
+        path=path,
+        refs="".join(REF.format(r) for r in refs),
+        modified=modified,
+    ).encode()
+
+
+class FakeSession:
+    """Serves catalogs by URL and answers conditional requests by ETag"""
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(url)
+        body = self.catalogs[url]
+        etag = f'"{hash(body)}"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return SimpleNamespace(status_code=304, content=b"", headers={})
+        return SimpleNamespace(
+            status_code=200,
+            content=body,
+            headers={"ETag": etag},
+            raise_for_status=lambda: None,
+        )
+
+
+def _catalogs(modified="2020-01-01T00:00:00Z"):
+    base = "http://thredds.example/thredds/catalog/if87"
+    return {
+        ROOT: _catalog("if87", ["a", "b", "QA"]),
+        f"{base}/a/catalog.xml": _catalog("if87/a"),
+        f"{base}/b/catalog.xml": _catalog("if87/b", modified=modified),
+        f"{base}/QA/catalog.xml": _catalog("if87/QA"),
+    }
+
+
+def test_parse_catalog():
+    catalog = parse_catalog(
+        ROOT, _catalog("if87", ["a", "QA"]), [".*/QA/.*"], [".*ARD-METADATA.yaml"]
+    )
+    assert catalog.refs == ["http://thredds.example/thredds/catalog/if87/a/catalog.xml"]
+    assert catalog.datasets == [
+        (
+            "http://thredds.example/thredds/fileServer/if87/ARD-METADATA.yaml",
+            "2020-01-01T00:00:00Z|12",
+        )
+    ]
+
+
+def test_incremental_crawl(tmp_path):
+    skips, select = [".*/QA/.*"], [".*ARD-METADATA.yaml"]
+    session = FakeSession(_catalogs())
+    with CatalogCache(str(tmp_path)) as cache:
+        crawled = list(crawl_catalog(ROOT, skips, select, cache, session=session))
+        assert len(crawled) == 3
+        assert cache.new_or_changed(crawled) == crawled
+        cache.mark_indexed(crawled)
+
+    # Only the changed dataset is reported, unchanged catalogs are revalidated
+    session = FakeSession(_catalogs(modified="2020-02-01T00:00:00Z"))
+    with CatalogCache(str(tmp_path)) as cache:
+        crawled = list(crawl_catalog(ROOT, skips, select, cache, session=session))
+        changed = cache.new_or_changed(crawled)
+        assert [url for url, _ in changed] == [
+            "http://thredds.example/thredds/fileServer/if87/b/ARD-METADATA.yaml"
+        ]
+        assert cache.hits == 2
+        assert cache.misses == 1
+        # Subcatalogs of unchanged catalogs are revalidated all the same
+        assert len(session.requests) == 3
+
+    # Catalogs checked recently are not requested at all
+    session = FakeSession(_catalogs())
+    with CatalogCache(str(tmp_path)) as cache:
+        crawled = list(
+            crawl_catalog(ROOT, skips, select, cache, max_age=3600, session=session)
+        )
+        assert len(crawled) == 3
+        assert session.requests == []
+
+
+def test_changed_datasets_are_updated(monkeypatch):
+    new, changed, broken = (SimpleNamespace(id=n) for n in ("new", "changed", "broken"))
+    stream = [
+        ("https://a/new.yaml", new, None, None),
+        ("https://a/changed.yaml", changed, None, None),
+        ("https://a/broken.yaml", broken, None, None),
+    ]
+    updated = []
+
+    def update_datasets(dc, datasets):
+        for ds in datasets:
+            if ds is broken:
+                raise ValueError("Unsafe changes")
+            updated.append(ds)
+
+    monkeypatch.setattr(thredds_to_dc, "doc_stream_to_datasets", lambda *a, **k: stream)
+    monkeypatch.setattr(thredds_to_dc, "add_datasets_if_absent", lambda dc, ds: ds)
+    monkeypatch.setattr(thredds_to_dc, "bulk_unchanged", lambda dc, ds: set())
+    monkeypatch.setattr(thredds_to_dc, "update_datasets", update_datasets)
+
+    written = set()
+    added, failed = thredds_to_dc.dump_list_to_odc(
+        [],
+        SimpleNamespace(index=None),
+        ["product"],
+        update_uris={"https://a/changed.yaml", "https://a/broken.yaml"},
+        written=written,
+    )
+
+    assert (added, failed) == (1, 1)
+    assert updated == [changed]
+    # Only datasets the index now matches are recorded as indexed
+    assert written == {"https://a/new.yaml", "https://a/changed.yaml"}